@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the import time of the plugin modules, as done by PyMoDAQ when it discovers plugins
+
+Each module is imported in a fresh interpreter, the median of several runs is reported. Importing the
+mini-spectrometer wrapper should neither load the .NET driver nor scan the USB devices.
+
+Usage: python benchmarks/bench_import.py [number_of_runs]
+"""
+import statistics
+import subprocess
+import sys
+
+MODULES = ('pymodaq_plugins_hamamatsu.hardware.minispectro',
+           'pymodaq_plugins_hamamatsu.daq_viewer_plugins.plugins_1D.daq_1Dviewer_MiniSpectro',
+           'pymodaq_plugins_hamamatsu.daq_viewer_plugins.plugins_2D.daq_2Dviewer_Hamamatsu')
+
+SNIPPET = """
+import time
+import pymodaq_plugins_hamamatsu  # package and pymodaq configuration are loaded by PyMoDAQ anyway
+start = time.perf_counter()
+try:
+    import {module}
+except Exception as e:
+    print('failed', repr(e))
+else:
+    print(time.perf_counter() - start)
+"""
+
+
+def import_time(module):
+    output = subprocess.run([sys.executable, '-c', SNIPPET.format(module=module)],
+                            capture_output=True, text=True).stdout.strip().splitlines()
+    if not output or output[-1].startswith('failed'):
+        return None
+    return float(output[-1])
+
+
+def main(runs=5):
+    for module in MODULES:
+        times = [import_time(module) for _ in range(runs)]
+        if None in times:
+            print(f'{module}: import failed')
+        else:
+            print(f'{module}: {statistics.median(times) * 1e3:.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the conversion of the .NET sensor buffer into a numpy array
+
+Compares the element by element conversion through pythonnet (np.array(net_array)) with the
+pinned block copy of dotnet_utils.dotnet_to_numpy, for each mini-spectrometer sensor size.
+Only requires pythonnet with a working .NET runtime (no driver nor device).
+
+Usage: python benchmarks/bench_sensor_buffer.py [number_of_repeats]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from pymodaq_plugins_hamamatsu.hardware.dotnet_utils import dotnet_to_numpy, numpy_to_dotnet  # loads pythonnet (clr)
+import System  # noqa: E402 (only importable once the .NET runtime is loaded)
+
+SENSOR_SIZES = (256, 512, 1024, 2048)
+
+
+def main(number=200):
+    print(f"{'pixels':>8} {'np.array (µs)':>15} {'block copy (µs)':>17} {'speed-up':>10}")
+    for size in SENSOR_SIZES:
+        net_array = numpy_to_dotnet(np.arange(size, dtype=np.uint16), System.UInt16)
+        out = np.empty(size, dtype=np.uint16)
+        assert np.array_equal(np.array(net_array), dotnet_to_numpy(net_array, out))
+
+        t_old = min(timeit.repeat(lambda: np.array(net_array), number=number, repeat=5)) / number
+        t_new = min(timeit.repeat(lambda: dotnet_to_numpy(net_array, out), number=number, repeat=5)) / number
+        print(f'{size:>8} {t_old * 1e6:>15.1f} {t_new * 1e6:>17.1f} {t_old / t_new:>9.0f}x')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
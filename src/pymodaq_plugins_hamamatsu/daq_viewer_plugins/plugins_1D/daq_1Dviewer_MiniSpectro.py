@@ -1,10 +1,27 @@
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+
 import numpy as np
 from pymodaq.utils.daq_utils import ThreadCommand
 from pymodaq.utils.data import DataFromPlugins, Axis, DataToExport
 from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
 from pymodaq.utils.parameter import Parameter
+from pymodaq.utils.config import get_set_local_dir
 
+from pymodaq_plugins_hamamatsu.hardware.averaging import Accumulator
 from pymodaq_plugins_hamamatsu.hardware.minispectro import MiniSpectro
+from pymodaq_plugins_hamamatsu.hardware.minispectro_group import MiniSpectroGroup
+from pymodaq_plugins_hamamatsu.hardware.minispectro_replay import RecordingMiniSpectro, MiniSpectroReplay
+from pymodaq_plugins_hamamatsu.hardware.minispectro_sim import MiniSpectroSim, SIMULATED_MODELS
+from pymodaq_plugins_hamamatsu.hardware.spectrum_reader import SpectrumRingBuffer, SpectrumReader, read_burst
+from pymodaq_plugins_hamamatsu.hardware.spectro_processing import DarkSpectra, SpectrumCorrector, WavelengthResampler, \
+    load_nonlinearity, uniform_grid
+from pymodaq_plugins_hamamatsu.hardware.stream_file import STREAM_SUFFIX, indexed_path
+
+TRIGGER_MODES = {'Internal': 0x00, 'External (edge)': 0x01, 'External (gate)': 0x02}
+TRIGGER_EDGES = {'Rising edge': 0x00, 'Falling edge': 0x01}
+GAINS = {'Low gain': 0x00, 'High gain': 0x01}
 
 
 class DAQ_1DViewer_MiniSpectro(DAQ_Viewer_base):
@@ -23,8 +40,46 @@ class DAQ_1DViewer_MiniSpectro(DAQ_Viewer_base):
     should work with the .dll file in its default location (C:\Program Files\Hamamatsu\TokuSpec) but make sure to change its
     path in the python wrapper "minispectro.py" in the case you place it somewhere else. This .dll file can also be found in
     the installation files of the Hamamatsu Evaluation Software originally provided with the device CD.
+
+    Averaging is done within the plugin (hardware_averaging): the Naverage spectra are accumulated in place and only
+    their mean (and optionally standard deviation) is emitted.
+
+    In "Continuous" acquisition mode, spectra are read by a background thread into a ring buffer, grab_data only publishes
+    the next (or latest already acquired) spectra and does not block the viewer for the integration time.
+
+    Changes of the device parameters (integration time, gain, trigger) are gathered and written to the device in a
+    single call at the beginning of the next grab, so reconfiguring several of them (presets, scans) is cheap.
+
+    Spectra can be corrected before being averaged and emitted: subtraction of a dark spectrum, taken on demand ("Take
+    dark") and cached per integration time and gain, and a nonlinearity polynomial (common or per-pixel coefficients,
+    read from a file). Dark spectra are only taken on the user's action, with the light source off: a missing (or too
+    old) dark spectrum is reported at grab time, the spectra being emitted without dark subtraction.
+
+    In external trigger modes, "Burst" grabs read N triggered spectra back to back into a preallocated array, with the
+    host time of each readout, and emit them as a single Data2D (time since the first spectrum x wavelength), so that
+    there is no per-trigger overhead. Naverage bursts are averaged spectrum by spectrum.
+
+    Several spectrometers can be opened together (comma separated serial numbers): they share the device settings and
+    are acquired concurrently, one thread per device, their readouts being started together. Their spectra are emitted
+    in a single DataToExport (one Data1D per device, with its own wavelength axis), each one timestamped with the end
+    of its readout. The continuous acquisition mode is only available with a single device.
+
+    Spectra can be resampled (after correction and averaging) onto a uniform wavelength grid, common to all the devices,
+    by linear interpolation between the calibrated pixels. The interpolation matrix of each device is computed once per
+    calibration and grid.
+
+    A simulated device (no driver nor hardware needed) can be selected in the "Simulation" settings group, to test or
+    benchmark the acquisition chain on any machine.
+
+    The spectra read from the devices, with their timing, and the parameter changes can be recorded to a compact stream
+    file (one per device), and replayed later instead of opening the devices ("Stream replay" settings, applied at
+    initialization), at the recorded rate or faster: field acquisitions can then be reproduced, load tested and
+    benchmarked without the hardware.
     """
     params = comon_parameters + [
+        {'title': 'Serial numbers to open', 'name': 'device_serial', 'type': 'str', 'value': '',
+                        'tip': 'Serial numbers (comma separated) of the devices to open at initialization, first '
+                               'device found if empty'},
         {'title': 'Device ID', 'name': 'unit_id', 'type': 'str', 'value': '', 'readonly': True},
         {'title': 'Sensor name', 'name': 'sensor_name', 'type': 'str', 'value': '', 'readonly': True},
         {'title': 'Serial number', 'name': 'serial_number', 'type': 'str', 'value': '', 'readonly': True},
@@ -37,12 +92,100 @@ class DAQ_1DViewer_MiniSpectro(DAQ_Viewer_base):
                         'limits': ['Rising edge', 'Falling edge'], 'value': 'Rising edge'},
         {'title': 'Gain mode', 'name': 'gain', 'type': 'list', 'limits': ['Low gain', 'High gain', 'None'], 'value': ''},
         {'title': 'Integration time', 'name': 'integration_time', 'type': 'int', 'value': 100, 'min': 5, 'max': 10000,
-                        'siPrefix': True, 'suffix': 'ms', 'tip': 'MIN = 5 ms, MAX = 10000 ms'}
+                        'siPrefix': True, 'suffix': 'ms', 'tip': 'MIN = 5 ms, MAX = 10000 ms'},
+        {'title': 'Emit std deviation', 'name': 'emit_std', 'type': 'bool', 'value': False,
+                        'tip': 'When averaging, also emit the standard deviation of the averaged spectra'},
+        {'title': 'Acquisition', 'name': 'acquisition', 'type': 'group', 'children':
+            [{'title': 'Mode', 'name': 'acq_mode', 'type': 'list', 'limits': ['Synchronous', 'Continuous'],
+              'value': 'Synchronous', 'tip': 'Continuous: spectra are read in a background thread into a ring buffer'},
+             {'title': 'Publish', 'name': 'publish', 'type': 'list', 'limits': ['Next', 'Latest'], 'value': 'Next',
+              'tip': 'Continuous mode: publish the next acquired spectra, or the latest ones if not yet published'},
+             {'title': 'Ring buffer size', 'name': 'ring_size', 'type': 'int', 'value': 16, 'min': 2},
+             {'title': 'Burst (ext. trigger)', 'name': 'burst', 'type': 'bool', 'value': False,
+              'tip': 'External trigger modes: read Burst size triggered spectra per grab, emitted as one Data2D'},
+             {'title': 'Burst size', 'name': 'burst_size', 'type': 'int', 'value': 100, 'min': 1}]
+         },
+        {'title': 'Correction', 'name': 'correction', 'type': 'group', 'children':
+            [{'title': 'Subtract dark', 'name': 'subtract_dark', 'type': 'bool', 'value': False,
+              'tip': 'Subtract the dark spectrum of the current integration time and gain, if taken'},
+             {'title': 'Dark averages', 'name': 'dark_averages', 'type': 'int', 'value': 10, 'min': 1,
+              'tip': 'Number of spectra averaged to take a dark spectrum'},
+             {'title': 'Take dark', 'name': 'take_dark', 'type': 'bool_push', 'value': False,
+              'tip': 'Acquire the dark spectra of the current settings now, in internal trigger mode (light source '
+                     'off)'},
+             {'title': 'Clear darks', 'name': 'clear_darks', 'type': 'bool_push', 'value': False},
+             {'title': 'Dark max age (s)', 'name': 'dark_max_age', 'type': 'float', 'value': 0., 'min': 0.,
+              'tip': 'Dark spectra older than this are not subtracted anymore and should be taken again (0: no '
+                     'limit)'},
+             {'title': 'Dark available', 'name': 'dark', 'type': 'led', 'value': False, 'readonly': True},
+             {'title': 'Correct nonlinearity', 'name': 'nonlinearity', 'type': 'bool', 'value': False,
+              'tip': 'Apply the polynomial of the coefficients file to the (dark subtracted) counts'},
+             {'title': 'Coefficients file', 'name': 'nonlinearity_file', 'type': 'browsepath', 'value': '',
+              'filetype': True, 'tip': '.npy, .txt or .csv file of (degree + 1) or (degree + 1, pixels) polynomial '
+                                       'coefficients, constant term first'}]
+         },
+        {'title': 'Resampling', 'name': 'resampling', 'type': 'group', 'children':
+            [{'title': 'Uniform grid', 'name': 'resample', 'type': 'bool', 'value': False,
+              'tip': 'Interpolate the spectra onto a uniform wavelength grid (common to all the devices)'},
+             {'title': 'Start', 'name': 'grid_start', 'type': 'float', 'value': 0., 'min': 0., 'suffix': 'nm',
+              'tip': 'First wavelength of the grid (0: lower wavelength of the devices)'},
+             {'title': 'Stop', 'name': 'grid_stop', 'type': 'float', 'value': 0., 'min': 0., 'suffix': 'nm',
+              'tip': 'Last wavelength of the grid (0: upper wavelength of the devices)'},
+             {'title': 'Step', 'name': 'grid_step', 'type': 'float', 'value': 1., 'min': 0.001, 'suffix': 'nm'}]
+         },
+        {'title': 'Simulation', 'name': 'simulation', 'type': 'group', 'children':
+            [{'title': 'Simulated device', 'name': 'simulated', 'type': 'bool', 'value': False,
+              'tip': 'Use a simulated spectrometer instead of a real device (applied at initialization)'},
+             {'title': 'Sensor size', 'name': 'sim_sensor_size', 'type': 'list', 'limits': list(SIMULATED_MODELS),
+              'value': 1024},
+             {'title': 'Simulated devices', 'name': 'sim_devices', 'type': 'int', 'value': 1, 'min': 1, 'max': 8}]
+         },
+        {'title': 'Stream replay', 'name': 'replay', 'type': 'group', 'children':
+            [{'title': 'Record stream', 'name': 'record_stream', 'type': 'bool', 'value': False,
+              'tip': 'Record the spectra and parameter changes of the devices to stream files (applied at '
+                     'initialization)'},
+             {'title': 'Replay stream', 'name': 'replay_stream', 'type': 'bool', 'value': False,
+              'tip': 'Replay stream files instead of opening the devices (applied at initialization)'},
+             {'title': 'Stream file', 'name': 'stream_file', 'type': 'browsepath', 'value': '', 'filetype': True,
+              'tip': 'File of the first device, name_1, name_2... for the next ones. A new file in the local '
+                     'directory if empty when recording'},
+             {'title': 'Replay speed', 'name': 'speed', 'type': 'float', 'value': 1., 'min': 0.,
+              'tip': 'Ratio to the recorded rate, 0 to replay as fast as possible'},
+             {'title': 'Loop', 'name': 'loop', 'type': 'bool', 'value': True}]
+         }
         ]
+    hardware_averaging = True
 
     def ini_attributes(self):
         self.controller: MiniSpectro = None
+        self.controllers = []  # all the opened devices, the first one being self.controller
+        self.group: MiniSpectroGroup = None  # if several devices are opened
         self.x_axis = None
+        self.x_axes = []
+        self._raw_buffer: np.ndarray = None
+        self._accumulator: Accumulator = None
+
+        self._controller_lock = threading.RLock()  # shared with the reader thread
+        self._request_lock = threading.Lock()
+        self._ring: SpectrumRingBuffer = None
+        self._reader: SpectrumReader = None
+        self._request = None  # number of spectra to publish in continuous mode, None if no pending grab
+        self._first_valid_index = 0  # first spectrum of the ring acquired with the current settings
+        self._last_published = -1
+        self._pending_parameters = dict()  # device parameters to write at next grab
+
+        self.darks = DarkSpectra()
+        self._dark_warning = None  # settings for which a missing dark spectrum was reported
+        self.correctors = []  # one per device
+        self._corrected: np.ndarray = None  # corrected spectrum before accumulation
+        self._group_accumulators = []  # per device buffers to average spectra of several devices
+        self._group_raw = []
+        self._group_corrected = []
+        self._bursts = []  # per device buffers of the burst mode
+
+        self.resamplers = []  # one per device, empty if spectra are not resampled
+        self._resampler_cache = dict()  # (calibration and grid key, resampler) of each device, by device name
+        self._grid_axes = dict()  # axes of the grid, by index
 
     def commit_settings(self, param: Parameter):
         """Apply the consequences of a change of value in the detector settings
@@ -53,20 +196,51 @@ class DAQ_1DViewer_MiniSpectro(DAQ_Viewer_base):
             A given parameter (within detector_settings) whose value has been changed by the user
         """
         if param.name() == "integration_time":
-            self.controller.set_parameter(integ_time=int(self.settings['integration_time']*1e3))  # Convert from ms to µs
+            self._pending_parameters['integ_time'] = int(param.value()*1e3)  # Convert from ms to µs
         if param.name() == 'trig_mode':
-            if param.value() == 'Internal':
-                self.controller.set_parameter(trigger_mode=0x00)
-            elif param.value() == 'External (edge)':
-                self.controller.set_parameter(trigger_mode=0x01)
-            elif param.value() == 'External (gate)':
-                self.controller.set_parameter(trigger_mode=0x02)
+            self._pending_parameters['trigger_mode'] = TRIGGER_MODES[param.value()]
         if param.name() == 'trig_edge':
-            if param.value() == 'Rising edge':
-                self.controller.set_parameter(trigger_mode=0x00)
-            elif param.value() == 'Falling edge':
-                self.controller.set_parameter(trigger_mode=0x01)
+            self._pending_parameters['trigger_edge'] = TRIGGER_EDGES[param.value()]
+        if param.name() == 'gain' and param.value() in GAINS:
+            self._pending_parameters['gain'] = GAINS[param.value()]
+        if param.name() in ('acq_mode', 'ring_size'):
+            self._stop_reader()  # restarted with the new configuration on next grab
+        if param.name() == 'take_dark' and param.value():
+            param.setValue(False)
+            if self.controller is not None:
+                self.take_dark()
+        if param.name() == 'clear_darks' and param.value():
+            param.setValue(False)
+            self.darks.clear()
+            self.update_correction()
+        if param.name() in ('subtract_dark', 'dark_max_age'):
+            self.update_correction()
+        if param.name() in ('nonlinearity', 'nonlinearity_file'):
+            self.update_nonlinearity()
+        if param.name() in ('resample', 'grid_start', 'grid_stop', 'grid_step'):
+            self.update_resampling()
 
+    def _apply_parameters(self):
+        """
+        Write all pending parameter changes to the device at once. Spectra of the ring buffer acquired with the former
+        parameters are discarded.
+        """
+        if not self._pending_parameters:
+            return
+        with self._controller_lock:
+            for controller in self.controllers:
+                parameters = dict(self._pending_parameters)
+                if '0xff' in controller.trigger_edge:  # device without external trigger
+                    parameters.pop('trigger_edge', None)
+                    parameters.pop('trigger_mode', None)
+                if '0xff' in controller.gain:
+                    parameters.pop('gain', None)
+                if parameters:
+                    controller.set_parameter(**parameters)
+            self._pending_parameters = dict()
+            if self._ring is not None:
+                # the spectrum currently integrating may have started with the former parameters
+                self._first_valid_index = self._ring.count + 1
 
     def ini_detector(self, controller=None):
         """Detector communication initialization
@@ -86,14 +260,22 @@ class DAQ_1DViewer_MiniSpectro(DAQ_Viewer_base):
         self.ini_detector_init(slave_controller=controller)
 
         if self.is_master:
-            self.controller = MiniSpectro()
+            self.controllers = self._open_devices()
+            self.controller = self.controllers[0]
+        else:
+            self.controllers = [self.controller]
+        if len(self.controllers) > 1:
+            self.group = MiniSpectroGroup(self.controllers)
+        self.correctors = [SpectrumCorrector() for _ in self.controllers]
 
         self.settings.child('unit_id').setValue(self.controller.unit_id)
         self.settings.child('sensor_name').setValue(self.controller.sensor_name)
-        self.settings.child('serial_number').setValue(self.controller.serial_number)
+        self.settings.child('serial_number').setValue(', '.join(self.device_name(controller)
+                                                                for controller in self.controllers))
         self.settings.child('lower_wl').setValue(self.controller.lower_wl)
         self.settings.child('upper_wl').setValue(self.controller.upper_wl)
-        self.settings.child('pixel_nb').setValue(self.controller.sensor_size)
+        self.settings.child('pixel_nb').setValue(', '.join(str(controller.sensor_size)
+                                                           for controller in self.controllers))
 
         # Check if device handles external trigger
         if '0xff' in self.controller.trigger_edge:
@@ -104,23 +286,90 @@ class DAQ_1DViewer_MiniSpectro(DAQ_Viewer_base):
             self.settings.child('gain').setValue('None')
             self.settings.child('gain').setReadonly()
 
-        data_x_axis = self.controller.get_sensor_data()[1]*1e-9
-        self.x_axis = Axis(data=data_x_axis, label='Wavelength', units='m', index=0)
+        # Current settings are written to the device in one go at first grab
+        self._pending_parameters = dict(integ_time=int(self.settings['integration_time']*1e3),
+                                        trigger_mode=TRIGGER_MODES[self.settings['trig_mode']])
+        if '0xff' not in self.controller.trigger_edge:
+            self._pending_parameters['trigger_edge'] = TRIGGER_EDGES[self.settings['trig_edge']]
+        if self.settings['gain'] in GAINS:
+            self._pending_parameters['gain'] = GAINS[self.settings['gain']]
+
+        self.update_nonlinearity()
+        self.update_resampling()
+
+        self.x_axes = [Axis(data=controller.wl_array*1e-9, label='Wavelength', units='m', index=0)
+                       for controller in self.controllers]
+        self.x_axis = self.x_axes[0]
 
         # Initialize viewers panel with the future type of data
-        self.dte_signal_temp.emit(DataToExport(name='MiniSpectro',
-                                               data=[DataFromPlugins(name='Mini-spectrometer',
-                                                                     data=[np.array([0 for _ in range(self.controller.sensor_size)])],
-                                                                     dim='Data1D', labels=['Spectrometer'],
-                                                                     axes=[self.x_axis])]))
+        if self.group is None:
+            self.dte_signal_temp.emit(DataToExport(name='MiniSpectro',
+                                                   data=[DataFromPlugins(name='Mini-spectrometer',
+                                                                         data=[self._resample(np.zeros(
+                                                                             self.controller.sensor_size))],
+                                                                         dim='Data1D', labels=['Spectrometer'],
+                                                                         axes=[self.spectral_axis()])]))
+        else:
+            self._emit_group([(np.zeros(controller.sensor_size), None) for controller in self.controllers],
+                             np.zeros(len(self.controllers)), temporary=True)
 
         info = "Whatever info you want to log"
         initialized = True
         return info, initialized
 
+    def _open_devices(self):
+        """
+        Open the replayed devices, the simulated devices or the devices with the given serial numbers (the first one
+        found if none), recording their spectra if requested
+        """
+        if self.settings['replay', 'replay_stream']:
+            return self._open_replays()
+        if self.settings['simulation', 'simulated']:
+            controllers = [MiniSpectroSim(sensor_size=self.settings['simulation', 'sim_sensor_size'],
+                                          device_index=index)
+                           for index in range(self.settings['simulation', 'sim_devices'])]
+        else:
+            serials = [serial.strip() for serial in self.settings['device_serial'].split(',') if serial.strip()]
+            controllers = []
+            try:
+                for serial in serials or [None]:
+                    controllers.append(MiniSpectro(serial_number=serial))
+            except Exception:
+                for controller in controllers:
+                    controller.close()
+                raise
+        if self.settings['replay', 'record_stream']:
+            path = self.settings['replay', 'stream_file']
+            if not path:
+                directory = get_set_local_dir() / 'minispectro_streams'
+                directory.mkdir(parents=True, exist_ok=True)
+                path = directory / f'minispectro_{datetime.now():%Y%m%d_%H%M%S}{STREAM_SUFFIX}'
+                self.settings.child('replay', 'stream_file').setValue(str(path))
+            controllers = [RecordingMiniSpectro(controller, indexed_path(path, index))
+                           for index, controller in enumerate(controllers)]
+        return controllers
+
+    def _open_replays(self):
+        """Replay the stream file of each recorded device"""
+        path = self.settings['replay', 'stream_file']
+        count = 1
+        while indexed_path(path, count).exists():
+            count += 1
+        return [MiniSpectroReplay(indexed_path(path, index), speed=self.settings['replay', 'speed'],
+                                  loop=self.settings['replay', 'loop']) for index in range(count)]
+
+    @staticmethod
+    def device_name(controller):
+        """Serial number of a device, without padding"""
+        return controller.serial_number.strip('\x00 ')
+
     def close(self):
         """Terminate the communication protocol"""
-        if self.controller is not None:
+        self._stop_reader(wait=True)
+        if self.group is not None:
+            self.group.close()
+            self.group = None
+        elif self.controller is not None:
             self.controller.close()
 
     def grab_data(self, Naverage=1, **kwargs):
@@ -129,25 +378,370 @@ class DAQ_1DViewer_MiniSpectro(DAQ_Viewer_base):
         Parameters
         ----------
         Naverage: int
-            Number of hardware averaging (if hardware averaging is possible, self.hardware_averaging should be set to
-            True in class preamble and you should code this implementation)
+            Number of spectra to average within the plugin before emitting their mean
         kwargs: dict
             others optionals arguments
         """
+        Naverage = max(int(Naverage), 1)
+        self._apply_parameters()
+        self._prepare_correction()
+        if self.settings['acquisition', 'burst'] and self.settings['trig_mode'] != 'Internal':
+            self._grab_burst(Naverage)
+            return
+        if self.group is not None:
+            self._grab_group(Naverage)
+            return
+        if self.settings['acquisition', 'acq_mode'] == 'Continuous':
+            self._grab_continuous(Naverage)
+            return
+
         # Synchrone version (blocking function)
-        data_tot = self.controller.get_sensor_data()[2]
-        self.dte_signal.emit(DataToExport(name='MiniSpectro',
-                                          data=[DataFromPlugins(name='Mini-spectrometer',
-                                                                data=data_tot,
-                                                                dim='Data1D',
-                                                                labels=['Spectrometer'],
-                                                                axes=[self.x_axis])]))
+        with self._controller_lock:
+            if Naverage == 1:
+                self._emit_spectra(self._correct(self.controller.get_sensor_data()))
+                return
+
+            accumulator = self._reset_accumulator()
+            for _ in range(Naverage):
+                accumulator.add(self._correct(self.controller.get_sensor_data(out=self._raw_buffer), self._corrected))
+        self._emit_average()
+
+    def _map_devices(self, function):
+        """Call function(index, controller) for all the devices (concurrently if there are several)"""
+        if self.group is not None:
+            return self.group.map(function)
+        return [function(0, self.controller)]
+
+    def dark_key(self, controller=None):
+        """Device and settings a dark spectrum depends on: serial number, integration time and gain"""
+        controller = self.controller if controller is None else controller
+        return self.device_name(controller), controller.integration_time, controller.gain
+
+    def take_dark(self):
+        """Average spectra (in internal trigger mode) and cache them as the dark spectra of the current settings"""
+        self._stop_reader(wait=True)
+        self._apply_parameters()
+        with self._controller_lock:
+            darks = self._map_devices(self._read_dark)
+        for controller, dark in zip(self.controllers, darks):
+            self.darks.store(self.dark_key(controller), dark)
+        self._dark_warning = None
+        self.update_correction()
+        self.emit_status(ThreadCommand('Update_Status', ['Dark spectrum taken']))
+
+    def _read_dark(self, index, controller):
+        """Average dark spectra of a device, in internal trigger mode"""
+        dark = Accumulator((controller.sensor_size,))
+        raw = np.empty((controller.sensor_size,), dtype=np.uint16)
+        trigger_mode = int(controller.trigger_mode, 16)
+        if trigger_mode != TRIGGER_MODES['Internal']:
+            controller.set_parameter(trigger_mode=TRIGGER_MODES['Internal'])
+        readout = controller.dark_readout() if isinstance(controller, RecordingMiniSpectro) else nullcontext()
+        try:
+            with readout:
+                for _ in range(self.settings['correction', 'dark_averages']):
+                    dark.add(controller.get_sensor_data(out=raw))
+        finally:
+            if trigger_mode != TRIGGER_MODES['Internal']:
+                controller.set_parameter(trigger_mode=trigger_mode)
+        return dark.mean()
+
+    def _prepare_correction(self):
+        """Set the correction of the current settings, reporting (once per settings) missing dark spectra"""
+        self.update_correction()
+        missing = self.settings['correction', 'subtract_dark'] and not self.settings['correction', 'dark']
+        key = tuple(self.dark_key(controller) for controller in self.controllers) if missing else None
+        if key is not None and key != self._dark_warning:
+            self.emit_status(ThreadCommand('Update_Status', ['No recent dark spectrum for the current settings, spectra '
+                                                             'are not dark subtracted: use "Take dark" with the light '
+                                                             'source off', 'log']))
+        self._dark_warning = key
+
+    def update_correction(self):
+        """Set the dark spectrum of the current device settings (none if it was never taken or is too old)"""
+        if self.controller is None:
+            return
+        max_age = self.settings['correction', 'dark_max_age'] or None
+        darks = [self.darks.get(self.dark_key(controller), max_age) for controller in self.controllers]
+        for corrector, dark in zip(self.correctors, darks):
+            corrector.dark = dark if self.settings['correction', 'subtract_dark'] else None
+        self.settings.child('correction', 'dark').setValue(all(dark is not None for dark in darks))
+
+    def update_nonlinearity(self):
+        """Load the nonlinearity coefficients if the correction is enabled"""
+        coefficients = None
+        if self.settings['correction', 'nonlinearity'] and self.settings['correction', 'nonlinearity_file']:
+            try:
+                coefficients = load_nonlinearity(self.settings['correction', 'nonlinearity_file'])
+            except Exception as e:
+                self.emit_status(ThreadCommand('Update_Status', [f'Nonlinearity correction disabled: {e}', 'log']))
+        for controller, corrector in zip(self.controllers, self.correctors):
+            try:
+                corrector.set_nonlinearity(coefficients, controller.sensor_size)
+            except ValueError as e:
+                corrector.set_nonlinearity(None)
+                self.emit_status(ThreadCommand('Update_Status', [f'{self.device_name(controller)}: nonlinearity '
+                                                                 f'correction disabled: {e}', 'log']))
+
+    def _correct(self, spectra, out=None, index=0):
+        """Corrected spectra of a device (into out if given), or spectra themselves if there is no correction"""
+        if self.correctors[index].is_identity:
+            return spectra
+        return self.correctors[index](spectra, out)
+
+    def update_resampling(self):
+        """Set the resamplers of the devices onto the grid of the settings (none if resampling is disabled)"""
+        self.resamplers = []
+        self._grid_axes = dict()
+        if self.controller is None or not self.settings['resampling', 'resample']:
+            self._resampler_cache = dict()
+            return
+        start = self.settings['resampling', 'grid_start'] or min(controller.lower_wl for controller in self.controllers)
+        stop = self.settings['resampling', 'grid_stop'] or max(controller.upper_wl for controller in self.controllers)
+        step = self.settings['resampling', 'grid_step']
+        try:
+            grid = uniform_grid(start, stop, step)
+        except ValueError as e:
+            self.emit_status(ThreadCommand('Update_Status', [f'Resampling disabled: {e}', 'log']))
+            return
+        cache = dict()  # only the current resampler of each device is kept
+        for controller in self.controllers:
+            # per device, as the resamplers scratch buffers are used by the device threads concurrently
+            name = self.device_name(controller)
+            key = (tuple(controller.calibration_list), start, step, len(grid))
+            cached_key, resampler = self._resampler_cache.get(name, (None, None))
+            if cached_key != key:
+                resampler = WavelengthResampler(controller.wl_array, grid)
+            cache[name] = (key, resampler)
+            self.resamplers.append(resampler)
+        self._resampler_cache = cache
+
+    def _resample(self, spectra, index=0):
+        """Spectra of a device resampled onto the grid (new array), or spectra themselves if not resampling"""
+        if not self.resamplers:
+            return spectra
+        return self.resamplers[index](spectra)
+
+    def spectral_axis(self, index=0, axis_index=0):
+        """Wavelength axis of the emitted spectra of a device: its calibrated axis, or the grid if resampling"""
+        if not self.resamplers:
+            return self.x_axes[index] if axis_index == 0 else \
+                Axis(data=self.controllers[index].wl_array*1e-9, label='Wavelength', units='m', index=axis_index)
+        if axis_index not in self._grid_axes:
+            grid = self.resamplers[0].grid
+            self._grid_axes[axis_index] = Axis(label='Wavelength', units='m', offset=grid[0]*1e-9,
+                                               scaling=(grid[1] - grid[0])*1e-9 if len(grid) > 1 else 1e-9,
+                                               size=len(grid), index=axis_index)
+        return self._grid_axes[axis_index]
+
+    def _grab_group(self, Naverage):
+        """Acquire (and average) spectra of all the devices concurrently, and emit them together"""
+        with self._controller_lock:
+            if Naverage == 1:
+                spectra, timestamps = self.group.read()
+                results = [(self._correct(spectrum, index=index), None) for index, spectrum in enumerate(spectra)]
+            else:
+                accumulators = self._reset_group_accumulators()
+                for _ in range(Naverage):
+                    spectra, timestamps = self.group.read(out=self._group_raw)
+                    for index, spectrum in enumerate(spectra):
+                        accumulators[index].add(self._correct(spectrum, self._group_corrected[index], index))
+                results = [(accumulator.mean(), accumulator.std() if accumulator.compute_variance else None)
+                           for accumulator in accumulators]
+        self._emit_group(results, timestamps)
+
+    def _grab_burst(self, Naverage):
+        """Read (and average) bursts of triggered spectra from all the devices, and emit them"""
+        self._stop_reader(wait=True)  # the reader thread would take some of the triggers
+        self._reset_bursts()
+
+        def read_device(index, controller):
+            burst = self._bursts[index]
+            burst['accumulator'].reset()
+            for _ in range(Naverage):
+                read_burst(controller, burst['raw'], burst['timestamps'])
+                spectra = self._correct(burst['raw'], burst['corrected'], index)
+                if Naverage > 1:
+                    burst['accumulator'].add(spectra)
+            if Naverage > 1:
+                accumulator = burst['accumulator']
+                return self._resample(accumulator.mean(), index), \
+                    self._resample(accumulator.std(), index) if accumulator.compute_variance else None
+            if self.resamplers:
+                return self._resample(spectra, index), None
+            return spectra.copy(), None  # the buffers are reused by the next burst
+
+        with self._controller_lock:
+            results = self._map_devices(read_device)
+        data = []
+        for index, (controller, burst, (spectra, std)) in enumerate(zip(self.controllers, self._bursts, results)):
+            wavelength_axis = self.spectral_axis(index, axis_index=1)
+            name = 'Mini-spectrometer' if self.group is None else f'Mini-spectrometer {self.device_name(controller)}'
+            timestamps = burst['timestamps']
+            time_axis = Axis(data=timestamps - timestamps[0], label='Time', units='s', index=0)
+            burst_data = [DataFromPlugins(name=f'{name} burst', data=[spectra], dim='Data2D', labels=['Burst'],
+                                          axes=[time_axis, wavelength_axis])]
+            if std is not None:
+                burst_data.append(DataFromPlugins(name=f'{name} burst std', data=[std], dim='Data2D',
+                                                  labels=['Burst std deviation'], axes=[time_axis, wavelength_axis]))
+            for dwa in burst_data:
+                dwa.timestamp = timestamps[0]
+            data.extend(burst_data)
+        self.dte_signal.emit(DataToExport(name='MiniSpectro', data=data))
+
+    def _reset_bursts(self):
+        """Allocate the burst buffers of the devices if their size changed"""
+        size = self.settings['acquisition', 'burst_size']
+        emit_std = self.settings['emit_std']
+        if len(self._bursts) == len(self.controllers) and len(self._bursts[0]['raw']) == size \
+                and self._bursts[0]['accumulator'].matches((size, self.controller.sensor_size), emit_std):
+            return
+        self._bursts = [dict(raw=np.empty((size, controller.sensor_size), dtype=np.uint16),
+                             timestamps=np.zeros(size),
+                             corrected=np.empty((size, controller.sensor_size)),
+                             accumulator=Accumulator((size, controller.sensor_size), compute_variance=emit_std))
+                        for controller in self.controllers]
+
+    def _reset_group_accumulators(self):
+        """Get the averaging accumulators of the devices, reset and (re)allocated if needed"""
+        emit_std = self.settings['emit_std']
+        if len(self._group_accumulators) != len(self.controllers) \
+                or not self._group_accumulators[0].matches(self._group_accumulators[0].shape, emit_std):
+            self._group_accumulators = [Accumulator((controller.sensor_size,), compute_variance=emit_std)
+                                        for controller in self.controllers]
+            self._group_raw = [np.empty(controller.sensor_size, dtype=np.uint16) for controller in self.controllers]
+            self._group_corrected = [np.empty(controller.sensor_size) for controller in self.controllers]
+        for accumulator in self._group_accumulators:
+            accumulator.reset()
+        return self._group_accumulators
+
+    def _emit_group(self, results, timestamps, temporary=False):
+        """
+        Emit the spectra of all the devices in a single DataToExport
+
+        Parameters
+        ----------
+        results: list(tuple)
+            (spectrum, std or None) of each device
+        timestamps: numpy.array()
+            Time (s since epoch) of the readout of each device
+        temporary: bool
+            If True, emitted to initialize the viewers
+        """
+        data = []
+        for index, (controller, (spectrum, std), timestamp) in enumerate(zip(self.controllers, results, timestamps)):
+            name = self.device_name(controller)
+            axis = self.spectral_axis(index)
+            spectrum = self._resample(spectrum, index)
+            std = None if std is None else self._resample(std, index)
+            device_data = [DataFromPlugins(name=f'Mini-spectrometer {name}', data=[spectrum], dim='Data1D',
+                                           labels=[name], axes=[axis])]
+            if std is not None:
+                device_data.append(DataFromPlugins(name=f'Mini-spectrometer {name} std', data=[std], dim='Data1D',
+                                                   labels=[f'{name} std deviation'], axes=[axis]))
+            for dwa in device_data:
+                if not temporary:
+                    dwa.timestamp = timestamp
+                data.append(dwa)
+        signal = self.dte_signal_temp if temporary else self.dte_signal
+        signal.emit(DataToExport(name='MiniSpectro', data=data))
+
+    def _reset_accumulator(self):
+        """Get the averaging accumulator, reset and (re)allocated if needed"""
+        shape = (self.controller.sensor_size,)
+        emit_std = self.settings['emit_std']
+        if self._accumulator is None or not self._accumulator.matches(shape, emit_std):
+            self._accumulator = Accumulator(shape, compute_variance=emit_std)
+            self._raw_buffer = np.empty(shape, dtype=np.uint16)
+            self._corrected = np.empty(shape, dtype=np.float64)
+        self._accumulator.reset()
+        return self._accumulator
+
+    def _emit_average(self):
+        """Emit the mean of the accumulated spectra"""
+        std = self._accumulator.std() if self._accumulator.compute_variance else None
+        self._emit_spectra(self._accumulator.mean(), std)
+
+    def _start_reader(self):
+        """Start the background reader thread (and its ring buffer) if not already running"""
+        if self._reader is not None and self._reader.is_alive():
+            return
+        if self._reader is not None and self._reader.error is not None:
+            self.emit_status(ThreadCommand('Update_Status', [f'Reader thread stopped: {self._reader.error}', 'log']))
+        self._ring = SpectrumRingBuffer(self.settings['acquisition', 'ring_size'], self.controller.sensor_size)
+        self._first_valid_index = 0
+        self._last_published = -1
+        self._reader = SpectrumReader(self.controller, self._ring, callback=self._on_new_spectrum,
+                                      lock=self._controller_lock)
+        self._reader.start()
+
+    def _stop_reader(self, wait=False):
+        """Stop the reader thread, without waiting for the end of the current readout unless wait is True"""
+        with self._request_lock:
+            self._request = None
+        if self._reader is not None:
+            self._reader.stop(timeout=None if wait else 0.)
+            self._reader = None
+
+    def _grab_continuous(self, Naverage):
+        """Publish spectra from the ring buffer, filled by the reader thread"""
+        self._start_reader()
+        with self._request_lock:
+            if self.settings['acquisition', 'publish'] == 'Latest':
+                newest = self._ring.count - 1
+                first = max(self._first_valid_index, self._last_published + 1, self._ring.oldest_index())
+                if newest - first + 1 >= Naverage:
+                    spectra, _ = self._ring.get_last(Naverage)
+                    spectra = self._correct(spectra)
+                    self._last_published = newest
+                    if Naverage == 1:
+                        self._emit_spectra(spectra[0])
+                    else:
+                        self._reset_accumulator().add_batch(spectra)
+                        self._emit_average()
+                    return
+            self._reset_accumulator()
+            self._request = Naverage  # fulfilled by _on_new_spectrum, in the reader thread
+
+    def _on_new_spectrum(self, index):
+        """Called by the reader thread for each new spectrum of the ring buffer"""
+        with self._request_lock:
+            if self._request is None or index < self._first_valid_index:
+                return
+            spectrum, _ = self._ring.get(index)
+            if self._request == 1:
+                self._emit_spectra(self._correct(spectrum))
+            else:
+                self._accumulator.add(self._correct(spectrum, self._corrected))
+                if self._accumulator.count < self._request:
+                    return
+                self._emit_average()
+            self._request = None
+            self._last_published = index
+
+    def _emit_spectra(self, spectrum, std=None):
+        """Emit a (possibly averaged) spectrum, and its standard deviation if given"""
+        data = [DataFromPlugins(name='Mini-spectrometer',
+                                data=[self._resample(spectrum)],
+                                dim='Data1D',
+                                labels=['Spectrometer'],
+                                axes=[self.spectral_axis()])]
+        if std is not None:
+            data.append(DataFromPlugins(name='Mini-spectrometer std',
+                                        data=[self._resample(std)],
+                                        dim='Data1D',
+                                        labels=['Std deviation'],
+                                        axes=[self.spectral_axis()]))
+        self.dte_signal.emit(DataToExport(name='MiniSpectro', data=data))
 
     def stop(self):
         """
-        Stop the current grab by emitting a status. Works by stopping to call get_sensor_data() function)
+        Stop the current grab. In continuous mode, pending grabs are cancelled and the reader thread stops after its
+        current readout.
         """
-        self.emit_status(ThreadCommand('Update_Status', ['Some info you want to log']))
+        self._stop_reader()
+        self.emit_status(ThreadCommand('Update_Status', ['Acquisition stopped']))
+        return ''
 
 
 if __name__ == '__main__':
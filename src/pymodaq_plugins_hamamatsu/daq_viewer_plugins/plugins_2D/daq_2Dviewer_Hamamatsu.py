@@ -1,49 +1,268 @@
+import threading
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
 import numpy as np
 from pymodaq.utils.daq_utils import ThreadCommand
 from pymodaq.utils.data import DataFromPlugins, Axis, DataToExport
 from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
 from pymodaq.utils.parameter import Parameter
+from pymodaq.utils.config import get_set_local_dir
 
-import pylablib as pll
-pll.par["devices/dlls/dcamapi"] = "C:/Windows/System32"
+from pymodaq_plugins_hamamatsu.hardware.dcam_registry import camera_registry  # sets the dcamapi dll location
+from pymodaq_plugins_hamamatsu.hardware.dcam_acquisition import (FrameTracker, AcquisitionLoop, buffer_frame_count,
+                                                                  BYTES_PER_PIXEL)
+from pymodaq_plugins_hamamatsu.hardware.dcam_processing import (FrameReducer, FramePreview, FrameCorrector,
+                                                                 ProcessingChain, ReferenceStore, RoiStatistics,
+                                                                 REFERENCE_KINDS, parse_regions)
+from pymodaq_plugins_hamamatsu.hardware.averaging import Accumulator
+from pymodaq_plugins_hamamatsu.hardware.dcam_recorder import FrameRecorder, RECORD_FORMATS
+from pymodaq_plugins_hamamatsu.hardware.dcam_replay import RecordingDCAMCamera, DCAMCameraReplay
+from pymodaq_plugins_hamamatsu.hardware.dcam_sync import FrameMatcher
+from pymodaq_plugins_hamamatsu.hardware.dcam_telemetry import AcquisitionTelemetry, TELEMETRY_CHANNELS
+from pymodaq_plugins_hamamatsu.hardware.stream_file import STREAM_SUFFIX, indexed_path
 from pylablib.devices import DCAM
-from qtpy import QtWidgets, QtCore
+from qtpy import QtCore
 from time import perf_counter
 
-camera_number = DCAM.get_cameras_number()
-if camera_number == 0:
-    raise Exception('No DCAM camera was found.')
-
 
 class DAQ_2DViewer_Hamamatsu(DAQ_Viewer_base):
     """
+    Instrument plugin class for Hamamatsu cameras using the DCAM-API (through pylablib).
+
+    Connected cameras are enumerated on demand (at initialization or with "Refresh cameras"), not when PyMoDAQ
+    imports the plugin, and the list is cached.
+
+    Frames are read continuously by an acquisition thread (AcquisitionLoop), independently of the display: data are
+    emitted at most at the display rate. In "Live" mode only the newest frame is emitted (frames in between are not
+    displayed). In "Lossless" mode, all the frames acquired since the last emission are emitted as a stack (DataND,
+    navigation axis being the frame index), and lost frames are counted. Full rate processing (saving, averaging...)
+    should be done by consumers of the acquisition loop, which receive every frame.
+
+    An optional software reduction (crop, independent horizontal/vertical binning, frame decimation) is applied to the
+    frames in the acquisition thread, before they are averaged, recorded or displayed.
+
+    Frames can then be corrected with dark and flat references: (frame - dark) * gain_map, computed in float32 buffers
+    allocated once. References are averages of frames taken with "Take dark"/"Take flat", stored per camera, ROI,
+    binning, software reduction and exposure (saved as .npy files, and reloaded when these settings are used again):
+    changing the exposure or the ROI switches to the references of the new settings, if any.
+
+    ROI channels (sum or mean of rectangular regions, their row and column projections and intensity centroid) can
+    be computed in the acquisition thread from the frames to emit (or from the averages) and emitted along with them,
+    as Data0D and Data1D (as Data1D and Data2D along the frame index for Lossless stacks). Emission of the images can
+    then be disabled, for scans only needing these values.
+
+    In preview mode, the displayed frames are downsampled (stride or block mean) in the acquisition thread, so that
+    only small copies of the frames are handed over to the display, at most at the display rate. Averages, recordings
+    and ROI channels are computed from the full frames.
+
+    Additional cameras can be acquired in sync with the main one ("Multi-camera" settings, applied at initialization),
+    each one being read by its own acquisition thread. All their frames are matched, in the acquisition threads, by
+    driver frame index (cameras triggered together) or by timestamp, and matched sets are emitted (at most at the
+    display rate) as a single DataToExport, one image per camera. The settings (ROI, binning, processing, preview,
+    averaging, recording) apply to the main camera only, the exposure time to all of them; averages are those of the
+    main camera.
+
+    Averaging is done by the plugin: frames are summed in place into a preallocated accumulator as they are read, and
+    only the average (and optionally the per-pixel variance) is emitted every Naverage frames.
+
+    While "Record" is on, every frame read during the acquisition is streamed to disk (HDF5 or raw file) by a writer
+    thread, with its frame index and timestamp, whatever is displayed.
+
+    The size of the camera ring buffer is given either as a number of frames or as a memory budget, in which case the
+    number of frames is recomputed from the frame size at each ROI/binning change. Its occupancy is reported in the
+    telemetry (buffer fill).
+
+    Telemetry (camera frame rate from the driver counters, display rate, frame latency, buffer fill and lost frames) is
+    shown in the settings, can be emitted as Data0D channels along with the images, and is available as a dictionary
+    from self.telemetry.snapshot().
+
+    The frames read from the cameras, with their index and timing, and the camera configuration changes can be
+    recorded to a compact stream file (one per camera), and replayed later instead of opening the cameras ("Stream
+    replay" settings, applied at initialization), at the recorded rate or faster: field acquisitions can then be
+    reproduced, load tested and benchmarked without the hardware. All the frames acquired are recorded in "Lossless"
+    mode (or while recording or averaging), only the displayed ones in "Live" mode.
     """
     params = comon_parameters + [
-        {'title': 'Camera index:', 'name': 'camera_index', 'type': 'int', 'value': 0, 'min': 0, 'max': camera_number},
+        {'title': 'Camera index:', 'name': 'camera_index', 'type': 'int', 'value': 0, 'min': 0},
+        {'title': 'Refresh cameras', 'name': 'refresh_cameras', 'type': 'bool_push', 'value': False},
         {'title': 'Camera model:', 'name': 'camera_name', 'type': 'str', 'value': '', 'readonly': True},
+        {'title': 'Camera serial:', 'name': 'camera_serial', 'type': 'str', 'value': '', 'readonly': True},
         {'title': 'Update ROI', 'name': 'update_roi', 'type': 'bool_push', 'value': False},
         {'title': 'Clear ROI+Bin', 'name': 'clear_roi', 'type': 'bool_push', 'value': False},
         {'title': 'Binning', 'name': 'binning', 'type': 'list', 'values': [1,2]},
         {'title': 'Image width', 'name': 'hdet', 'type': 'int', 'value': 1, 'readonly': True},
         {'title': 'Image height', 'name': 'vdet', 'type': 'int', 'value': 1, 'readonly': True},
+        {'title': 'Software reduction', 'name': 'reduction', 'type': 'group', 'children':
+            [{'title': 'Reduce frames', 'name': 'reduce', 'type': 'bool', 'value': False,
+              'tip': 'Crop, bin and decimate the frames in software, after the camera ROI and binning'},
+             {'title': 'Crop x start', 'name': 'crop_x', 'type': 'int', 'value': 0, 'min': 0},
+             {'title': 'Crop width (0: all)', 'name': 'crop_width', 'type': 'int', 'value': 0, 'min': 0},
+             {'title': 'Crop y start', 'name': 'crop_y', 'type': 'int', 'value': 0, 'min': 0},
+             {'title': 'Crop height (0: all)', 'name': 'crop_height', 'type': 'int', 'value': 0, 'min': 0},
+             {'title': 'Horizontal binning', 'name': 'hbin', 'type': 'int', 'value': 1, 'min': 1},
+             {'title': 'Vertical binning', 'name': 'vbin', 'type': 'int', 'value': 1, 'min': 1},
+             {'title': 'Binning mode', 'name': 'bin_mode', 'type': 'list', 'limits': ['sum', 'mean'], 'value': 'sum'},
+             {'title': 'Keep 1 frame every', 'name': 'decimation', 'type': 'int', 'value': 1, 'min': 1},
+             {'title': 'Threads', 'name': 'workers', 'type': 'int', 'value': 1, 'min': 1, 'max': 16,
+              'tip': 'Number of threads binning large frames'}]
+         },
+        {'title': 'Correction', 'name': 'correction', 'type': 'group', 'children':
+            [{'title': 'Correct frames', 'name': 'correct', 'type': 'bool', 'value': False,
+              'tip': 'Subtract the dark frame and apply the flat-field gain map: (frame - dark) * gain_map'},
+             {'title': 'Reference frames', 'name': 'reference_frames', 'type': 'int', 'value': 50, 'min': 1,
+              'tip': 'Number of frames averaged to take a reference'},
+             {'title': 'Take dark', 'name': 'take_dark', 'type': 'bool_push', 'value': False},
+             {'title': 'Take flat', 'name': 'take_flat', 'type': 'bool_push', 'value': False},
+             {'title': 'Clear references', 'name': 'clear_references', 'type': 'bool_push', 'value': False,
+              'tip': 'Delete the references of the current ROI, binning and exposure'},
+             {'title': 'Directory', 'name': 'directory', 'type': 'browsepath', 'value': '', 'filetype': False,
+              'tip': 'Where references are saved (default: dcam_references in the PyMoDAQ local folder)'},
+             {'title': 'Dark available', 'name': 'dark', 'type': 'led', 'value': False, 'readonly': True},
+             {'title': 'Flat available', 'name': 'flat', 'type': 'led', 'value': False, 'readonly': True}]
+         },
+        {'title': 'ROI channels', 'name': 'roi_channels', 'type': 'group', 'children':
+            [{'title': 'Compute ROI channels', 'name': 'enable', 'type': 'bool', 'value': False,
+              'tip': 'Reduce the emitted frames to a few values per region, emitted along with them'},
+             {'title': 'Regions', 'name': 'regions', 'type': 'str', 'value': '',
+              'tip': 'x, y, width, height of each region in pixels of the frames (after the software reduction, '
+                     'not of the preview), regions being separated by ";". Whole frames if empty'},
+             {'title': 'Statistic', 'name': 'statistic', 'type': 'list', 'limits': ['sum', 'mean'], 'value': 'sum'},
+             {'title': 'Projections', 'name': 'projections', 'type': 'bool', 'value': False,
+              'tip': 'Also emit the row and column projections of the regions'},
+             {'title': 'Centroid', 'name': 'centroid', 'type': 'bool', 'value': False,
+              'tip': 'Also emit the intensity centroid of the regions (sensor pixels)'},
+             {'title': 'Emit images', 'name': 'emit_frames', 'type': 'bool', 'value': True,
+              'tip': 'If off, only the ROI channels (and telemetry) are emitted'}]
+         },
+        {'title': 'Acquisition', 'name': 'acquisition', 'type': 'group', 'children':
+            [{'title': 'Mode', 'name': 'acq_mode', 'type': 'list', 'limits': ['Live', 'Lossless'], 'value': 'Live',
+              'tip': 'Live: newest frame only, Lossless: all frames since last read, emitted as a stack'},
+             {'title': 'Display rate (Hz)', 'name': 'display_rate', 'type': 'float', 'value': 20., 'min': 0.1,
+              'tip': 'Maximum rate at which frames are emitted, independently of the camera frame rate'},
+             {'title': 'Preview', 'name': 'preview', 'type': 'list', 'limits': ['Off', 'Stride', 'Block mean'],
+              'value': 'Off', 'tip': 'Display downsampled frames, averages, recordings and ROI channels using the '
+                                     'full frames'},
+             {'title': 'Preview factor', 'name': 'preview_factor', 'type': 'int', 'value': 4, 'min': 2},
+             {'title': 'Buffer size', 'name': 'buffer_mode', 'type': 'list', 'limits': ['Frames', 'Memory (MB)'],
+              'value': 'Frames', 'tip': 'Camera ring buffer size, as a number of frames or as a memory budget'},
+             {'title': 'Buffer frames', 'name': 'buffer_frames', 'type': 'int', 'value': 100, 'min': 2},
+             {'title': 'Buffer memory (MB)', 'name': 'buffer_mb', 'type': 'float', 'value': 500., 'min': 1.,
+              'visible': False},
+             {'title': 'Allocated frames', 'name': 'buffer_allocated', 'type': 'int', 'value': 0, 'readonly': True},
+             {'title': 'Allocated memory (MB)', 'name': 'buffer_allocated_mb', 'type': 'float', 'value': 0.,
+              'readonly': True},
+             {'title': 'Accumulator type', 'name': 'accumulator_dtype', 'type': 'list',
+              'limits': ['float32', 'float64'], 'value': 'float32',
+              'tip': 'Type of the averaging buffers, float32 halves their size'},
+             {'title': 'Emit variance', 'name': 'emit_variance', 'type': 'bool', 'value': False,
+              'tip': 'Also emit the per-pixel variance map when averaging'},
+             {'title': 'Frames read', 'name': 'frames_read', 'type': 'int', 'value': 0, 'readonly': True},
+             {'title': 'Dropped frames', 'name': 'dropped_frames', 'type': 'int', 'value': 0, 'readonly': True},
+             {'title': 'Buffer overruns', 'name': 'overruns', 'type': 'int', 'value': 0, 'readonly': True}]
+         },
+        {'title': 'Recording', 'name': 'recording', 'type': 'group', 'children':
+            [{'title': 'Record', 'name': 'record', 'type': 'bool', 'value': False,
+              'tip': 'Stream every acquired frame to a new file'},
+             {'title': 'Directory', 'name': 'directory', 'type': 'browsepath', 'value': '', 'filetype': False},
+             {'title': 'File prefix', 'name': 'prefix', 'type': 'str', 'value': 'dcam'},
+             {'title': 'Format', 'name': 'file_format', 'type': 'list', 'limits': list(RECORD_FORMATS),
+              'value': 'HDF5'},
+             {'title': 'Queue size (frames)', 'name': 'queue_size', 'type': 'int', 'value': 1000, 'min': 1,
+              'tip': 'Frames waiting to be written, frames are dropped if the queue is full'},
+             {'title': 'File', 'name': 'file', 'type': 'str', 'value': '', 'readonly': True},
+             {'title': 'Frames written', 'name': 'frames_written', 'type': 'int', 'value': 0, 'readonly': True},
+             {'title': 'Throughput (MB/s)', 'name': 'throughput', 'type': 'float', 'value': 0., 'readonly': True},
+             {'title': 'Queue depth', 'name': 'queue_depth', 'type': 'int', 'value': 0, 'readonly': True},
+             {'title': 'Dropped frames', 'name': 'dropped_frames', 'type': 'int', 'value': 0, 'readonly': True}]
+         },
+        {'title': 'Multi-camera', 'name': 'multi_camera', 'type': 'group', 'children':
+            [{'title': 'Additional cameras', 'name': 'cameras', 'type': 'str', 'value': '',
+              'tip': 'Indices (comma separated) of the cameras acquired in sync with the main one (applied at '
+                     'initialization)'},
+             {'title': 'Match frames by', 'name': 'match_by', 'type': 'list', 'limits': ['Frame index', 'Timestamp'],
+              'value': 'Frame index', 'tip': 'Frame index: cameras started together and triggered by the same signal'},
+             {'title': 'Tolerance (ms)', 'name': 'tolerance', 'type': 'float', 'value': 1., 'min': 0.,
+              'tip': 'Maximum difference between the timestamps of matched frames'},
+             {'title': 'Matched sets', 'name': 'matched_sets', 'type': 'int', 'value': 0, 'readonly': True}]
+         },
         {'title': 'Timing', 'name': 'timing_opts', 'type': 'group', 'children':
-            [{'title': 'Exposure Time (ms)', 'name': 'exposure_time', 'type': 'int', 'value': 1},
-             {'title': 'Compute FPS', 'name': 'fps_on', 'type': 'bool', 'value': True},
-             {'title': 'FPS', 'name': 'fps', 'type': 'float', 'value': 0.0, 'readonly': True}]
+            [{'title': 'Exposure Time (ms)', 'name': 'exposure_time', 'type': 'int', 'value': 1}]
+         },
+        {'title': 'Telemetry', 'name': 'telemetry', 'type': 'group', 'children':
+            [{'title': 'Emit telemetry', 'name': 'emit_telemetry', 'type': 'bool', 'value': False,
+              'tip': 'Emit the telemetry values as Data0D channels along with the images'},
+             {'title': 'Camera FPS', 'name': 'camera_fps', 'type': 'float', 'value': 0., 'readonly': True},
+             {'title': 'Display FPS', 'name': 'display_fps', 'type': 'float', 'value': 0., 'readonly': True},
+             {'title': 'Latency median (ms)', 'name': 'latency_median', 'type': 'float', 'value': 0.,
+              'readonly': True},
+             {'title': 'Latency 95% (ms)', 'name': 'latency_p95', 'type': 'float', 'value': 0., 'readonly': True},
+             {'title': 'Latency max (ms)', 'name': 'latency_max', 'type': 'float', 'value': 0., 'readonly': True},
+             {'title': 'Buffer fill (%)', 'name': 'buffer_fill', 'type': 'float', 'value': 0., 'readonly': True},
+             {'title': 'Driver skipped frames', 'name': 'skipped_frames', 'type': 'int', 'value': 0,
+              'readonly': True}]
+         },
+        {'title': 'Stream replay', 'name': 'replay', 'type': 'group', 'children':
+            [{'title': 'Record stream', 'name': 'record_stream', 'type': 'bool', 'value': False,
+              'tip': 'Record the frames read and the configuration changes of the cameras to stream files (applied '
+                     'at initialization)'},
+             {'title': 'Replay stream', 'name': 'replay_stream', 'type': 'bool', 'value': False,
+              'tip': 'Replay stream files instead of opening the cameras (applied at initialization)'},
+             {'title': 'Stream file', 'name': 'stream_file', 'type': 'browsepath', 'value': '', 'filetype': True,
+              'tip': 'File of the main camera, name_1, name_2... for the additional ones. A new file in the local '
+                     'directory if empty when recording'},
+             {'title': 'Replay speed', 'name': 'speed', 'type': 'float', 'value': 1., 'min': 0.,
+              'tip': 'Ratio to the recorded frame rate, 0 to replay as fast as frames are read'},
+             {'title': 'Loop', 'name': 'loop', 'type': 'bool', 'value': True}]
          }
     ]
-    callback_signal = QtCore.Signal()
+    live_mode_available = True
+    hardware_averaging = True
+    frames_signal = QtCore.Signal(object, object, float, object)
+    average_signal = QtCore.Signal(object, object, float, object)
+    matched_signal = QtCore.Signal(object, object, float, object)
+    loop_error_signal = QtCore.Signal(str)
+    reference_signal = QtCore.Signal(str, object)
 
     def ini_attributes(self):
         self.controller: DCAM = None
 
         self.x_axis = None
         self.y_axis = None
-        self.last_tick = 0.0  # time counter used to compute FPS
-        self.fps = 0.0
+        self._geometry = None  # (hstart, vstart, hscale, vscale, height, width) of the emitted frames (sensor pixels)
+        self._axes_cache = dict()  # frame axes per geometry
+        self.reducer = FrameReducer()
+        self.corrector = FrameCorrector()
+        self.processing_stages = []  # stages of the acquisition loop processor
+        self.references = ReferenceStore()
+        self._reference_kind = None  # reference being taken
+        self._reference_accumulator: Accumulator = None
+        self._pause_after_reference = False
+        self._record_consumer = None
+        self._view_shape = None  # frame shape the viewers were initialized with
+        self._display_geometry = None  # geometry of the displayed frames (of the preview if enabled)
+        self._display_shape = None  # shape of the displayed frames
+        self.preview: FramePreview = None  # None if full frames are displayed
+        self.camera_loops = []  # acquisition loops of the additional cameras
+        self._camera_shapes = []  # frame shapes of the additional cameras
+        self._camera_axes = []  # frame axes of the additional cameras
+        self.matcher: FrameMatcher = None  # None if there is no additional camera
+        self._match_lock = threading.Lock()  # serializes the matching done by the acquisition threads
+        self._single_grab = False
+        self._last_matched_emission = 0.
+        self.roi_statistics: RoiStatistics = None  # ROI channels computation, None if disabled
+        self.telemetry = AcquisitionTelemetry()
 
         self.data_shape = 'Data2D'
-        self.callback_thread = None
+        self.acquisition_loop: AcquisitionLoop = None
+        self.controller_lock = threading.Lock()  # shared with the acquisition thread
+        self.frame_tracker = FrameTracker()
+        self._accumulator: Accumulator = None
+        self._naverage = 1
+        self._live_average = False
+        self._averaging = False
+        self.recorder: FrameRecorder = None
 
         # Disable "use ROI" option to avoid confusion with other buttons
         self.settings.child('ROIselect', 'use_ROI').setOpts(visible=False)
@@ -56,23 +275,87 @@ class DAQ_2DViewer_Hamamatsu(DAQ_Viewer_base):
         param: Parameter
             A given parameter (within detector_settings) whose value has been changed by the user
         """
+        if param.name() == "refresh_cameras":
+            if param.value():
+                self.update_camera_list(refresh=True)
+                param.setValue(False)
+
+        if param.name() == "camera_index" and self.controller is None:
+            self.update_camera_list()
+
+        if param.name() == "acq_mode" and self.controller is not None:
+            with self.controller_lock:
+                # frames skipped in live mode should not be counted as dropped
+                self.frame_tracker.reset()
+                new_range = self.controller.get_new_images_range()
+                if new_range is not None:
+                    self.frame_tracker.next_index = new_range[0]
+                self.acquisition_loop.lossless = param.value() == 'Lossless'
+
+        if param.name() == "buffer_mode":
+            self.settings.child('acquisition', 'buffer_frames').setOpts(visible=param.value() == 'Frames')
+            self.settings.child('acquisition', 'buffer_mb').setOpts(visible=param.value() != 'Frames')
+
+        if param.name() in ("buffer_mode", "buffer_frames", "buffer_mb") and self.controller is not None:
+            self.reconfigure()
+
+        if param.name() == "display_rate" and self.acquisition_loop is not None:
+            self.acquisition_loop.display_period = 1 / param.value()
+
+        if param.name() in ("preview", "preview_factor"):
+            self.update_preview()
+
+        if param.name() == "record" and self.controller is not None:
+            if param.value():
+                self.start_recording()
+            else:
+                self.stop_recording()
+
         if param.name() == "exposure_time":
-            self.controller.set_exposure(param.value() / 1000)
+            with self.controller_lock:
+                self.controller.set_exposure(param.value() / 1000)
+            for loop in self.camera_loops:
+                with loop.lock:
+                    loop.camera.set_exposure(param.value() / 1000)
+            self.update_correction()
+
+        if param.name() in ("match_by", "tolerance"):
+            self.update_matcher()
+
+        if param.name() in ("correct", "directory") and param.parent().name() == 'correction':
+            self.update_correction()
+
+        if param.name() in ("take_dark", "take_flat") and param.value():
+            param.setValue(False)
+            if self.controller is not None:
+                self.take_reference(param.name()[len('take_'):])
+
+        if param.name() == "clear_references" and param.value():
+            param.setValue(False)
+            if self._geometry is not None:
+                for kind in REFERENCE_KINDS:
+                    self.references.remove(self.reference_key(), kind)
+                self.update_correction()
+
+        if param.parent() is not None and param.parent().name() == 'reduction':
+            self.update_reduction()
 
-        if param.name() == "fps_on":
-            self.settings.child('timing_opts', 'fps').setOpts(visible=param.value())
+        if param.parent() is not None and param.parent().name() == 'roi_channels':
+            self.update_roi_channels()
 
         if param.name() == "update_roi":
             if param.value():  # Switching on ROI
 
                 # We handle ROI and binning separately for clarity
-                (old_x, _, old_y, _, xbin, ybin) = self.controller.get_roi()  # Get current binning
+                (*_, xbin, ybin) = self.controller.get_roi()  # Get current binning
 
-                # Values need to be rescaled by binning factor and shifted by current x0,y0 to be correct.
-                new_x = (old_x + self.settings.child('ROIselect', 'x0').value()) * xbin
-                new_y = (old_y + self.settings.child('ROIselect', 'y0').value()) * xbin
-                new_width = self.settings.child('ROIselect', 'width').value() * ybin
-                new_height = self.settings.child('ROIselect', 'height').value() * ybin
+                # The selection is given in pixels of the displayed frames: values need to be rescaled by the
+                # (camera, software and preview) binning factors and shifted by the frame start to be in sensor pixels.
+                hstart, vstart, hscale, vscale, *_ = self._display_geometry
+                new_x = hstart + self.settings.child('ROIselect', 'x0').value() * hscale
+                new_y = vstart + self.settings.child('ROIselect', 'y0').value() * vscale
+                new_width = self.settings.child('ROIselect', 'width').value() * hscale
+                new_height = self.settings.child('ROIselect', 'height').value() * vscale
 
                 new_roi = (new_x, new_width, xbin, new_y, new_height, ybin)
                 self.update_rois(new_roi)
@@ -83,10 +366,10 @@ class DAQ_2DViewer_Hamamatsu(DAQ_Viewer_base):
 
         if param.name() == 'binning':
             # We handle ROI and binning separately for clarity
-            (x0, w, y0, h, *_) = self.controller.get_roi()  # Get current ROI
+            (x0, x1, y0, y1, *_) = self.controller.get_roi()  # Get current ROI, as (hstart, hend, vstart, vend)
             xbin = self.settings.child('binning').value()
             ybin = self.settings.child('binning').value()
-            new_roi = (x0, w, xbin, y0, h, ybin)
+            new_roi = (x0, x1 - x0, xbin, y0, y1 - y0, ybin)
             self.update_rois(new_roi)
 
         if param.name() == "clear_roi":
@@ -118,150 +401,807 @@ class DAQ_2DViewer_Hamamatsu(DAQ_Viewer_base):
         initialized: bool
             False if initialization failed otherwise True
         """
+        # Check the camera index against the (cached) list of connected cameras
+        if self.is_master and not self.settings['replay', 'replay_stream']:
+            self.update_camera_list()
+            camera_registry.get(self.settings['camera_index'])
+
         # Initialize camera class
         self.ini_detector_init(old_controller=controller,
-                               new_controller=DCAM.DCAMCamera(
-                                   idx=self.settings.child('camera_index').value()))
+                               new_controller=self.open_camera(self.settings['camera_index']))
 
         # Get camera name
-        self.settings.child('camera_name').setValue(self.controller.get_device_info()[1])
+        device_info = self.controller.get_device_info()
+        self.settings.child('camera_name').setValue(device_info.model)
+        self.settings.child('camera_serial').setValue(device_info.serial_number)
 
         # Set exposure time
         self.controller.set_exposure(self.settings.child('timing_opts', 'exposure_time').value() / 1000)
 
-        # FPS visibility
-        self.settings.child('timing_opts', 'fps').setOpts(visible=self.settings.child('timing_opts', 'fps_on').value())
-
         # Update image parameters
         (*_, hbin, vbin) = self.controller.get_roi()
         height, width = self.controller._get_data_dimensions_rc()
         self.settings.child('binning').setValue(hbin)
         self.settings.child('hdet').setValue(width)
         self.settings.child('vdet').setValue(height)
+        self.reconfigure()
 
-        # Way to define a wait function with arguments
-        wait_func = lambda: self.controller.wait_for_frame(since='lastread', nframes=1, timeout=20.0)
-        callback = DCAMCallback(wait_func)
-
-        self.callback_thread = QtCore.QThread()  # creation of a Qt5 thread
-        callback.moveToThread(self.callback_thread)  # callback object will live within this thread
-        callback.data_sig.connect(
-            self.emit_data)  # when the wait for acquisition returns (with data taken), emit_data will be fired
+        # Acquisition thread, frames are passed to emit_data (in this thread) through a queued signal
+        self.frames_signal.connect(self.emit_data)
+        self.average_signal.connect(self.emit_average)
+        self.loop_error_signal.connect(self.on_loop_error)
+        self.reference_signal.connect(self.store_reference)
+        self.acquisition_loop = AcquisitionLoop(self.controller, self.display_frames, tracker=self.frame_tracker,
+                                                lock=self.controller_lock,
+                                                error_callback=lambda e: self.loop_error_signal.emit(str(e)))
+        self.acquisition_loop.lossless = self.settings['acquisition', 'acq_mode'] == 'Lossless'
+        self.acquisition_loop.display_period = 1 / self.settings['acquisition', 'display_rate']
+        self.acquisition_loop.telemetry = self.telemetry
+        self.acquisition_loop.start()
 
-        self.callback_signal.connect(callback.wait_for_acquisition)
-        self.callback_thread.callback = callback
-        self.callback_thread.start()
-
-        self._prepare_view()
+        self.matched_signal.connect(self.emit_matched)
+        self._open_cameras()
+        self.update_roi_channels()
+        self.update_preview()
+        self.update_reduction()  # also prepares the view
 
         info = "Initialized camera"
         initialized = True
         return info, initialized
 
+    @property
+    def emitting_frames(self):
+        """False if only the ROI channels are emitted"""
+        return self.settings['roi_channels', 'emit_frames'] or not self.settings['roi_channels', 'enable']
+
+    def update_preview(self):
+        """Apply the preview settings"""
+        mode = self.settings['acquisition', 'preview']
+        self.preview = None if mode == 'Off' else \
+            FramePreview(self.settings['acquisition', 'preview_factor'], 'stride' if mode == 'Stride' else 'mean')
+        if self._geometry is not None:
+            self._prepare_view()
+
+    def update_roi_channels(self):
+        """Apply the ROI channels settings"""
+        roi_statistics = None
+        if self.settings['roi_channels', 'enable']:
+            try:
+                regions = parse_regions(self.settings['roi_channels', 'regions'])
+            except ValueError as e:
+                self.emit_status(ThreadCommand('Update_Status', [f'ROI channels: {e}', 'log']))
+                regions = []
+            roi_statistics = RoiStatistics(regions or None, self.settings['roi_channels', 'statistic'],
+                                           projections=self.settings['roi_channels', 'projections'],
+                                           centroid=self.settings['roi_channels', 'centroid'])
+        self.roi_statistics = roi_statistics  # used as is by the acquisition thread
+        if self._view_shape is not None:
+            self._init_viewers()
+
+    def roi_data(self, channels, frame_axis=None):
+        """
+        ROI channels as data to emit
+
+        Parameters
+        ----------
+        channels: list(dict) or None
+            RoiStatistics results
+        frame_axis: Axis or None
+            Frame index axis if the channels of all the frames of a stack are emitted, otherwise only those of the
+            last frame are
+        """
+        if not channels:
+            return []
+        hstart, vstart, hscale, vscale, *_ = self._geometry
+        stacked = frame_axis is not None
+        if stacked:
+            def values(array):
+                return array
+            options = dict(dim='Data1D', axes=[frame_axis])
+        else:
+            def values(array):
+                return array[-1:]
+            options = dict(dim='Data0D')
+
+        statistic = self.settings['roi_channels', 'statistic']
+        data = [DataFromPlugins(name='DCAM ROI', data=[values(channel['value']) for channel in channels],
+                                labels=[f'ROI{index} {statistic}' for index in range(len(channels))], **options)]
+        if 'centroid' in channels[0]:
+            centroids, labels = [], []
+            for index, channel in enumerate(channels):
+                centroids.extend([values(hstart + channel['centroid'][:, 1] * hscale),
+                                  values(vstart + channel['centroid'][:, 0] * vscale)])
+                labels.extend([f'ROI{index} x', f'ROI{index} y'])
+            data.append(DataFromPlugins(name='DCAM ROI centroid', data=centroids, labels=labels, **options))
+        if 'rows' in channels[0]:
+            for index, channel in enumerate(channels):
+                region_vstart, _, region_hstart, _ = channel['bounds']
+                for label, profile, start, scale in (('Y', channel['rows'], vstart + region_vstart * vscale, vscale),
+                                                     ('X', channel['columns'], hstart + region_hstart * hscale, hscale)):
+                    axis = Axis(label=label, units='pixels', offset=start, scaling=scale, size=profile.shape[1],
+                                index=1 if stacked else 0)
+                    name = f'DCAM ROI{index} {label} profile'
+                    if stacked:
+                        data.append(DataFromPlugins(name=name, data=[profile], dim='Data2D', axes=[frame_axis, axis],
+                                                    labels=[name]))
+                    else:
+                        data.append(DataFromPlugins(name=name, data=[profile[-1]], dim='Data1D', axes=[axis],
+                                                    labels=[name]))
+        return data
+
+    def _open_cameras(self):
+        """Open the additional cameras, each one being read by its own acquisition loop"""
+        try:
+            indexes = [int(index) for index in self.settings['multi_camera', 'cameras'].replace(',', ' ').split()]
+        except ValueError:
+            self.emit_status(ThreadCommand('Update_Status', ['Invalid additional camera indices', 'log']))
+            indexes = []
+        for index in indexes:
+            camera = self.open_camera(index, len(self.camera_loops) + 1)
+            camera.set_exposure(self.settings['timing_opts', 'exposure_time'] / 1000)
+            camera.setup_acquisition(nframes=self.buffer_frames(camera))
+            hstart, _, vstart, _, hbin, vbin = camera.get_roi()
+            height, width = camera._get_data_dimensions_rc()
+            self._camera_shapes.append((height, width))
+            self._camera_axes.append(self.geometry_axes((hstart, vstart, hbin, vbin, height, width)))
+            # frames are only displayed as matched sets
+            loop = AcquisitionLoop(camera, lambda frames, infos, ready_time: None,
+                                   error_callback=lambda e, index=index: self.loop_error_signal.emit(
+                                       f'camera {index}: {e}'))
+            loop.consumers.append(partial(self.match_frames, len(self.camera_loops) + 1))
+            loop.start()
+            self.camera_loops.append(loop)
+        if self.camera_loops:
+            with self.controller_lock:
+                self.acquisition_loop.consumers.append(partial(self.match_frames, 0))
+        self.update_matcher()
+
+    def open_camera(self, index, position=0):
+        """
+        Open a camera, or replay its recording, recording its frames if requested
+
+        Parameters
+        ----------
+        index: int
+            Camera index
+        position: int
+            0 for the main camera, 1, 2... for the additional ones (index of their stream file)
+        """
+        path = self.settings['replay', 'stream_file']
+        if self.settings['replay', 'replay_stream']:
+            return DCAMCameraReplay(indexed_path(path, position), speed=self.settings['replay', 'speed'],
+                                    loop=self.settings['replay', 'loop'])
+        camera = DCAM.DCAMCamera(idx=index)
+        if self.settings['replay', 'record_stream']:
+            if not path:
+                directory = get_set_local_dir() / 'dcam_streams'
+                directory.mkdir(parents=True, exist_ok=True)
+                path = directory / f'dcam_{datetime.now():%Y%m%d_%H%M%S}{STREAM_SUFFIX}'
+                self.settings.child('replay', 'stream_file').setValue(str(path))
+            camera = RecordingDCAMCamera(camera, indexed_path(path, position))
+        return camera
+
+    def update_matcher(self):
+        """Set the frame matcher of the additional cameras, if any"""
+        if not self.camera_loops:
+            return
+        with self._match_lock:
+            self.matcher = FrameMatcher(len(self.camera_loops) + 1,
+                                        'frame_index' if self.settings['multi_camera', 'match_by'] == 'Frame index'
+                                        else 'timestamp', tolerance=self.settings['multi_camera', 'tolerance'] / 1000)
+
+    def match_frames(self, camera, frames, infos):
+        """
+        Consumer of the acquisition loops in multi-camera mode (called in the acquisition threads): match the frames
+        of a camera with those of the others, and pass the complete sets (with the ROI channels of the main camera
+        frame) to emit_matched, at most at the display rate
+
+        Parameters
+        ----------
+        camera: int
+            0 for the main camera, index in camera_loops + 1 for the additional ones
+        """
+        with self._match_lock:
+            if self._averaging:  # only averages of the main camera are emitted
+                return
+            if camera == 0 and self.acquisition_loop.processor is not None:
+                frames = frames.copy()  # kept by the matcher, while processed frames are in a reused buffer
+            matched = self.matcher.add(camera, frames, infos)
+            now = perf_counter()
+            display_period = 0. if self._single_grab else self.acquisition_loop.display_period
+            if matched is None or now - self._last_matched_emission < display_period:
+                return
+            self._last_matched_emission = now
+            if self._single_grab:
+                for loop in [self.acquisition_loop] + self.camera_loops:
+                    loop.pause(wait=False)
+            frames = [frame[np.newaxis] for frame, _ in matched]
+            channels = self.roi_statistics(frames[0]) if self.roi_statistics is not None else None
+            if self.preview is not None and self.emitting_frames:
+                frames[0] = self.preview(frames[0])
+        self.matched_signal.emit(frames, [info for _, info in matched], now, channels)
+
+    def update_camera_list(self, refresh=False):
+        """Set the camera index limits and the model/serial of the selected camera from the camera registry"""
+        cameras = camera_registry.cameras(refresh=refresh)
+        self.settings.child('camera_index').setLimits((0, max(len(cameras) - 1, 0)))
+        index = self.settings['camera_index']
+        if index < len(cameras):
+            self.settings.child('camera_name').setValue(cameras[index].model)
+            self.settings.child('camera_serial').setValue(cameras[index].serial_number)
+        if refresh:
+            self.emit_status(ThreadCommand('Update_Status', [f'{len(cameras)} DCAM camera(s) found']))
+
     def _prepare_view(self):
-        """Preparing a data viewer by emitting temporary data. Typically, needs to be called whenever the
-        ROIs are changed"""
-        # wx = self.settings.child('rois', 'width').value()
-        # wy = self.settings.child('rois', 'height').value()
-        # bx = self.settings.child('rois', 'x_binning').value()
-        # by = self.settings.child('rois', 'y_binning').value()
-        #
-        # sizex = wx // bx
-        # sizey = wy // by
-        height, width = self.controller._get_data_dimensions_rc()
+        """Update the frame size and axes for the current ROI, and prepare the data viewer by emitting temporary
+        data if the frame shape changed. Needs to be called whenever the ROIs or the software reduction are changed"""
+        hstart, _, vstart, _, hbin, vbin = self.controller.get_roi()
+        camera_height, camera_width = self.controller._get_data_dimensions_rc()
+        self.settings.child('hdet').setValue(camera_width)
+        self.settings.child('vdet').setValue(camera_height)
 
-        self.settings.child('hdet').setValue(width)
-        self.settings.child('vdet').setValue(height)
-        mock_data = np.zeros((width, height))
+        if self.reducing:
+            crop_vstart, _, crop_hstart, _ = self.reducer.bounds((camera_height, camera_width))
+            height, width = self.reducer.output_shape((camera_height, camera_width))
+            self._geometry = (hstart + crop_hstart * hbin, vstart + crop_vstart * vbin,
+                              hbin * self.reducer.hbin, vbin * self.reducer.vbin, height, width)
+        else:
+            height, width = camera_height, camera_width
+            self._geometry = (hstart, vstart, hbin, vbin, height, width)
 
         if width != 1 and height != 1:
-            data_shape = 'Data2D'
+            self.data_shape = 'Data2D'
         else:
-            data_shape = 'Data1D'
+            self.data_shape = 'Data1D'
 
-        if data_shape != self.data_shape:
-            self.data_shape = data_shape
-            # init the viewers
-            self.data_grabed_signal_temp.emit([DataFromPlugins(name='Thorlabs Camera',
-                                                               data=[np.squeeze(mock_data)],
-                                                               dim=self.data_shape,
-                                                               labels=[f'ThorCam_{self.data_shape}'])])
-            QtWidgets.QApplication.processEvents()
+        axes = self.frame_axes()
+        self.x_axis = next((axis for axis in axes if axis.label == 'X'), None)
+        self.y_axis = next((axis for axis in axes if axis.label == 'Y'), None)
+
+        if self.preview is not None:
+            vfactor, hfactor = self.preview.factors((height, width))
+            display_shape = self.preview.output_shape((height, width))
+            self._display_geometry = self._geometry[:2] + (self._geometry[2] * hfactor,
+                                                           self._geometry[3] * vfactor) + display_shape
+        else:
+            display_shape = (height, width)
+            self._display_geometry = self._geometry
+
+        if (height, width) != self._view_shape or display_shape != self._display_shape:
+            self._view_shape = (height, width)
+            self._display_shape = display_shape
+            self._init_viewers()
+        self.update_correction()
+
+    def _init_viewers(self):
+        """Prepare the data viewers by emitting temporary data of the current frame shape and ROI channels"""
+        data = []
+        if self.emitting_frames:
+            data.append(DataFromPlugins(name='DCAM Camera', data=[np.squeeze(np.zeros(self._display_shape))],
+                                        dim=self.data_shape, axes=self.frame_axes(displayed=True),
+                                        labels=[f'DCAM_{self.data_shape}']))
+            data.extend(self.camera_data([np.zeros((1,) + shape) for shape in self._camera_shapes]))
+        if self.roi_statistics is not None:
+            data.extend(self.roi_data(self.roi_statistics(np.zeros((1,) + self._view_shape))))
+        self.data_grabed_signal_temp.emit(data)
+
+    def camera_data(self, frames):
+        """Last frame of each additional camera, as data to emit"""
+        data = []
+        for index, (camera_frames, axes) in enumerate(zip(frames, self._camera_axes), start=1):
+            dim = 'Data2D' if len(axes) == 2 else 'Data1D'
+            data.append(DataFromPlugins(name=f'DCAM Camera {index}', data=[np.squeeze(camera_frames[-1])], dim=dim,
+                                        axes=axes, labels=[f'DCAM{index}_{dim}']))
+        return data
+
+    def frame_axes(self, stacked=False, displayed=False):
+        """
+        Axes of the emitted frames, in sensor pixels (binned and offset by the ROI start), cached per geometry
+
+        Parameters
+        ----------
+        stacked: bool
+            If True, axes of frame stacks (the first dimension being the frame index, frames are not squeezed)
+        displayed: bool
+            If True, axes of the displayed frames (the preview if enabled) instead of the full frames
+        """
+        return self.geometry_axes(self._display_geometry if displayed else self._geometry, stacked)
+
+    def geometry_axes(self, geometry, stacked=False):
+        """Axes of frames of a given geometry (hstart, vstart, hscale, vscale, height, width), cached"""
+        key = (geometry, stacked)
+        if key not in self._axes_cache:
+            hstart, vstart, hbin, vbin, height, width = geometry
+            index = 1 if stacked else 0
+            axes = []
+            if height > 1 or stacked:
+                axes.append(Axis(label='Y', units='pixels', offset=vstart, scaling=vbin, size=height, index=index))
+                index += 1
+            if width > 1 or stacked:
+                axes.append(Axis(label='X', units='pixels', offset=hstart, scaling=hbin, size=width, index=index))
+            self._axes_cache[key] = axes
+        return self._axes_cache[key]
+
+    @property
+    def reducing(self):
+        """True if the software reduction is applied to the frames"""
+        return self.reducer in self.processing_stages
+
+    @property
+    def correcting(self):
+        """True if the dark/flat correction is applied to the frames"""
+        return self.corrector in self.processing_stages
+
+    def frame_shape(self):
+        """Shape (height, width) of the emitted frames, after the software reduction"""
+        shape = self.controller._get_data_dimensions_rc()
+        return self.reducer.output_shape(shape) if self.reducing else shape
+
+    def frame_dtype(self):
+        """Type of the emitted frames, after the software reduction and the correction"""
+        if self.correcting:
+            return np.dtype(np.float32)
+        return self.reducer.output_dtype(np.uint16) if self.reducing else np.dtype(np.uint16)
+
+    def _set_processor(self):
+        """Set the processor of the acquisition loop from the enabled stages. To be called with the controller lock"""
+        self.processing_stages = []
+        if self.settings['reduction', 'reduce'] and not self.reducer.is_identity:
+            self.processing_stages.append(self.reducer)
+        if self.settings['correction', 'correct'] and self._reference_kind is None and not self.corrector.is_identity:
+            self.processing_stages.append(self.corrector)
+        if len(self.processing_stages) > 1:
+            self.acquisition_loop.processor = ProcessingChain(self.processing_stages)
+        else:
+            self.acquisition_loop.processor = self.processing_stages[0] if self.processing_stages else None
+
+    def _check_recording(self, frame_format):
+        """Stop the recording if the shape or type of the frames changed"""
+        if self.recorder is not None and (self.frame_shape(), self.frame_dtype()) != frame_format:
+            self.settings.child('recording', 'record').setValue(False)
+            self.stop_recording()
+
+    def update_reduction(self):
+        """Apply the software reduction settings"""
+        if self.acquisition_loop is None:
+            return
+        crop = (self.settings['reduction', 'crop_y'], self.settings['reduction', 'crop_height'],
+                self.settings['reduction', 'crop_x'], self.settings['reduction', 'crop_width'])
+        frame_format = (self.frame_shape(), self.frame_dtype())
+        with self.controller_lock:
+            if crop == (0, 0, 0, 0):
+                self.reducer.crop = None
+            else:
+                vstart, height, hstart, width = crop
+                self.reducer.crop = (vstart, vstart + height if height else np.iinfo(np.int32).max,
+                                     hstart, hstart + width if width else np.iinfo(np.int32).max)
+            self.reducer.hbin = self.settings['reduction', 'hbin']
+            self.reducer.vbin = self.settings['reduction', 'vbin']
+            self.reducer.mode = self.settings['reduction', 'bin_mode']
+            self.reducer.decimation = self.settings['reduction', 'decimation']
+            if self.reducer.workers != self.settings['reduction', 'workers']:
+                self.reducer.workers = self.settings['reduction', 'workers']
+            self.reducer.reset()
+            self._set_processor()
+        self._check_recording(frame_format)
+        self._prepare_view()
+
+    def reference_key(self):
+        """Settings the correction references depend on: camera, geometry of the frames, reduction and exposure"""
+        return (self.settings['camera_serial'] or f"camera{self.settings['camera_index']}", *self._geometry,
+                self.reducer.mode if self.reducing else 'raw', f"{self.settings['timing_opts', 'exposure_time']}ms")
+
+    def update_correction(self):
+        """Set the correction references of the current settings (none if they were never taken)"""
+        if self.acquisition_loop is None or self._geometry is None:
+            return
+        self.references.directory = self.settings['correction', 'directory'] \
+            or get_set_local_dir() / 'dcam_references'
+        key = self.reference_key()
+        dark, flat = (self.references.get(key, kind) for kind in REFERENCE_KINDS)
+        frame_format = (self.frame_shape(), self.frame_dtype())
+        with self.controller_lock:
+            self.corrector.set_references(dark, flat)
+            self._set_processor()
+        self._check_recording(frame_format)
+        self.settings.child('correction', 'dark').setValue(dark is not None)
+        self.settings.child('correction', 'flat').setValue(flat is not None)
+
+    def take_reference(self, kind):
+        """
+        Average frames (without correction) to take a correction reference, stored by store_reference
+
+        Parameters
+        ----------
+        kind: str
+            One of REFERENCE_KINDS
+        """
+        self.start_acquisition()
+        with self.controller_lock:
+            self._reference_kind = kind
+            self._set_processor()  # references are taken on uncorrected frames
+            self._reference_accumulator = Accumulator(self.frame_shape())
+            self._pause_after_reference = not self.acquisition_loop.running
+            if self.accumulate_reference not in self.acquisition_loop.consumers:
+                self.acquisition_loop.consumers.append(self.accumulate_reference)
+        self.emit_status(ThreadCommand('Update_Status', [f'Taking {kind} reference...']))
+        self.acquisition_loop.start_grab()
+
+    def accumulate_reference(self, frames, infos):
+        """Consumer of the acquisition loop (called in the acquisition thread): add frames to the reference"""
+        if frames.shape[1:] != self._reference_accumulator.shape:  # ROI changed while taking the reference
+            self._reference_accumulator = Accumulator(frames.shape[1:])
+        needed = self.settings['correction', 'reference_frames'] - self._reference_accumulator.count
+        self._reference_accumulator.add_batch(frames[:needed])
+        if self._reference_accumulator.count >= self.settings['correction', 'reference_frames']:
+            self.acquisition_loop.consumers.remove(self.accumulate_reference)
+            if self._pause_after_reference:
+                self.acquisition_loop.pause(wait=False)
+            self.reference_signal.emit(self._reference_kind, self._reference_accumulator.mean())
+
+    def cancel_reference(self):
+        """Stop taking a reference"""
+        if self._reference_kind is None:
+            return
+        with self.controller_lock:
+            if self.accumulate_reference in self.acquisition_loop.consumers:
+                self.acquisition_loop.consumers.remove(self.accumulate_reference)
+            self._reference_kind = None
+            self._set_processor()
+
+    def store_reference(self, kind, reference):
+        """Save a reference taken by accumulate_reference, and use it for the correction"""
+        with self.controller_lock:
+            self._reference_kind = None
+            self._reference_accumulator = None
+        if reference.shape == self.frame_shape():
+            self.references.store(self.reference_key(), kind, reference.astype(np.float32))
+            self.emit_status(ThreadCommand('Update_Status', [f'{kind.capitalize()} reference taken']))
+        else:
+            self.emit_status(ThreadCommand('Update_Status', [f'{kind.capitalize()} reference discarded: the frame '
+                                                             f'shape changed while it was taken', 'log']))
+        self.update_correction()
 
     def update_rois(self, new_roi):
-        # In pylablib, ROIs compare as tuples
+        """
+        Set the camera ROI, only if it is different from the current one
+
+        Parameters
+        ----------
+        new_roi: tuple
+            (x start, width, x binning, y start, height, y binning) in sensor pixels
+        """
         (new_x, new_width, new_xbinning, new_y, new_height, new_ybinning) = new_roi
-        if new_roi != self.controller.get_roi():
+        # In pylablib, ROIs compare as tuples (hstart, hend, vstart, vend, hbin, vbin)
+        if (new_x, new_x + new_width, new_y, new_y + new_height, new_xbinning, new_ybinning) \
+                != tuple(self.controller.get_roi()):
+            if self.recorder is not None:  # the frame size is fixed in a recording
+                self.settings.child('recording', 'record').setValue(False)
+                self.stop_recording()
             # self.controller.set_attribute_value("ROIs",[new_roi])
-            self.controller.set_roi(hstart=new_x, hend=new_x + new_width, vstart=new_y, vend=new_y + new_height,
-                                    hbin=new_xbinning, vbin=new_ybinning)
+            self.reconfigure(lambda: self.controller.set_roi(hstart=new_x, hend=new_x + new_width, vstart=new_y,
+                                                             vend=new_y + new_height, hbin=new_xbinning,
+                                                             vbin=new_ybinning),
+                             # prepare view for displaying the new data
+                             after=self._prepare_view)
             self.emit_status(ThreadCommand('Update_Status', [f'Changed ROI: {new_roi}']))
-            self.controller.clear_acquisition()
-            self.controller.setup_acquisition()
-            # Finally, prepare view for displaying the new data
-            self._prepare_view()
 
-    def grab_data(self, Naverage=1, **kwargs):
+    def reconfigure(self, configure=None, after=None):
         """
-        Grabs the data. Synchronous method (kinda).
+        Reconfigure the camera with the acquisition stopped, update the buffer, and resume the acquisition if it was
+        running.
+
+        Without configure, the buffer is only reallocated if the number of frames changed. Otherwise, the buffer is
+        released before configure and allocated once afterwards: DCAM does not allow to change the ROI with an
+        allocated buffer (pylablib set_roi clears the acquisition), so that any ROI or binning change reallocates it.
+
+        Parameters
+        ----------
+        configure: callable or None
+            Called with the acquisition stopped and cleared
+        after: callable or None
+            Called once the camera is configured, before resuming the acquisition
+        """
+        # the acquisition thread should not read frames while the camera is reconfigured
+        was_running = self.acquisition_loop is not None and self.acquisition_loop.running
+        if self.acquisition_loop is not None:
+            self.acquisition_loop.pause()
+        with self.controller_lock:
+            self.controller.stop_acquisition()
+            if configure is not None:
+                # cleared first, so that pylablib does not set the acquisition up again with the previous number of
+                # frames before the setup below
+                self.controller.clear_acquisition()
+                configure()
+            self.controller.setup_acquisition(nframes=self.buffer_frames())  # reallocates if nframes changed
+        if after is not None:
+            after()
+        if was_running:
+            self.start_acquisition()
+            self.acquisition_loop.start_grab()
+
+    def buffer_frames(self, camera=None):
+        """Number of frames of the buffer of a camera (the main one if None), from the buffer settings and the current
+        frame size"""
+        frame_shape = (self.controller if camera is None else camera)._get_data_dimensions_rc()
+        if self.settings['acquisition', 'buffer_mode'] == 'Frames':
+            nframes = buffer_frame_count(frame_shape, nframes=self.settings['acquisition', 'buffer_frames'])
+        else:
+            nframes = buffer_frame_count(frame_shape, budget_mb=self.settings['acquisition', 'buffer_mb'])
+        if camera is not None:
+            return nframes
+        self.settings.child('acquisition', 'buffer_allocated').setValue(nframes)
+        self.settings.child('acquisition', 'buffer_allocated_mb').setValue(
+            round(nframes * np.prod(frame_shape) * BYTES_PER_PIXEL / 1e6, 1))
+        return nframes
+
+    def start_acquisition(self):
+        """Start the camera acquisition if not running"""
+        with self.controller_lock:
+            # Warning, acquisition_in_progress returns 1,0 and not a real bool
+            if not self.controller.acquisition_in_progress():
+                # the buffer set up by reconfigure is reused
+                self.controller.start_acquisition(nframes=self.settings['acquisition', 'buffer_allocated'])
+                self.frame_tracker.reset()
+                self.telemetry.reset()
+        for loop in self.camera_loops:
+            with loop.lock:
+                if not loop.camera.acquisition_in_progress():
+                    loop.camera.start_acquisition(nframes=self.buffer_frames(loop.camera))
+                    loop.tracker.reset()
+
+    def grab_data(self, Naverage=1, live=False, **kwargs):
+        """
+        Start the acquisition loop, data are then emitted by emit_data.
         ----------
         Naverage: (int) Number of averaging
+        live: (bool) if True, emit data continuously (at the display rate) until stop, otherwise emit a single time
         kwargs: (dict) of others optionals arguments
         """
         try:
-            # Warning, acquisition_in_progress returns 1,0 and not a real bool
-            if not self.controller.acquisition_in_progress():
-                self.controller.clear_acquisition()
-                self.controller.start_acquisition()
-            # Then start the acquisition
-            self.callback_signal.emit()  # will trigger the wait for acquisition
+            self.start_acquisition()
+            if Naverage > 1:
+                self.start_averaging(Naverage, live)
+            elif self.camera_loops:
+                self.stop_averaging()
+                with self._match_lock:
+                    self.matcher.reset()
+                    self._single_grab = not live  # loops are paused once a set is matched
+                for loop in [self.acquisition_loop] + self.camera_loops:
+                    loop.start_grab()
+            else:
+                self.stop_averaging()
+                self.acquisition_loop.start_grab(single=not live)
 
         except Exception as e:
             self.emit_status(ThreadCommand('Update_Status', [str(e), "log"]))
 
-    def emit_data(self):
+    def start_recording(self):
+        """Open a new file and stream every frame read by the acquisition loop to it"""
+        if self.recorder is not None:
+            return
+        file_format = self.settings['recording', 'file_format']
+        directory = Path(self.settings['recording', 'directory'] or Path.home())
+        path = directory / (f"{self.settings['recording', 'prefix']}_{datetime.now():%Y%m%d_%H%M%S}"
+                            f"{RECORD_FORMATS[file_format]}")
+        try:
+            self.recorder = FrameRecorder(path, self.frame_shape(), dtype=self.frame_dtype(), file_format=file_format,
+                                          max_queued_frames=self.settings['recording', 'queue_size'])
+        except Exception as e:
+            self.settings.child('recording', 'record').setValue(False)
+            self.emit_status(ThreadCommand('Update_Status', [f'Cannot record: {e}', 'log']))
+            return
+        self.settings.child('recording', 'file').setValue(str(path))
+        recorder = self.recorder
+        # processed frames are written in a reused buffer, they are copied
+        self._record_consumer = (lambda frames, infos: recorder.put(frames.copy(), infos)) \
+            if self.acquisition_loop.processor is not None else recorder.put
+        with self.controller_lock:
+            self.acquisition_loop.consumers.append(self._record_consumer)
+        self.emit_status(ThreadCommand('Update_Status', [f'Recording to {path}']))
+
+    def stop_recording(self):
+        """Write the remaining frames and close the recording file"""
+        if self.recorder is None:
+            return
+        with self.controller_lock:
+            if self._record_consumer in self.acquisition_loop.consumers:
+                self.acquisition_loop.consumers.remove(self._record_consumer)
+        self.recorder.close()
+        self.update_recording_status()
+        if self.recorder.error is not None:
+            self.emit_status(ThreadCommand('Update_Status', [f'Recording error: {self.recorder.error}', 'log']))
+        self.emit_status(ThreadCommand('Update_Status', [f'{self.recorder.frames_written} frames recorded to '
+                                                         f'{self.recorder.path}']))
+        self.recorder = None
+
+    def update_recording_status(self):
+        """Display the recorder metrics"""
+        self.settings.child('recording', 'frames_written').setValue(self.recorder.frames_written)
+        self.settings.child('recording', 'throughput').setValue(round(self.recorder.throughput, 1))
+        self.settings.child('recording', 'queue_depth').setValue(self.recorder.queue_depth)
+        self.settings.child('recording', 'dropped_frames').setValue(self.recorder.dropped)
+
+    def start_averaging(self, Naverage, live=False):
+        """Accumulate the frames read by the acquisition loop, to emit their average every Naverage frames"""
+        shape = self.frame_shape()
+        dtype = np.dtype(self.settings['acquisition', 'accumulator_dtype'])
+        compute_variance = self.settings['acquisition', 'emit_variance']
+        with self.controller_lock:
+            if self._accumulator is None or not self._accumulator.matches(shape, compute_variance, dtype):
+                self._accumulator = Accumulator(shape, compute_variance, dtype)
+            self._accumulator.reset()
+            self._naverage = Naverage
+            self._live_average = live
+            self._averaging = True
+            if self.accumulate not in self.acquisition_loop.consumers:
+                self.acquisition_loop.consumers.append(self.accumulate)
+        self.acquisition_loop.start_grab()
+
+    def stop_averaging(self):
+        """Stop accumulating frames"""
+        with self.controller_lock:
+            self._averaging = False
+            if self.accumulate in self.acquisition_loop.consumers:
+                self.acquisition_loop.consumers.remove(self.accumulate)
+
+    def accumulate(self, frames, infos):
+        """Consumer of the acquisition loop (called in the acquisition thread): add frames to the accumulator"""
+        if frames.shape[1:] != self._accumulator.shape:  # ROI changed during the averaging
+            self._accumulator = Accumulator(frames.shape[1:], self._accumulator.compute_variance,
+                                            self._accumulator.dtype)
+        while len(frames) > 0:
+            needed = self._naverage - self._accumulator.count
+            self._accumulator.add_batch(frames[:needed])
+            frames = frames[needed:]
+            if self._accumulator.count >= self._naverage:
+                variance = self._accumulator.variance() if self._accumulator.compute_variance else None
+                mean = self._accumulator.mean()
+                roi_statistics = self.roi_statistics
+                channels = roi_statistics(mean[np.newaxis]) if roi_statistics is not None else None
+                self.average_signal.emit(mean, variance, perf_counter(), channels)
+                self._accumulator.reset()
+                if not self._live_average:  # single average (snap)
+                    self._averaging = False
+                    self.acquisition_loop.consumers.remove(self.accumulate)
+                    self.acquisition_loop.pause(wait=False)
+                    return
+
+    def emit_average(self, mean, variance, ready_time, channels=None):
+        """Emit the average of Naverage frames, and their variance if computed, with their ROI channels"""
+        if mean.shape != self._view_shape:  # computed before a change of the ROI or of the reduction
+            return
+        self.telemetry.add_emission(ready_time)
+        data = []
+        if self.emitting_frames:
+            data.append(DataFromPlugins(name='DCAM Camera', data=[np.squeeze(mean)], dim=self.data_shape,
+                                        axes=self.frame_axes(), labels=[f'DCAM_{self.data_shape}']))
+            if variance is not None:
+                data.append(DataFromPlugins(name='DCAM Variance', data=[np.squeeze(variance)], dim=self.data_shape,
+                                            axes=self.frame_axes(), labels=[f'DCAM_variance_{self.data_shape}']))
+        self.dte_signal.emit(DataToExport(name='DCAM', data=data + self.roi_data(channels) + self.telemetry_data()))
+
+    def emit_matched(self, frames, infos, ready_time, channels=None):
         """
-            Fonction used to emit data obtained by callback.
-            See Also
-            --------
-            daq_utils.ThreadCommand
+        Emit a set of matched frames (one per camera), with the ROI channels of the main camera frame
+
+        Parameters
+        ----------
+        frames: list(numpy.array())
+            (1, height, width) array of each camera, the main one being first
+        infos: list
+            pylablib frame info of each frame
+        ready_time: float
+            perf_counter time at which the set was matched
+        channels: list(dict) or None
         """
-        try:
-            # Get  data from buffer
-            frame = self.controller.read_newest_image()
-            # Emit the frame.
-            if frame is not None:  # happens for last frame when stopping camera
-                self.data_grabed_signal.emit([DataFromPlugins(name='DCAM Camera',
-                                                              data=[np.squeeze(frame)],
-                                                              dim=self.data_shape,
-                                                              labels=[f'DCAM_{self.data_shape}'])])
+        self.update_acquisition_status()
+        if frames[0].shape[1:] != (self._display_shape if self.emitting_frames else self._view_shape):
+            return  # read before a change of the ROI, of the reduction or of the preview
+        self.telemetry.add_emission(ready_time)
+        self.settings.child('multi_camera', 'matched_sets').setValue(self.matcher.matched)
+        data = []
+        if self.emitting_frames:
+            data.append(DataFromPlugins(name='DCAM Camera', data=[np.squeeze(frames[0][-1])], dim=self.data_shape,
+                                        axes=self.frame_axes(displayed=True), labels=[f'DCAM_{self.data_shape}']))
+            data.extend(self.camera_data(frames[1:]))
+        self.dte_signal.emit(DataToExport(name='DCAM', data=data + self.roi_data(channels) + self.telemetry_data()))
+        self.update_telemetry()
 
-            if self.settings.child('timing_opts', 'fps_on').value():
-                self.update_fps()
+    def display_frames(self, frames, infos, ready_time):
+        """
+        Display callback of the acquisition loop (called in the acquisition thread): compute the ROI channels of the
+        frames, downsample them if previewing, and pass both to emit_data
+        """
+        if self.matcher is not None:  # frames are emitted as matched sets
+            return
+        channels = None
+        if not self._averaging:  # otherwise only averages are emitted
+            roi_statistics, preview = self.roi_statistics, self.preview
+            channels = roi_statistics(frames) if roi_statistics is not None else None
+            if preview is not None and self.emitting_frames:
+                frames = preview(frames)
+        self.frames_signal.emit(frames, infos, ready_time, channels)
+
+    def emit_data(self, frames, infos, ready_time, channels=None):
+        """
+            Emit the frames passed by the acquisition thread (at most at the display rate).
+
+            Parameters
+            ----------
+            frames: numpy.array()
+                (n_frames, height, width) array, only the last one is emitted in Live mode
+            infos: list
+                pylablib frame info of each frame
+            ready_time: float
+                perf_counter time at which the frames were available
+            channels: list(dict) or None
+                ROI channels of the frames, if computed
+        """
+        try:
+            self.update_acquisition_status()
+            if self._averaging:  # only averages are emitted
+                self.update_telemetry()
+                return
+            if frames.shape[1:] != (self._display_shape if self.emitting_frames else self._view_shape):
+                return  # read before a change of the ROI, of the reduction or of the preview
 
-            # To make sure that timed events are executed in continuous grab mode
-            QtWidgets.QApplication.processEvents()
+            self.telemetry.add_emission(ready_time)
+            if self.settings['acquisition', 'acq_mode'] == 'Lossless':
+                self.emit_frame_stack(frames, infos, channels)
+            else:
+                data = []
+                if self.emitting_frames:
+                    data.append(DataFromPlugins(name='DCAM Camera', data=[np.squeeze(frames[-1])],
+                                                dim=self.data_shape, axes=self.frame_axes(displayed=True),
+                                                labels=[f'DCAM_{self.data_shape}']))
+                self.dte_signal.emit(DataToExport(name='DCAM',
+                                                  data=data + self.roi_data(channels) + self.telemetry_data()))
+            self.update_telemetry()
 
         except Exception as e:
             self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
 
-    def update_fps(self):
-        current_tick = perf_counter()
-        frame_time = current_tick - self.last_tick
+    def update_acquisition_status(self):
+        """Display the frame counters and the recorder metrics"""
+        if self.recorder is not None:
+            self.update_recording_status()
+        self.settings.child('acquisition', 'frames_read').setValue(self.frame_tracker.frames_read)
+        self.settings.child('acquisition', 'dropped_frames').setValue(self.frame_tracker.dropped)
+        self.settings.child('acquisition', 'overruns').setValue(self.frame_tracker.overruns)
 
-        if self.last_tick != 0.0 and frame_time != 0.0:
-            # We don't update FPS for the first frame, and we also avoid divisions by zero
+    def on_loop_error(self, message):
+        """Report an error of the acquisition thread (which is then paused)"""
+        self.emit_status(ThreadCommand('Update_Status', [f'Acquisition error: {message}', 'log']))
 
-            if self.fps == 0.0:
-                self.fps = 1 / frame_time
-            else:
-                # If we already have an FPS calculated, we smooth its evolution
-                self.fps = 0.9 * self.fps + 0.1 / frame_time
+    def emit_frame_stack(self, frames, infos, channels=None):
+        """Emit all the frames acquired since the last emission as a single stack, with their ROI channels"""
+        indexes = np.array([info.frame_index for info in infos]) if infos and infos[0] is not None \
+            else np.arange(len(frames))
+        frame_axis = Axis(label='Frame index', data=indexes.astype(float), index=0)
+        data = []
+        if self.emitting_frames:
+            data.append(DataFromPlugins(name='DCAM Camera', data=[frames], dim='DataND', nav_indexes=(0,),
+                                        axes=[frame_axis] + self.frame_axes(stacked=True, displayed=True),
+                                        labels=['DCAM_frames']))
+        self.dte_signal.emit(DataToExport(name='DCAM', data=data + self.roi_data(channels, frame_axis)
+                                          + self.telemetry_data()))
 
-        self.last_tick = current_tick
+    def update_telemetry(self):
+        """Display the telemetry values"""
+        for name, value in self.telemetry.snapshot().items():
+            if name != 'dropped_frames':  # already displayed in the acquisition settings
+                self.settings.child('telemetry', name).setValue(round(value, 1))
 
-        # Update reading
-        self.settings.child('timing_opts', 'fps').setValue(round(self.fps, 1))
+    def telemetry_data(self):
+        """Telemetry values as a Data0D to emit along with the images, if enabled"""
+        if not self.settings['telemetry', 'emit_telemetry']:
+            return []
+        snapshot = self.telemetry.snapshot()
+        return [DataFromPlugins(name='DCAM Telemetry', dim='Data0D',
+                                data=[np.array([snapshot[name]]) for name in TELEMETRY_CHANNELS],
+                                labels=[f'{name} ({unit})' if unit else name
+                                        for name, unit in TELEMETRY_CHANNELS.items()])]
 
     def callback(self):
         """optional asynchrone method called when the detector has finished its acquisition of data"""
@@ -271,7 +1211,18 @@ class DAQ_2DViewer_Hamamatsu(DAQ_Viewer_base):
         """
         Terminate the communication protocol
         """
-        # Terminate the communication
+        # Terminate the acquisition thread and the communication
+        self.stop_recording()
+        if self.acquisition_loop is not None:
+            self.acquisition_loop.stop()
+            self.acquisition_loop = None
+        for loop in self.camera_loops:
+            loop.stop()
+            loop.camera.close()
+        self.camera_loops = []
+        self.matcher = None
+        self.reducer.close()
+        self.controller.clear_acquisition()
         self.controller.close()
         self.controller = None  # Garbage collect the controller
         self.status.initialized = False
@@ -280,25 +1231,17 @@ class DAQ_2DViewer_Hamamatsu(DAQ_Viewer_base):
 
     def stop(self):
         """Stop the acquisition."""
-        self.controller.stop_acquisition()
-        self.controller.clear_acquisition()
+        self.stop_averaging()
+        self.cancel_reference()
+        self.acquisition_loop.pause()
+        with self.controller_lock:
+            self.controller.stop_acquisition()  # the buffer is kept for the next grab
+        for loop in self.camera_loops:
+            loop.pause()
+            with loop.lock:
+                loop.camera.stop_acquisition()
         return ''
 
 
-class DCAMCallback(QtCore.QObject):
-    """Callback object """
-    data_sig = QtCore.Signal()
-
-    def __init__(self, wait_fn):
-        super().__init__()
-        # Set the wait function
-        self.wait_fn = wait_fn
-
-    def wait_for_acquisition(self):
-        new_data = self.wait_fn()
-        if new_data is not False:  # will be returned if the main thread called CancelWait
-            self.data_sig.emit()
-
-
 if __name__ == '__main__':
     main(__file__)
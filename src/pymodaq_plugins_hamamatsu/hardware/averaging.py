@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+In-place accumulation of spectra or frames for plugin side averaging
+"""
+
+import numpy as np
+
+
+class Accumulator:
+    """
+    Accumulate data into preallocated buffers, to average N acquisitions before emitting them.
+
+    Sum (and sum of squares if the variance is required) are accumulated with in-place additions,
+    so no memory is allocated per acquisition.
+
+    Parameters
+    ----------
+    shape: tuple of int
+        Shape of a single acquisition
+    compute_variance: bool
+        If True, also accumulate the sum of squares to compute the variance/standard deviation
+    dtype: numpy.dtype
+        Type of the accumulation buffers (float64 by default, float32 to spare memory on large frames)
+    """
+
+    def __init__(self, shape, compute_variance=False, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.compute_variance = compute_variance
+        self.dtype = np.dtype(dtype)
+        self._sum = np.zeros(self.shape, dtype=self.dtype)
+        self._sum_sq = np.zeros(self.shape, dtype=self.dtype) if compute_variance else None
+        self._tmp = np.zeros(self.shape, dtype=self.dtype) if compute_variance else None
+        self.count = 0
+
+    def matches(self, shape, compute_variance=False, dtype=np.float64):
+        """Check if the buffers can be reused for acquisitions with these characteristics"""
+        return (self.shape == tuple(shape) and self.dtype == np.dtype(dtype)
+                and (self.compute_variance or not compute_variance))
+
+    def reset(self):
+        """Restart accumulation without reallocating the buffers"""
+        self._sum.fill(0)
+        if self._sum_sq is not None:
+            self._sum_sq.fill(0)
+        self.count = 0
+
+    def add(self, data):
+        """
+        Add a single acquisition
+
+        Parameters
+        ----------
+        data: numpy.array()
+            Array with the accumulator shape, any numerical type
+        """
+        np.add(self._sum, data, out=self._sum, casting='unsafe')
+        if self._sum_sq is not None:
+            np.multiply(data, data, out=self._tmp, dtype=self.dtype, casting='unsafe')
+            np.add(self._sum_sq, self._tmp, out=self._sum_sq)
+        self.count += 1
+
+    def add_batch(self, data):
+        """
+        Add a stack of acquisitions at once
+
+        Parameters
+        ----------
+        data: numpy.array()
+            Array of shape (n,) + accumulator shape
+        """
+        if len(data) == 0:
+            return
+        self._sum += np.sum(data, axis=0, dtype=self.dtype)
+        if self._sum_sq is not None:
+            for frame in data:  # avoids allocating a squared copy of the whole stack
+                np.multiply(frame, frame, out=self._tmp, dtype=self.dtype, casting='unsafe')
+                np.add(self._sum_sq, self._tmp, out=self._sum_sq)
+        self.count += len(data)
+
+    def mean(self):
+        """Return the average of the accumulated data (new array)"""
+        return self._sum / max(self.count, 1)
+
+    def variance(self):
+        """Return the (population) variance of the accumulated data (new array)"""
+        if self._sum_sq is None:
+            raise ValueError('Accumulator was not configured to compute the variance')
+        count = max(self.count, 1)
+        mean = self._sum / count
+        variance = self._sum_sq / count
+        variance -= mean * mean
+        np.maximum(variance, 0, out=variance)  # rounding errors
+        return variance
+
+    def std(self):
+        """Return the standard deviation of the accumulated data (new array)"""
+        return np.sqrt(self.variance())
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Frame reading helpers for DCAM cameras (pylablib DCAMCamera API)
+"""
+
+import threading
+import time
+
+import numpy as np
+
+BYTES_PER_PIXEL = 2  # mono16, the default DCAM pixel type
+
+
+class FrameTracker:
+    """
+    Keep track of the frames read from the camera buffer, to count lost frames.
+
+    Frames are lost either because the camera buffer was overwritten before they were read (buffer overrun, seen as
+    a gap in the buffer frame indices) or because the driver missed them (gap in the frame stamps).
+
+    Attributes
+    ----------
+    frames_read: int
+        Number of frames read since the acquisition start
+    dropped: int
+        Number of lost frames
+    overruns: int
+        Number of reads where frames had already been overwritten in the buffer
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """To be called when the acquisition is (re)started, as buffer indices start from 0 again"""
+        self.next_index = 0
+        self.frames_read = 0
+        self.dropped = 0
+        self.overruns = 0
+        self._last_framestamp = None
+
+    def update(self, first, last, framestamps=None):
+        """
+        Account for frames [first, last) read from the buffer
+
+        Parameters
+        ----------
+        first, last: int
+            Buffer range of the read frames (last excluded)
+        framestamps: list(int) or None
+            Driver frame stamps of the read frames, if available
+        """
+        if first > self.next_index:
+            self.dropped += first - self.next_index
+            self.overruns += 1
+        elif framestamps is not None and len(framestamps) > 0:
+            stamps = np.asarray(framestamps, dtype=np.int64)
+            if self._last_framestamp is not None:
+                stamps = np.concatenate(([self._last_framestamp], stamps))
+            gaps = np.diff(stamps) - 1
+            self.dropped += int(gaps[gaps > 0].sum())
+        if framestamps is not None and len(framestamps) > 0:
+            self._last_framestamp = int(framestamps[-1])
+        self.frames_read += last - first
+        self.next_index = last
+
+    def skip_to(self, index):
+        """Ignore the frames before buffer index (skipped on purpose, not lost)"""
+        self.next_index = index
+        self._last_framestamp = None
+
+
+def buffer_frame_count(frame_shape, nframes=None, budget_mb=None, bytes_per_pixel=BYTES_PER_PIXEL, min_frames=2):
+    """
+    Number of frames of the camera ring buffer, given either directly or as a memory budget
+
+    Parameters
+    ----------
+    frame_shape: tuple of int
+        (height, width) of the (binned) frames
+    nframes: int or None
+        Requested number of frames, used if budget_mb is None
+    budget_mb: float or None
+        Memory budget of the buffer (MB)
+    bytes_per_pixel: int
+    min_frames: int
+        Minimum size of the buffer
+
+    Returns
+    -------
+    int: number of frames
+    """
+    if budget_mb is not None:
+        frame_bytes = int(np.prod(frame_shape)) * bytes_per_pixel
+        nframes = int(budget_mb * 1e6 // max(frame_bytes, 1))
+    elif nframes is None:
+        raise ValueError('Either a number of frames or a memory budget should be given')
+    return max(int(nframes), min_frames)
+
+
+def stack_frames(frames):
+    """Stack frames returned by pylablib (list of 2D frames or of 3D chunks) into a single 3D array"""
+    if len(frames) == 1:
+        return frames[0][np.newaxis] if frames[0].ndim == 2 else frames[0]
+    return np.concatenate([frame[np.newaxis] if frame.ndim == 2 else frame for frame in frames])
+
+
+def drain_frames(camera, tracker=None):
+    """
+    Read all the frames acquired since the last read, in a single call
+
+    Parameters
+    ----------
+    camera: DCAM.DCAMCamera
+    tracker: FrameTracker or None
+        Updated with the read frames
+
+    Returns
+    -------
+    frames: numpy.array() or None
+        (n_frames, height, width) array, None if no new frame is available
+    infos: list
+        pylablib frame info of each frame (index, frame stamp, timestamp...)
+    """
+    result = camera.read_multiple_images(return_info=True, return_rng=True)
+    if result is None:  # acquisition not running
+        return None, []
+    frames, infos, rng = result
+    if len(frames) == 0:
+        return None, []
+    if tracker is not None:
+        framestamps = [info.framestamp for info in infos] if infos and infos[0] is not None else None
+        tracker.update(rng[0], rng[1], framestamps)
+    return stack_frames(frames), infos
+
+
+class AcquisitionLoop(threading.Thread):
+    """
+    Thread reading frames continuously from a DCAM camera, decoupled from their display.
+
+    Each batch of new frames is handed to the full-rate consumers, called in the acquisition thread, while the display
+    callback is called at most once per display period with the frames to show: the newest frame only, or in lossless
+    mode all the frames read since the previous display (as a stack).
+
+    Frames are only drained from the camera buffer (and counted by the tracker) when some consumer needs them all or in
+    lossless mode, otherwise only the newest frame is read.
+
+    Parameters
+    ----------
+    camera: DCAM.DCAMCamera
+    display_callback: callable
+        Called in the acquisition thread as display_callback(frames, infos, ready_time), frames being a
+        (n_frames, height, width) array and ready_time the perf_counter time at which the (oldest) frames were
+        available. Should not block (emit a Qt signal for instance).
+    tracker: FrameTracker or None
+        Updated with the drained frames
+    lock: threading.Lock or None
+        Lock held while reading frames, to share the camera with other threads (setting ROIs, exposure...)
+    error_callback: callable or None
+        Called in the acquisition thread with the exception if reading frames fails. The loop is then paused.
+
+    Attributes
+    ----------
+    consumers: list(callable)
+        Called as consumer(frames, infos) with every batch of frames
+    lossless: bool
+        If True, all frames are displayed (in stacks)
+    display_period: float
+        Minimum time between two calls of the display callback (s)
+    telemetry: AcquisitionTelemetry or None
+        If set, updated with the camera frame counters at each display
+    processor: callable or None
+        If set, called as processor(frames, infos) -> (frames, infos) on the read frames, before they are passed to
+        the consumers and displayed (software binning...). The returned frames (None to skip them) may be a reused
+        buffer: consumers keeping them should copy them.
+    """
+    wait_timeout = 0.1  # max time of a single wait, so that pause or stop requests are handled quickly (s)
+
+    def __init__(self, camera, display_callback, tracker=None, lock=None, error_callback=None):
+        super().__init__(name='DCAMAcquisitionLoop', daemon=True)
+        self.camera = camera
+        self.display_callback = display_callback
+        self.error_callback = error_callback
+        self.tracker = tracker if tracker is not None else FrameTracker()
+        self.lock = lock if lock is not None else threading.Lock()
+        self.consumers = []
+        self.lossless = False
+        self.display_period = 0.05
+        self.telemetry = None
+        self.processor = None
+        self._running = threading.Event()
+        self._quit = threading.Event()
+        self._single = False
+        self._last_display = 0.
+        self._pending = []
+        self._pending_infos = []
+        self._latest = None
+        self._ready_time = None
+        self._draining = False
+
+    @property
+    def running(self):
+        """True if frames are being read"""
+        return self._running.is_set()
+
+    def start_grab(self, single=False):
+        """
+        Start (or resume) reading frames
+
+        Parameters
+        ----------
+        single: bool
+            If True, pause after the next display (snap)
+        """
+        self._single = single
+        self._last_display = 0.
+        self._running.set()
+
+    def pause(self, wait=True):
+        """
+        Stop reading frames
+
+        Parameters
+        ----------
+        wait: bool
+            If True, return once the frame read in progress (if any) is over. Should be False when called from a
+            consumer (in the acquisition thread).
+        """
+        self._running.clear()
+        if not wait:
+            return
+        with self.lock:
+            self._pending, self._pending_infos, self._latest = [], [], None
+            self._draining = False
+
+    def stop(self, timeout=None):
+        """Terminate the thread"""
+        self._quit.set()
+        self.pause()
+        self.join(timeout)
+
+    def run(self):
+        while not self._quit.is_set():
+            if not self._running.wait(self.wait_timeout):
+                continue
+            try:
+                if not self.camera.acquisition_in_progress():
+                    time.sleep(self.wait_timeout)  # without the lock, the camera may be being reconfigured
+                    continue
+                with self.lock:
+                    if not self._running.is_set() or not self._read():
+                        continue
+                self._display()
+            except Exception as e:
+                self._running.clear()
+                if self.error_callback is not None:
+                    self.error_callback(e)
+
+    def _read(self):
+        """Wait for and read new frames, return False if none was available"""
+        try:
+            if not self.camera.wait_for_frame(since='lastread', nframes=1, timeout=self.wait_timeout):
+                return False  # acquisition stopped meanwhile
+        except self.camera.TimeoutError:
+            return False
+        ready_time = time.perf_counter()
+        if self.lossless or self.consumers:
+            if not self._draining:  # frames skipped while reading only the newest ones are not lost
+                new_range = self.camera.get_new_images_range()
+                if new_range is not None:
+                    self.tracker.skip_to(new_range[0])
+                self._draining = True
+            frames, infos = self._process(*drain_frames(self.camera, self.tracker))
+            if frames is None:
+                return False
+            for consumer in list(self.consumers):  # consumers may remove themselves
+                consumer(frames, infos)
+            if self.lossless:
+                if not self._pending:
+                    self._ready_time = ready_time
+                self._pending.append(self._keep(frames))
+                self._pending_infos.extend(infos)
+            else:
+                self._latest = self._keep(frames[-1:]), infos[-1:]
+                self._ready_time = ready_time
+        else:
+            self._draining = False
+            result = self.camera.read_newest_image(return_info=True)
+            if result is None:
+                return False
+            frames, infos = self._process(result[0][np.newaxis], [result[1]])
+            if frames is None:
+                return False
+            self._latest = self._keep(frames), infos
+            self._ready_time = ready_time
+        return True
+
+    def _process(self, frames, infos):
+        if self.processor is None or frames is None:
+            return frames, infos
+        return self.processor(frames, infos)
+
+    def _keep(self, frames):
+        """Frames to be kept until the display, copied if they may be a reused processing buffer"""
+        return frames if self.processor is None else frames.copy()
+
+    def _display(self):
+        """Call the display callback if the display period is over"""
+        now = time.perf_counter()
+        if now - self._last_display < self.display_period:
+            return
+        with self.lock:
+            if self.lossless and self._pending:
+                frames, infos = stack_frames(self._pending), self._pending_infos
+                self._pending, self._pending_infos = [], []
+            elif not self.lossless and self._latest is not None:
+                (frames, infos), self._latest = self._latest, None
+            else:
+                return
+            if self.telemetry is not None:
+                self.telemetry.update_status(self.camera.get_frames_status(), self.tracker.dropped)
+        self._last_display = now
+        if self._single:
+            self._running.clear()
+        self.display_callback(frames, infos, self._ready_time)
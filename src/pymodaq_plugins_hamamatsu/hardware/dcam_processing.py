@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+Software processing of camera frame stacks (n_frames, height, width), done in the acquisition thread
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+REFERENCE_KINDS = ('dark', 'flat')
+
+
+class FrameReducer:
+    """
+    Software crop, binning (independent horizontal and vertical factors) and frame decimation.
+
+    Binning is done in two passes written into preallocated buffers (the returned array is overwritten by the next
+    call, and should be copied if it has to be kept): vertical binning as a reshape based reduction over whole rows,
+    then horizontal binning as a sum of strided column slices (small factors) or a reshape based reduction (large
+    factors), NumPy being slow to reduce short contiguous axes. Large stacks can be reduced by several threads (NumPy
+    releases the GIL), each one handling a band of rows.
+
+    Parameters
+    ----------
+    crop: tuple of int or None
+        (vstart, vend, hstart, hend) region of the frames to keep (frame pixels), None to keep the whole frames.
+        The region is clipped to the frames and truncated to a multiple of the binning.
+    hbin, vbin: int
+        Horizontal and vertical binning factors
+    mode: str
+        'sum' (uint32 output for integer frames) or 'mean' (float32 output)
+    decimation: int
+        Keep one frame every decimation frames
+    workers: int
+        Number of threads used to reduce large stacks (1: no thread pool)
+    """
+    parallel_threshold = 1 << 20  # minimum number of input pixels to use the thread pool
+    max_slice_hbin = 8  # horizontal binning factor up to which columns are summed as strided slices
+
+    def __init__(self, crop=None, hbin=1, vbin=1, mode='sum', decimation=1, workers=1):
+        self.crop = crop
+        self.hbin = hbin
+        self.vbin = vbin
+        self.mode = mode
+        self.decimation = decimation
+        self.workers = workers
+        self._out = None
+        self._rows = None  # vertically binned frames
+        self._pool = None
+        self._frame_count = 0
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, mode):
+        if mode not in ('sum', 'mean'):
+            raise ValueError(f'Unknown binning mode {mode}, should be sum or mean')
+        self._mode = mode
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers):
+        self._workers = max(int(workers), 1)
+        if getattr(self, '_pool', None) is not None:
+            self._pool.shutdown(wait=False)
+        self._pool = ThreadPoolExecutor(self._workers, thread_name_prefix='FrameReducer') \
+            if self._workers > 1 else None
+
+    @property
+    def is_identity(self):
+        """True if frames are returned unchanged"""
+        return self.crop is None and self.hbin == 1 and self.vbin == 1 and self.decimation == 1
+
+    def reset(self):
+        """Restart the frame decimation (new acquisition)"""
+        self._frame_count = 0
+
+    def bounds(self, frame_shape):
+        """(vstart, vend, hstart, hend) of the frame region that is reduced, for frames of shape (height, width)"""
+        height, width = frame_shape
+        vstart, vend, hstart, hend = self.crop if self.crop is not None else (0, height, 0, width)
+        vstart, hstart = min(max(vstart, 0), height), min(max(hstart, 0), width)
+        vend, hend = min(max(vend, vstart), height), min(max(hend, hstart), width)
+        vend -= (vend - vstart) % self.vbin
+        hend -= (hend - hstart) % self.hbin
+        return vstart, vend, hstart, hend
+
+    def output_shape(self, frame_shape):
+        """Shape (height, width) of the reduced frames"""
+        vstart, vend, hstart, hend = self.bounds(frame_shape)
+        return (vend - vstart) // self.vbin, (hend - hstart) // self.hbin
+
+    def output_dtype(self, dtype):
+        """Type of the reduced frames"""
+        if self.mode == 'mean':
+            return np.dtype(np.float32)
+        return np.dtype(np.uint32) if np.issubdtype(dtype, np.integer) else np.dtype(np.float32)
+
+    @staticmethod
+    def _buffer(buffer, n_frames, shape, dtype):
+        """Preallocated buffer, reallocated only if the frame shape or type changes, or for larger stacks"""
+        if buffer is None or buffer.shape[1:] != shape or buffer.dtype != dtype or len(buffer) < n_frames:
+            buffer = np.empty((n_frames,) + shape, dtype=dtype)
+        return buffer
+
+    def _reduce(self, frames, rows, out):
+        """Bin cropped frames into out, using rows for the vertically binned frames"""
+        n_frames, height, width = out.shape
+        if self.vbin > 1:
+            np.sum(frames.reshape(n_frames, height, self.vbin, frames.shape[2]), axis=2, out=rows, dtype=rows.dtype)
+            frames = rows
+        if self.hbin == 1:
+            if frames is not out:
+                np.copyto(out, frames, casting='unsafe')
+        elif self.hbin <= self.max_slice_hbin:
+            np.copyto(out, frames[:, :, 0::self.hbin], casting='unsafe')
+            for column in range(1, self.hbin):
+                np.add(out, frames[:, :, column::self.hbin], out=out, casting='unsafe')
+        else:
+            np.sum(frames.reshape(n_frames, height, width, self.hbin), axis=3, out=out, dtype=out.dtype)
+        if self.mode == 'mean':
+            out *= 1 / (self.vbin * self.hbin)
+
+    def __call__(self, frames, infos=None):
+        """
+        Reduce a stack of frames
+
+        Parameters
+        ----------
+        frames: numpy.array()
+            (n_frames, height, width) array
+        infos: list or None
+            Frame infos, decimated as the frames
+
+        Returns
+        -------
+        frames: numpy.array() or None
+            Reduced stack (frames itself if is_identity), None if all frames were dropped by the decimation
+        infos: list or None
+            Infos of the kept frames
+        """
+        if self.is_identity:
+            return frames, infos
+        if self.decimation > 1:
+            first = -self._frame_count % self.decimation
+            self._frame_count += len(frames)
+            frames = frames[first::self.decimation]
+            infos = infos[first::self.decimation] if infos is not None else None
+            if len(frames) == 0:
+                return None, infos
+        vstart, vend, hstart, hend = self.bounds(frames.shape[1:])
+        out_shape = ((vend - vstart) // self.vbin, (hend - hstart) // self.hbin)
+        if self.hbin == 1 and self.vbin == 1:  # crop and decimation only, views are enough
+            return frames[:, vstart:vend, hstart:hend], infos
+
+        frames = frames[:, vstart:vend, hstart:hend]
+        dtype = self.output_dtype(frames.dtype)
+        self._out = self._buffer(self._out, len(frames), out_shape, dtype)
+        out = self._out[:len(frames)]
+        if self.vbin > 1 and self.hbin > 1:
+            self._rows = self._buffer(self._rows, len(frames), (out_shape[0], frames.shape[2]), dtype)
+            rows = self._rows[:len(frames)]
+        else:
+            rows = out  # single pass
+        if self._pool is not None and frames.size >= self.parallel_threshold and out_shape[0] > 1:
+            bands = [slice(band[0], band[-1] + 1) for band in
+                     np.array_split(np.arange(out_shape[0]), min(self.workers, out_shape[0]))]
+            list(self._pool.map(lambda band: self._reduce(
+                frames[:, band.start * self.vbin:band.stop * self.vbin], rows[:, band], out[:, band]), bands))
+        else:
+            self._reduce(frames, rows, out)
+        return out, infos
+
+    def close(self):
+        """Stop the thread pool"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class FramePreview:
+    """
+    Downsampled frames for display: one pixel every factor pixels in both directions (stride) or mean of factor x
+    factor blocks (block mean, binned by a FrameReducer into its reused buffers).
+
+    The returned frames are new, small arrays, which can be handed over to another thread (the display), while the full
+    frames stay in the acquisition thread.
+
+    Parameters
+    ----------
+    factor: int
+        Downsampling factor, reduced to the frame size along each axis
+    mode: str
+        'stride' or 'mean'
+    """
+
+    def __init__(self, factor=2, mode='stride'):
+        if mode not in ('stride', 'mean'):
+            raise ValueError(f'Unknown preview mode {mode}, should be stride or mean')
+        self.factor = max(int(factor), 1)
+        self.mode = mode
+        self._reducer = FrameReducer(mode='mean')
+
+    def factors(self, frame_shape):
+        """(vertical, horizontal) downsampling factors for frames of shape (height, width)"""
+        return tuple(max(min(self.factor, size), 1) for size in frame_shape)
+
+    def output_shape(self, frame_shape):
+        """Shape (height, width) of the preview of frames of shape (height, width)"""
+        if self.mode == 'stride':
+            return tuple(-(-size // factor) for size, factor in zip(frame_shape, self.factors(frame_shape)))
+        return tuple(size // factor for size, factor in zip(frame_shape, self.factors(frame_shape)))
+
+    def __call__(self, frames):
+        """
+        Preview of a stack of frames
+
+        Parameters
+        ----------
+        frames: numpy.array()
+            (n_frames, height, width) array
+
+        Returns
+        -------
+        numpy.array(): (n_frames, *output_shape) array, float32 in block mean mode
+        """
+        vfactor, hfactor = self.factors(frames.shape[1:])
+        if self.mode == 'stride':
+            return np.ascontiguousarray(frames[:, ::vfactor, ::hfactor])
+        self._reducer.vbin, self._reducer.hbin = vfactor, hfactor
+        return self._reducer(frames)[0].copy()
+
+
+class FrameCorrector:
+    """
+    Dark-frame and flat-field correction: (frame - dark) * gain_map, written into a preallocated float32 buffer (the
+    returned array is overwritten by the next call, and should be copied if it has to be kept).
+
+    The gain map normalizes the dark-subtracted flat to its mean: gain_map = mean(flat - dark) / (flat - dark), pixels
+    without response (flat <= dark) being set to 0.
+
+    Attributes
+    ----------
+    dark: numpy.array() or None
+        Dark frame, float32
+    gain_map: numpy.array() or None
+        Flat-field gain map, float32
+    """
+
+    def __init__(self):
+        self.dark = None
+        self.gain_map = None
+        self._out = None
+
+    @property
+    def is_identity(self):
+        """True if no reference is set"""
+        return self.dark is None and self.gain_map is None
+
+    @property
+    def shape(self):
+        """Shape (height, width) of the references, None if there is none"""
+        reference = self.dark if self.dark is not None else self.gain_map
+        return None if reference is None else reference.shape
+
+    def set_references(self, dark=None, flat=None):
+        """
+        Set the references to correct the frames with
+
+        Parameters
+        ----------
+        dark: numpy.array() or None
+            Dark frame (averaged frames without light)
+        flat: numpy.array() or None
+            Flat frame (averaged frames of a uniform illumination)
+        """
+        if dark is not None and flat is not None and dark.shape != flat.shape:
+            raise ValueError(f'Dark {dark.shape} and flat {flat.shape} shapes differ')
+        self.dark = None if dark is None else np.asarray(dark, dtype=np.float32)
+        if flat is None:
+            self.gain_map = None
+        else:
+            response = np.asarray(flat, dtype=np.float32)
+            if self.dark is not None:
+                response = response - self.dark
+            valid = response > 0
+            self.gain_map = np.zeros(response.shape, dtype=np.float32)
+            if valid.any():
+                np.divide(response[valid].mean(), response, out=self.gain_map, where=valid)
+
+    def __call__(self, frames, infos=None):
+        """
+        Correct a stack of frames
+
+        Parameters
+        ----------
+        frames: numpy.array()
+            (n_frames, height, width) array
+        infos: list or None
+            Frame infos, returned unchanged
+
+        Returns
+        -------
+        frames: numpy.array() or None
+            Corrected float32 stack (frames itself if is_identity), None if the frames do not have the shape of the
+            references (read before a change of ROI, the references being updated)
+        infos: list or None
+        """
+        if self.is_identity:
+            return frames, infos
+        if frames.shape[1:] != self.shape:
+            return None, infos
+        self._out = FrameReducer._buffer(self._out, len(frames), self.shape, np.dtype(np.float32))
+        out = self._out[:len(frames)]
+        if self.dark is not None:
+            np.subtract(frames, self.dark, out=out, casting='unsafe')
+        else:
+            np.copyto(out, frames, casting='unsafe')
+        if self.gain_map is not None:
+            np.multiply(out, self.gain_map, out=out)
+        return out, infos
+
+
+class ProcessingChain:
+    """
+    Processing stages applied one after the other, each one being called as stage(frames, infos) -> (frames, infos)
+
+    Parameters
+    ----------
+    stages: list(callable)
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def __call__(self, frames, infos=None):
+        for stage in self.stages:
+            frames, infos = stage(frames, infos)
+            if frames is None:
+                break
+        return frames, infos
+
+
+class ReferenceStore:
+    """
+    Cache of correction references (dark and flat frames), kept in memory and persisted as .npy files.
+
+    References are identified by a key (tuple of values describing the acquisition settings they were taken with:
+    camera, ROI, binning, exposure...) which is also used as file name, so that they are reloaded in later sessions.
+
+    Parameters
+    ----------
+    directory: str or Path or None
+        Directory of the reference files, None to keep them in memory only
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._references = dict()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @directory.setter
+    def directory(self, directory):
+        self._directory = Path(directory) if directory else None
+
+    def path(self, key, kind):
+        """File of a reference"""
+        return self.directory / (f"{kind}_{'_'.join(str(value) for value in key)}.npy")
+
+    def get(self, key, kind):
+        """
+        Reference taken with the settings key, loaded from disk if it is not in memory
+
+        Parameters
+        ----------
+        key: tuple
+        kind: str
+            One of REFERENCE_KINDS
+
+        Returns
+        -------
+        numpy.array() or None: None if there is no such reference
+        """
+        if (key, kind) not in self._references and self.directory is not None and self.path(key, kind).is_file():
+            self._references[(key, kind)] = np.load(self.path(key, kind))
+        return self._references.get((key, kind))
+
+    def store(self, key, kind, reference):
+        """Keep a reference in memory and save it to disk (if a directory is set)"""
+        if kind not in REFERENCE_KINDS:
+            raise ValueError(f'Unknown reference {kind}, should be one of {REFERENCE_KINDS}')
+        self._references[(key, kind)] = reference
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            np.save(self.path(key, kind), reference)
+
+    def remove(self, key, kind):
+        """Forget a reference, and delete its file"""
+        self._references.pop((key, kind), None)
+        if self.directory is not None:
+            self.path(key, kind).unlink(missing_ok=True)
+
+
+def parse_regions(text):
+    """
+    Rectangular regions from a "x, y, width, height; x, y, width, height..." string
+
+    Returns
+    -------
+    list of tuple: (vstart, vend, hstart, hend) of each region
+    """
+    regions = []
+    for item in text.split(';'):
+        if not item.strip():
+            continue
+        values = [int(value) for value in item.replace(',', ' ').split()]
+        if len(values) != 4 or values[2] <= 0 or values[3] <= 0:
+            raise ValueError(f'Invalid region "{item.strip()}", should be x, y, width, height')
+        x, y, width, height = values
+        regions.append((y, y + height, x, x + width))
+    return regions
+
+
+class RoiStatistics:
+    """
+    Reduction of frame stacks to a few values per rectangular region: sum or mean, row and column projections and
+    intensity centroid, vectorized over the frames.
+
+    The profile along the vertical axis (sum of each row) is computed for every region and the sum is derived from
+    it, the profile along the horizontal axis being only computed (a second pass over the region) if projections or
+    centroids are requested.
+
+    Parameters
+    ----------
+    regions: list of tuple or None
+        (vstart, vend, hstart, hend) of each region (frame pixels, clipped to the frames), None for the whole frames
+    statistic: str
+        'sum' or 'mean' of the region pixels (also applies to the projections)
+    projections: bool
+        If True, compute the row and column projections of the regions
+    centroid: bool
+        If True, compute the intensity centroid of the regions
+    """
+
+    def __init__(self, regions=None, statistic='sum', projections=False, centroid=False):
+        if statistic not in ('sum', 'mean'):
+            raise ValueError(f'Unknown statistic {statistic}, should be sum or mean')
+        self.regions = regions
+        self.statistic = statistic
+        self.projections = projections
+        self.centroid = centroid
+
+    def bounds(self, frame_shape):
+        """(vstart, vend, hstart, hend) of the regions clipped to frames of shape (height, width)"""
+        height, width = frame_shape
+        bounds = []
+        for vstart, vend, hstart, hend in self.regions or [(0, height, 0, width)]:
+            vstart, hstart = min(max(vstart, 0), height), min(max(hstart, 0), width)
+            bounds.append((vstart, min(max(vend, vstart), height), hstart, min(max(hend, hstart), width)))
+        return bounds
+
+    def __call__(self, frames):
+        """
+        Reduce a stack of frames
+
+        Parameters
+        ----------
+        frames: numpy.array()
+            (n_frames, height, width) array
+
+        Returns
+        -------
+        list(dict): for each region, its 'bounds' and float64 arrays: 'value' (n_frames,), and if computed 'rows'
+            (n_frames, height) and 'columns' (n_frames, width) projections, 'centroid' (n_frames, 2) (y, x) in frame
+            pixels (NaN for frames without signal)
+        """
+        results = []
+        for vstart, vend, hstart, hend in self.bounds(frames.shape[1:]):
+            region = frames[:, vstart:vend, hstart:hend]
+            rows = region.sum(axis=2, dtype=np.float64)
+            total = rows.sum(axis=1)
+            result = dict(bounds=(vstart, vend, hstart, hend))
+            if self.projections or self.centroid:
+                columns = region.sum(axis=1, dtype=np.float64)
+            if self.centroid:
+                centroid = np.stack([rows @ np.arange(vstart, vend), columns @ np.arange(hstart, hend)], axis=1)
+                result['centroid'] = np.divide(centroid, total[:, np.newaxis], out=np.full(centroid.shape, np.nan),
+                                               where=total[:, np.newaxis] != 0)
+            if self.statistic == 'mean':
+                total /= max(region.shape[1] * region.shape[2], 1)
+                if self.projections:
+                    rows /= max(region.shape[2], 1)
+                    columns /= max(region.shape[1], 1)
+            result['value'] = total
+            if self.projections:
+                result['rows'] = rows
+                result['columns'] = columns
+            results.append(result)
+        return results
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming of camera frames to disk from a writer thread, decoupled from the acquisition
+
+Two file formats are available:
+
+* HDF5 (requires h5py): datasets 'frames' (n_frames, height, width), 'frame_index' and 'timestamps'
+* Raw: frames appended to a binary file through a memory map, frame indices, timestamps, shape and type of the frames
+  being saved in a .npz file next to it when the recording is closed
+"""
+
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:  # only needed for HDF5 recording
+    h5py = None
+
+RECORD_FORMATS = {'HDF5': '.h5', 'Raw': '.raw'}
+
+
+def frame_metadata(infos, n_frames, received):
+    """
+    Frame indices and timestamps from pylablib frame infos
+
+    Parameters
+    ----------
+    infos: list
+        pylablib frame info of each frame (None if not supported by the camera)
+    n_frames: int
+    received: float
+        Host time (s since epoch) at which the frames were read, used if the camera gives no timestamp
+
+    Returns
+    -------
+    indexes: numpy.array()
+        Frame indices (-1 if unknown)
+    timestamps: numpy.array()
+        Timestamps of the frames (s)
+    """
+    if len(infos) == n_frames and n_frames > 0 and infos[0] is not None:
+        indexes = np.array([info.frame_index for info in infos], dtype=np.int64)
+        timestamps = np.array([info.timestamp_us for info in infos], dtype=np.float64) * 1e-6
+    else:
+        indexes = np.full(n_frames, -1, dtype=np.int64)
+        timestamps = np.full(n_frames, received)
+    return indexes, timestamps
+
+
+class _HDF5Writer:
+    """Chunked HDF5 datasets (one frame per chunk), grown by blocks of frames"""
+
+    def __init__(self, path, frame_shape, dtype, block_frames):
+        self.block_frames = block_frames
+        self.count = 0
+        self.file = h5py.File(path, 'w')
+        self.frames = self.file.create_dataset('frames', shape=(block_frames,) + frame_shape,
+                                               maxshape=(None,) + frame_shape, chunks=(1,) + frame_shape,
+                                               dtype=dtype)
+        self.indexes = self.file.create_dataset('frame_index', shape=(block_frames,), maxshape=(None,),
+                                                dtype=np.int64)
+        self.timestamps = self.file.create_dataset('timestamps', shape=(block_frames,), maxshape=(None,),
+                                                   dtype=np.float64)
+
+    def _resize(self, size):
+        for dataset in (self.frames, self.indexes, self.timestamps):
+            dataset.resize(size, axis=0)
+
+    def write(self, frames, indexes, timestamps):
+        end = self.count + len(frames)
+        if end > len(self.frames):
+            self._resize(end + self.block_frames)
+        self.frames[self.count:end] = frames
+        self.indexes[self.count:end] = indexes
+        self.timestamps[self.count:end] = timestamps
+        self.count = end
+
+    def close(self):
+        self._resize(self.count)
+        self.file.close()
+
+
+class _RawWriter:
+    """Raw binary file written through a memory map, grown by blocks of frames"""
+
+    def __init__(self, path, frame_shape, dtype, block_frames):
+        self.path = Path(path)
+        self.frame_shape = frame_shape
+        self.dtype = np.dtype(dtype)
+        self.block_frames = block_frames
+        self.count = 0
+        self.capacity = 0
+        self.file = open(self.path, 'w+b')
+        self.map = None
+        self.indexes = []
+        self.timestamps = []
+
+    def _resize(self, capacity):
+        if self.map is not None:
+            self.map.flush()
+            self.map = None
+        self.file.truncate(capacity * self.dtype.itemsize * int(np.prod(self.frame_shape)))
+        self.capacity = capacity
+        if capacity > 0:
+            self.map = np.memmap(self.file, dtype=self.dtype, mode='r+', shape=(capacity,) + self.frame_shape)
+
+    def write(self, frames, indexes, timestamps):
+        end = self.count + len(frames)
+        if end > self.capacity:
+            self._resize(end + self.block_frames)
+        self.map[self.count:end] = frames
+        self.indexes.append(indexes)
+        self.timestamps.append(timestamps)
+        self.count = end
+
+    def close(self):
+        self._resize(self.count)
+        self.map = None
+        self.file.close()
+        np.savez(self.path.with_suffix('.npz'), shape=np.array(self.frame_shape), dtype=str(self.dtype),
+                 frame_index=np.concatenate(self.indexes) if self.indexes else np.zeros(0, dtype=np.int64),
+                 timestamps=np.concatenate(self.timestamps) if self.timestamps else np.zeros(0))
+
+
+def read_recording(path):
+    """
+    Read a file written by FrameRecorder
+
+    Returns
+    -------
+    frames: numpy.array()
+        (n_frames, height, width) array, memory-mapped for raw files
+    indexes: numpy.array()
+    timestamps: numpy.array()
+    """
+    path = Path(path)
+    if path.suffix == RECORD_FORMATS['Raw']:
+        metadata = np.load(path.with_suffix('.npz'))
+        shape = tuple(metadata['shape'])
+        n_frames = len(metadata['frame_index'])
+        frames = np.memmap(path, dtype=np.dtype(str(metadata['dtype'])), mode='r', shape=(n_frames,) + shape) \
+            if n_frames > 0 else np.zeros((0,) + shape, dtype=np.dtype(str(metadata['dtype'])))
+        return frames, metadata['frame_index'], metadata['timestamps']
+    if h5py is None:
+        raise ImportError('h5py is required to read HDF5 recordings')
+    with h5py.File(path, 'r') as file:
+        return file['frames'][()], file['frame_index'][()], file['timestamps'][()]
+
+
+class FrameRecorder:
+    """
+    Write frames to disk in a writer thread.
+
+    put() is meant to be called by the acquisition thread (as an AcquisitionLoop consumer): it only queues the frames
+    and never blocks. If the writer cannot keep up and the queue is full, frames are dropped (and counted) rather than
+    slowing down the acquisition.
+
+    Parameters
+    ----------
+    path: str or Path
+        File to write (overwritten)
+    frame_shape: tuple of int
+        (height, width) of the frames
+    dtype: numpy.dtype
+        Type of the frames
+    file_format: str
+        One of RECORD_FORMATS ('HDF5' or 'Raw')
+    max_queued_frames: int
+        Maximum number of frames waiting to be written
+    block_frames: int
+        File space is preallocated by blocks of this number of frames
+
+    Attributes
+    ----------
+    frames_written: int
+    bytes_written: int
+    dropped: int
+        Frames not recorded because the queue was full
+    error: Exception or None
+        Error of the writer thread, which then stops recording
+    """
+
+    def __init__(self, path, frame_shape, dtype=np.uint16, file_format='HDF5', max_queued_frames=1000,
+                 block_frames=256):
+        if file_format not in RECORD_FORMATS:
+            raise ValueError(f'Unknown recording format {file_format}, should be one of {list(RECORD_FORMATS)}')
+        if file_format == 'HDF5' and h5py is None:
+            raise ImportError('h5py is required to record HDF5 files')
+        self.path = Path(path)
+        self.frame_shape = tuple(frame_shape)
+        self.max_queued_frames = max_queued_frames
+        writer_class = _HDF5Writer if file_format == 'HDF5' else _RawWriter
+        self._writer = writer_class(self.path, self.frame_shape, np.dtype(dtype), block_frames)
+
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.dropped = 0
+        self.error = None
+        self._queue = deque()
+        self._queued_frames = 0
+        self._closing = False
+        self._condition = threading.Condition()
+        self._start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='DCAMRecorder', daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        """Number of frames waiting to be written"""
+        return self._queued_frames
+
+    @property
+    def throughput(self):
+        """Average write rate since the start of the recording (MB/s)"""
+        return self.bytes_written / max(time.perf_counter() - self._start_time, 1e-9) / 1e6
+
+    def put(self, frames, infos=()):
+        """
+        Queue frames to be written, without blocking
+
+        Parameters
+        ----------
+        frames: numpy.array()
+            (n_frames, height, width) array, should not be modified afterwards
+        infos: list
+            pylablib frame info of each frame
+
+        Returns
+        -------
+        bool: False if the frames were dropped
+        """
+        with self._condition:
+            if self._closing or self.error is not None \
+                    or self._queued_frames + len(frames) > self.max_queued_frames:
+                self.dropped += len(frames)
+                return False
+            self._queue.append((frames, infos, time.time()))
+            self._queued_frames += len(frames)
+            self._condition.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._closing)
+                if not self._queue:  # closing, and everything was written
+                    break
+                frames, infos, received = self._queue.popleft()
+            try:
+                if frames.shape[1:] != self.frame_shape:
+                    raise ValueError(f'Frame shape {frames.shape[1:]} differs from the recorded one {self.frame_shape}')
+                self._writer.write(frames, *frame_metadata(infos, len(frames), received))
+            except Exception as e:
+                self.error = e
+                with self._condition:
+                    self.dropped += self._queued_frames
+                    self._queue.clear()
+                    self._queued_frames = 0
+                break
+            with self._condition:
+                self._queued_frames -= len(frames)
+            self.frames_written += len(frames)
+            self.bytes_written += frames.nbytes
+
+    def close(self):
+        """Write the queued frames and close the file"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        self._writer.close()
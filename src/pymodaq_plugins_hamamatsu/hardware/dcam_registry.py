@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Cached, on-demand enumeration of the connected DCAM cameras
+
+The DCAM API is only initialized when the camera list is first requested (not when plugins are imported),
+and the result is kept until an explicit refresh.
+"""
+
+import threading
+from collections import namedtuple
+
+import pylablib as pll
+pll.par["devices/dlls/dcamapi"] = "C:/Windows/System32"
+from pylablib.core.utils import py3
+from pylablib.devices.DCAM import DCAMError, dcamapi4_lib
+from pylablib.devices.DCAM.DCAM import lib, libctl
+
+CameraInfo = namedtuple('CameraInfo', ['index', 'model', 'serial_number'])
+
+
+class CameraRegistry:
+    """
+    Lazily populated cache of the connected DCAM cameras
+
+    Methods
+    -------
+    cameras(refresh)
+        List of CameraInfo (index, model, serial number), enumerated on first call or on refresh.
+    get(index)
+        CameraInfo of a given camera index.
+    """
+
+    def __init__(self):
+        self._cameras = None
+        self._lock = threading.Lock()
+
+    def cameras(self, refresh=False):
+        """
+        Get the connected cameras
+
+        Parameters
+        ----------
+        refresh: bool
+            If True, enumerate cameras again (DCAM API initialization), otherwise use the cached list
+
+        Returns
+        -------
+        cameras: list(CameraInfo)
+        """
+        with self._lock:
+            if self._cameras is None or refresh:
+                self._cameras = self._enumerate()
+            return list(self._cameras)
+
+    def refresh(self):
+        """Enumerate the cameras again"""
+        return self.cameras(refresh=True)
+
+    def get(self, index):
+        """CameraInfo of the camera with this index, raise IndexError if not connected"""
+        cameras = self.cameras()
+        if not 0 <= index < len(cameras):
+            raise IndexError(f'No DCAM camera with index {index} ({len(cameras)} camera(s) found)')
+        return cameras[index]
+
+    def __len__(self):
+        return len(self.cameras())
+
+    @staticmethod
+    def _enumerate():
+        cameras = []
+        try:
+            with libctl.temp_open():
+                for index in range(libctl.cameras):
+                    cameras.append(CameraInfo(index, *CameraRegistry._read_strings(index)))
+        except (DCAMError, OSError):  # no DCAM API or no camera
+            pass
+        return cameras
+
+    @staticmethod
+    def _read_strings(index):
+        """Model and serial number of a camera, read from its index (without opening the camera)"""
+        try:
+            model = lib.dcamdev_getstring(index, dcamapi4_lib.DCAM_IDSTR.DCAM_IDSTR_MODEL)
+            serial_number = lib.dcamdev_getstring(index, dcamapi4_lib.DCAM_IDSTR.DCAM_IDSTR_CAMERAID)
+            return py3.as_str(model), py3.as_str(serial_number)
+        except DCAMError:
+            return '', ''
+
+
+camera_registry = CameraRegistry()
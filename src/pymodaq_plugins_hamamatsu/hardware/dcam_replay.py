@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Recording of the frames read from a DCAM camera to a stream file, and replay of such a recording with the
+DCAM.DCAMCamera API, to reproduce an acquisition (frames, frame rate) on a machine without the camera
+"""
+
+import threading
+import time
+
+import numpy as np
+from pylablib.devices.DCAM.DCAM import DCAMTimeoutError, TDeviceInfo, TFrameInfo
+from pylablib.devices.interface.camera import TFramePosition, TFramesStatus
+
+from pymodaq_plugins_hamamatsu.hardware.stream_file import StreamWriter, StreamReader, ReplayClock
+
+# Methods of the camera changing its configuration, recorded with their arguments
+RECORDED_CALLS = ('set_exposure', 'set_roi', 'set_attribute_value', 'setup_acquisition', 'clear_acquisition',
+                  'start_acquisition', 'stop_acquisition')
+
+
+class RecordingDCAMCamera:
+    """
+    Wrapper of a DCAM.DCAMCamera saving the frames read, with their frame index and timing, and the configuration
+    changes to a stream file. Everything else is forwarded to the wrapped camera.
+
+    Frames are timed by their driver timestamp, so that frames read together keep their acquisition intervals. Only
+    the frames read are recorded: in "Live" mode, frames acquired between two displays are not.
+
+    Parameters
+    ----------
+    camera: DCAM.DCAMCamera
+        Opened camera
+    path: str or Path
+        Stream file to write
+    """
+
+    def __init__(self, camera, path):
+        self.camera = camera
+        device_info = camera.get_device_info()
+        self.writer = StreamWriter(path, dict(device_info=device_info._asdict(),
+                                              detector_size=camera.get_detector_size(), roi=camera.get_roi(),
+                                              exposure=camera.get_exposure()))
+        self._timestamp_offset = None  # from the driver timestamps to the recording time
+
+    def __getattr__(self, name):
+        attribute = getattr(self.camera, name)
+        if name in RECORDED_CALLS:
+            def recorded(*args, **kwargs):
+                result = attribute(*args, **kwargs)
+                self.writer.write_call(name, args=args, **kwargs)
+                return result
+            return recorded
+        return attribute
+
+    def _record(self, frames, infos):
+        elapsed = self.writer.elapsed()
+        for frame, info in zip(frames, infos):
+            if info is None:
+                self.writer.write_data(frame, elapsed=elapsed)
+                continue
+            if self._timestamp_offset is None:
+                self._timestamp_offset = elapsed - info.timestamp_us * 1e-6
+            self.writer.write_data(frame, info.frame_index, info.timestamp_us * 1e-6 + self._timestamp_offset)
+
+    def read_multiple_images(self, rng=None, peek=False, missing_frame='skip', return_info=False, return_rng=False):
+        """Read frames, see DCAM.DCAMCamera.read_multiple_images, and record them (unless peeking)"""
+        result = self.camera.read_multiple_images(rng=rng, peek=peek, missing_frame=missing_frame, return_info=True,
+                                                  return_rng=True)
+        if result is None:
+            return None
+        frames, infos, rng = result
+        if not peek:
+            self._record([frame for chunk in frames for frame in (chunk[np.newaxis] if chunk.ndim == 2 else chunk)],
+                         infos)
+        result = (frames,) + ((infos,) if return_info else ()) + ((rng,) if return_rng else ())
+        return result if len(result) > 1 else frames
+
+    def read_newest_image(self, peek=False, return_info=False):
+        """Read the newest frame, see DCAM.DCAMCamera.read_newest_image, and record it (unless peeking)"""
+        result = self.camera.read_newest_image(peek=peek, return_info=True)
+        if result is None:
+            return None
+        if not peek:
+            self._record([result[0]], [result[1]])
+        return result if return_info else result[0]
+
+    def close(self):
+        """Close the camera and the recording"""
+        self.writer.close()
+        self.camera.close()
+
+
+class DCAMCameraReplay:
+    """
+    Replay of a recorded frame stream, with the DCAM.DCAMCamera API used by the acquisition loop and the plugin
+
+    Frames are "acquired" into a virtual ring buffer at their recorded intervals divided by the speed, from the start
+    of the acquisition, whether they are read or not: a slow reader loses frames as with the camera. The recording is
+    looped over, frame indices keep increasing. Only the frames with the format (size, type) of the first recorded
+    one are replayed, whatever the ROI set: device information, ROI and exposure are the recorded ones (when the
+    first frame was acquired), and changes only update what is reported.
+
+    Parameters
+    ----------
+    path: str or Path
+        Stream file recorded by RecordingDCAMCamera
+    speed: float
+        Replay speed (1: original rate), 0 to acquire frames as fast as they are read (full buffer at each read)
+    loop: bool
+        If False, no frame is acquired after the last recorded one
+    """
+    Error = RuntimeError
+    TimeoutError = DCAMTimeoutError
+
+    def __init__(self, path, speed=1., loop=True):
+        self.reader = StreamReader(path)
+        if len(self.reader) == 0:
+            raise ValueError(f'No frame in {self.reader.path}')
+        self.frame_format = self.reader.formats[0]
+        self._indices = self.reader.select(*self.frame_format)
+        self.clock = ReplayClock(self.reader.times[self._indices], speed, loop)
+        self._frames = self.reader.stack(self._indices)
+
+        metadata = self.reader.metadata
+        self._device_info = TDeviceInfo(**metadata['device_info'])
+        self._detector_size = tuple(metadata['detector_size'])
+        self._roi = tuple(metadata['roi'])
+        self._exposure = metadata['exposure']
+        self._attributes = dict()
+        for elapsed, name, kwargs in self.reader.calls:
+            if elapsed <= self.reader.times[0] and name in ('set_exposure', 'set_roi'):
+                kwargs = dict(kwargs)
+                getattr(self, name)(*kwargs.pop('args'), **kwargs)
+
+        self._lock = threading.Lock()
+        self._nframes = 100
+        self._setup = False
+        self._running = False
+        self._start = 0.
+        self._start_epoch = 0.
+        self._acquired = 0  # frozen count when the acquisition is stopped
+        self._read = 0
+
+    def get_device_info(self):
+        return self._device_info
+
+    def get_detector_size(self):
+        return self._detector_size
+
+    def get_roi(self):
+        return self._roi
+
+    def set_roi(self, hstart=0, hend=None, vstart=0, vend=None, hbin=1, vbin=1):
+        """Set the reported ROI (frames are replayed as recorded)"""
+        width, height = self._detector_size
+        self._roi = (hstart, width if hend is None else hend, vstart, height if vend is None else vend, hbin, vbin)
+        return self._roi
+
+    def _get_data_dimensions_rc(self):
+        return self.frame_format[1]
+
+    def get_data_dimensions(self):
+        return self.frame_format[1]
+
+    def get_exposure(self):
+        return self._exposure
+
+    def set_exposure(self, exposure):
+        """Set the reported exposure (frames are replayed at their recorded rate)"""
+        self._exposure = exposure
+        return exposure
+
+    def get_attribute_value(self, name, *args, **kwargs):
+        return self._attributes.get(name)
+
+    def set_attribute_value(self, name, value, *args, **kwargs):
+        self._attributes[name] = value
+        return value
+
+    def _acquired_frames(self):
+        if not self._running:
+            return self._acquired
+        if self.clock.speed == 0:
+            return min(self._read + self._nframes, self.clock.count(0))
+        return self.clock.count(time.perf_counter() - self._start)
+
+    def acquisition_in_progress(self):
+        return self._running
+
+    def setup_acquisition(self, mode='sequence', nframes=100):
+        self._nframes = nframes
+        self._setup = True
+
+    def clear_acquisition(self):
+        self.stop_acquisition()
+        self._setup = False
+
+    def start_acquisition(self, *args, nframes=None, **kwargs):
+        self.stop_acquisition()
+        if nframes is not None:
+            self._nframes = nframes
+        with self._lock:
+            self._setup = True
+            self._acquired = self._read = 0
+            self._start = time.perf_counter()
+            self._start_epoch = time.time()
+            self._running = True
+
+    def stop_acquisition(self):
+        with self._lock:
+            if self._running:
+                self._acquired = self._acquired_frames()
+                self._running = False
+
+    def get_frames_status(self):
+        with self._lock:
+            acquired = self._acquired_frames()
+            unread = acquired - self._read
+            return TFramesStatus(acquired, min(unread, self._nframes), max(0, unread - self._nframes), self._nframes)
+
+    def get_new_images_range(self):
+        with self._lock:
+            if not self._setup:
+                return None
+            acquired = self._acquired_frames()
+            first = max(self._read, acquired - self._nframes)
+            return (first, acquired) if acquired > first else None
+
+    def wait_for_frame(self, since='lastread', nframes=1, timeout=20.):
+        """Wait for nframes new frames since the last read, return False if the acquisition is not running"""
+        if not self._running:
+            return False
+        target = self._read + nframes
+        if self._acquired_frames() >= target:
+            return True
+        if not self.clock.loop and target > self.clock.size:
+            ready = float('inf')
+        else:
+            ready = self._start + self.clock.time(target - 1)
+        timeout = timeout[0] if isinstance(timeout, tuple) else timeout
+        delay = ready - time.perf_counter()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise self.TimeoutError('Timeout while waiting for a replayed frame')
+        time.sleep(max(delay, 0.))
+        return self._running
+
+    def _frame_info(self, index):
+        timestamp = time.time() if self.clock.speed == 0 else self._start_epoch + self.clock.time(index)
+        return TFrameInfo(index, index, int(timestamp * 1e6), index, TFramePosition(0, 0), 'mono16')
+
+    def read_multiple_images(self, rng=None, peek=False, missing_frame='skip', return_info=False, return_rng=False):
+        """
+        Read frames from the virtual buffer, see DCAM.DCAMCamera.read_multiple_images
+
+        Frames are returned as a single (n_frames, height, width) chunk.
+        """
+        with self._lock:
+            if not self._setup:
+                return None
+            acquired = self._acquired_frames()
+            first, last = (self._read, acquired) if rng is None else rng
+            first, last = max(first, acquired - self._nframes), min(last, acquired)
+            last = max(first, last)
+            records = np.arange(first, last) % self.clock.size
+            if self._frames is not None:
+                chunk = self._frames[records]
+            else:
+                chunk = np.array([self.reader[self._indices[record]] for record in records]).reshape(
+                    (len(records),) + self.frame_format[1])
+            if not peek:
+                self._read = max(self._read, last)
+        frames = [chunk] if len(chunk) else []
+        result = (frames,)
+        if return_info:
+            result += ([self._frame_info(index) for index in range(first, last)],)
+        if return_rng:
+            result += ((first, last),)
+        return result if len(result) > 1 else frames
+
+    def read_newest_image(self, peek=False, return_info=False):
+        """Read the newest frame, see DCAM.DCAMCamera.read_newest_image"""
+        acquired = self._acquired_frames()
+        if acquired <= self._read:
+            return None
+        frames, infos = self.read_multiple_images(rng=(acquired - 1, acquired), peek=peek, return_info=True)
+        if not frames:
+            return None
+        return (frames[0][0], infos[0]) if return_info else frames[0][0]
+
+    def close(self):
+        self.stop_acquisition()
+        self.reader.close()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Matching of the frames of several DCAM cameras acquired side by side (stereo, multi-colour imaging)
+"""
+
+from collections import deque
+
+MATCH_KEYS = ('frame_index', 'timestamp')
+
+
+class FrameMatcher:
+    """
+    Pair the frames of several cameras by driver frame index or by timestamp.
+
+    Frames are added, camera by camera, as they are read by the acquisition threads, and the last max_pending frames
+    of each camera are kept until a set with one frame of each camera is complete. The newest complete set is then
+    returned, and all the frames up to it are discarded (frames older than a matched set cannot be matched anymore).
+
+    Frame indices match when the cameras are started together and triggered by the same signal, timestamps (host
+    time of the frames, as given by the driver) match within a tolerance otherwise.
+
+    Calls from several threads should be serialized by the caller.
+
+    Parameters
+    ----------
+    n_cameras: int
+    key: str
+        One of MATCH_KEYS
+    tolerance: float
+        Maximum difference between the timestamps of the frames of a set (s), if matched by timestamp
+    max_pending: int
+        Number of frames kept per camera while waiting for the frames of the other cameras
+
+    Attributes
+    ----------
+    matched: int
+        Number of sets returned since the last reset
+    """
+
+    def __init__(self, n_cameras, key='frame_index', tolerance=1e-3, max_pending=16):
+        if key not in MATCH_KEYS:
+            raise ValueError(f'Unknown matching key {key}, should be one of {MATCH_KEYS}')
+        self.n_cameras = n_cameras
+        self.key = key
+        self.tolerance = tolerance
+        self.max_pending = max_pending
+        self.reset()
+
+    def reset(self):
+        """Discard the pending frames (new acquisition)"""
+        self._pending = [deque(maxlen=self.max_pending) for _ in range(self.n_cameras)]
+        self.matched = 0
+
+    def _key(self, info):
+        return info.frame_index if self.key == 'frame_index' else info.timestamp_us * 1e-6
+
+    def add(self, camera, frames, infos):
+        """
+        Add frames of a camera, and look for a complete set
+
+        Parameters
+        ----------
+        camera: int
+            Index of the camera
+        frames: numpy.array()
+            (n_frames, height, width) array, kept until matched or discarded
+        infos: list
+            pylablib frame info of each frame
+
+        Returns
+        -------
+        list(tuple) or None: (frame, info) of each camera for the newest complete set, None if there is none
+        """
+        for frame, info in zip(frames, infos):
+            self._pending[camera].append((self._key(info), frame, info))
+        return self._match()
+
+    def _match(self):
+        if not all(self._pending):
+            return None
+        for key, frame, info in reversed(self._pending[0]):  # newest first
+            selected = [(key, frame, info)]
+            for pending in self._pending[1:]:
+                candidate = min(pending, key=lambda item: abs(item[0] - key))
+                if abs(candidate[0] - key) > (0 if self.key == 'frame_index' else self.tolerance):
+                    break
+                selected.append(candidate)
+            else:
+                for pending, (matched_key, *_) in zip(self._pending, selected):
+                    while pending and pending[0][0] <= matched_key:
+                        pending.popleft()
+                self.matched += 1
+                return [(frame, info) for _, frame, info in selected]
+        return None
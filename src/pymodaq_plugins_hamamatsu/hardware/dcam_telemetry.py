@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Acquisition telemetry: camera and display frame rates, frame latency, buffer fill and lost frames
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# name and unit of the telemetry values, in the order they are emitted
+TELEMETRY_CHANNELS = {'camera_fps': 'Hz',
+                      'display_fps': 'Hz',
+                      'latency_median': 'ms',
+                      'latency_p95': 'ms',
+                      'latency_max': 'ms',
+                      'buffer_fill': '%',
+                      'skipped_frames': '',
+                      'dropped_frames': ''}
+
+
+class AcquisitionTelemetry:
+    """
+    Statistics on the flow of frames from the camera to the display
+
+    The camera frame rate is computed from the driver frame counter (not from the emitted frames), the display rate
+    from the emissions. The latency is the time between the end of the wait for a frame (in the acquisition thread)
+    and its emission.
+
+    update_status() is called by the acquisition thread, add_emission() and snapshot() by the plugin.
+
+    Parameters
+    ----------
+    window: float
+        Duration over which the rates are computed (s)
+    history: int
+        Number of latencies kept for the distribution
+    """
+
+    def __init__(self, window=1., history=500):
+        self.window = window
+        self.history = history
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all the statistics (new acquisition)"""
+        with self._lock:
+            self._acquired = deque()  # (time, driver frame counter)
+            self._emissions = deque()  # (time, emission counter)
+            self._emitted = 0
+            self._latencies = deque(maxlen=self.history)
+            self.buffer_fill = 0.
+            self.skipped_frames = 0
+            self.dropped_frames = 0
+
+    def _add_sample(self, samples, now, count):
+        """Add a counter sample to a window of samples"""
+        if samples and count < samples[-1][1]:  # counter was reset (acquisition restarted)
+            samples.clear()
+        samples.append((now, count))
+        while len(samples) > 2 and now - samples[0][0] > self.window:
+            samples.popleft()
+
+    @staticmethod
+    def _window_rate(samples):
+        if len(samples) < 2 or samples[-1][0] == samples[0][0]:
+            return 0.
+        return (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+
+    def update_status(self, status, dropped=0, now=None):
+        """
+        Update the camera statistics
+
+        Parameters
+        ----------
+        status: TFramesStatus
+            pylablib frame counters (acquired, unread, skipped, buffer_size)
+        dropped: int
+            Frames lost as counted by the FrameTracker
+        now: float or None
+            perf_counter time of the status
+        """
+        now = time.perf_counter() if now is None else now
+        with self._lock:
+            self._add_sample(self._acquired, now, status.acquired)
+            self.buffer_fill = 100 * status.unread / status.buffer_size if status.buffer_size else 0.
+            self.skipped_frames = status.skipped
+            self.dropped_frames = dropped
+
+    def add_emission(self, ready_time, now=None):
+        """
+        Account for an emission of data
+
+        Parameters
+        ----------
+        ready_time: float
+            perf_counter time at which the emitted frames were available
+        now: float or None
+            perf_counter time of the emission
+        """
+        now = time.perf_counter() if now is None else now
+        with self._lock:
+            self._emitted += 1
+            self._add_sample(self._emissions, now, self._emitted)
+            self._latencies.append(now - ready_time)
+
+    def snapshot(self):
+        """
+        Current telemetry values
+
+        Returns
+        -------
+        dict: values of TELEMETRY_CHANNELS
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000 if self._latencies else np.zeros(1)
+            return {'camera_fps': self._window_rate(self._acquired),
+                    'display_fps': self._window_rate(self._emissions),
+                    'latency_median': float(np.median(latencies)),
+                    'latency_p95': float(np.percentile(latencies, 95)),
+                    'latency_max': float(latencies.max()),
+                    'buffer_fill': self.buffer_fill,
+                    'skipped_frames': self.skipped_frames,
+                    'dropped_frames': self.dropped_frames}
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to exchange data between .NET (pythonnet) and numpy
+"""
+
+import ctypes
+
+import clr  # noqa: F401 (loads the .NET runtime)
+import System
+from System.Runtime.InteropServices import GCHandle, GCHandleType
+import numpy as np
+
+
+def dotnet_to_numpy(src, dest=None, dtype=np.uint16):
+    """
+    Copy a .NET array into a numpy array with a single block copy.
+
+    Converting with np.array(src) iterates over the .NET array element by element through pythonnet. Here the .NET
+    array is pinned in memory and its content copied at once.
+
+    Parameters
+    ----------
+    src: System.Array
+        1D .NET array of a blittable type (System.UInt16 for sensor data)
+    dest: numpy.array() or None
+        Preallocated destination array of type dtype, with the same length as src. If None a new array is allocated.
+    dtype: numpy.dtype
+        Type of the destination array, its item size should match the one of the src elements
+
+    Returns
+    -------
+    dest: numpy.array()
+        Array holding a copy of src
+    """
+    if dest is None:
+        dest = np.empty(src.Length, dtype=dtype)
+    elif dest.dtype != np.dtype(dtype) or dest.size != src.Length or not dest.flags.c_contiguous:
+        raise ValueError(f'Destination array should be a contiguous {np.dtype(dtype)} array with {src.Length} '
+                         f'elements')
+    if dest.nbytes != System.Buffer.ByteLength(src):  # copying more than the .NET buffer would read past its end
+        raise ValueError(f'Item size of {dest.dtype} does not match the elements of {src.GetType()}')
+
+    handle = GCHandle.Alloc(src, GCHandleType.Pinned)
+    try:
+        ptr = handle.AddrOfPinnedObject().ToInt64()
+        ctypes.memmove(dest.ctypes.data, ptr, dest.nbytes)
+    finally:
+        handle.Free()
+    return dest
+
+
+def numpy_to_dotnet(src, net_type=System.UInt16):
+    """
+    Build a .NET array from a numpy array with a single block copy.
+
+    Parameters
+    ----------
+    src: numpy.array()
+        1D array, its item size should match net_type
+    net_type: System type
+        Type of the .NET array elements
+
+    Returns
+    -------
+    dest: System.Array
+    """
+    src = np.ascontiguousarray(src)
+    dest = System.Array.CreateInstance(net_type, src.size)
+    handle = GCHandle.Alloc(dest, GCHandleType.Pinned)
+    try:
+        ptr = handle.AddrOfPinnedObject().ToInt64()
+        ctypes.memmove(ptr, src.ctypes.data, src.nbytes)
+    finally:
+        handle.Free()
+    return dest
@@ -5,26 +5,118 @@ Created on Mon Nov 25 14:20:19 2024
 @author: Bastien Bégon
 """
 
-import clr
 import sys
+import threading
+from collections import namedtuple
+
+import numpy as np
+from pymodaq.utils.logger import set_logger, get_module_name
+
+logger = set_logger(get_module_name(__file__))
 
 driver_dir = r"C:\\Program Files\\Hamamatsu\\TokuSpec"  # Path to specu1b.dll file folder
-sys.path.append(driver_dir)
 
-clr.AddReference("specu1b")
+# The .NET driver is only loaded on first use (see load_driver), so that importing this module is cheap and
+# does not require pythonnet nor the driver.
+DLL = None
+UNIT_PARAMETER = None
+UNIT_INFORMATION = None
+dotnet_utils = None
+_driver_lock = threading.Lock()
 
-from specu1b_DLL import specu1b, UNIT_PARAMETER, UNIT_INFORMATION
+DeviceInfo = namedtuple('DeviceInfo', ['pid', 'serial_number'])
+_devices = None  # cached result of list_devices
+_opened_pids = set()  # the driver opens devices by PID: a PID can only be opened once
 
-import usb.core
-import usb.util
 
-import time
-import numpy as np
-import System
+def load_driver():
+    """
+    Load the specu1b .NET driver on first call, and return the driver instance shared by all devices.
+    """
+    global DLL, UNIT_PARAMETER, UNIT_INFORMATION, dotnet_utils
+    with _driver_lock:
+        if DLL is None:
+            import clr
+            if driver_dir not in sys.path:
+                sys.path.append(driver_dir)
+            clr.AddReference("specu1b")
+            from specu1b_DLL import specu1b, UNIT_PARAMETER as unit_parameter, UNIT_INFORMATION as unit_information
+            from pymodaq_plugins_hamamatsu.hardware import dotnet_utils as utils
+
+            UNIT_PARAMETER, UNIT_INFORMATION, dotnet_utils = unit_parameter, unit_information, utils
+            DLL = specu1b()
+    return DLL
+
+
+def calibrated_axes(sensor_size, calibration_list, lower_wl, upper_wl):
+    """
+    Pixel and wavelength axes of a device, computed once per calibration
+
+    Parameters
+    ----------
+    sensor_size: int
+    calibration_list: list(float)
+        A, B1...B5 calibration coefficients, λ(nm) = A + B1*pix + ... + B5*pix⁵
+    lower_wl, upper_wl: float
+        Spectral range, giving a linear axis if the device holds no calibration (all coefficients zero)
+
+    Returns
+    -------
+    pixel_array: numpy.array()
+        Read only pixel indices (float)
+    wl_array: numpy.array()
+        Read only wavelength of each pixel (nm)
+    """
+    pixel_array = np.arange(sensor_size, dtype=float)
+    if any(calibration_list):
+        wl_array = np.polynomial.polynomial.polyval(pixel_array, calibration_list)
+    else:
+        wl_array = np.linspace(lower_wl, upper_wl, sensor_size)
+    pixel_array.flags.writeable = False
+    wl_array.flags.writeable = False
+    return pixel_array, wl_array
+
+
+def set_parameter_attributes(device, integration_time, gain, trigger_edge, trigger_mode, reserved_param=0):
+    """Set the parameter attributes of a device (see MiniSpectro.get_parameter) from the raw parameter values"""
+    device.integration_time = integration_time
+    device.gain = hex(gain)
+    device.trigger_edge = hex(trigger_edge)
+    device.trigger_mode = hex(trigger_mode)
+    device.reserved_param = reserved_param
+
+
+def list_devices(refresh=False):
+    """
+    List connected Mini-spectrometers. The USB scan is done once and cached.
+
+    We make the assumption only Mini-spectrometers devices have a pid starting with 0x290.
+
+    Parameters
+    ----------
+    refresh: bool
+        If True, scan the USB devices again.
+
+    Returns
+    -------
+    devices: list(DeviceInfo)
+        pid and USB serial number (None if it could not be read) of each device
+    """
+    global _devices
+    if _devices is None or refresh:
+        import usb.core
+        import usb.util
+
+        devices = []
+        for dev in usb.core.find(find_all=True, custom_match=lambda d: hex(d.idProduct).find("0x290") == 0):
+            try:
+                serial_number = usb.util.get_string(dev, dev.iSerialNumber) if dev.iSerialNumber else None
+            except (usb.core.USBError, ValueError, NotImplementedError):  # e.g. insufficient permissions
+                serial_number = None
+            devices.append(DeviceInfo(dev.idProduct, serial_number))
+        _devices = devices
+    return list(_devices)
 
-DLL = specu1b()
-unit_param = UNIT_PARAMETER()
-unit_info = UNIT_INFORMATION()
 
 class MiniSpectro:
     """
@@ -32,10 +124,10 @@ class MiniSpectro:
     
     Methods
     -------
-    get_parameter()
-        Get currently set parameters (integration time, gain, trigger modes).
+    get_parameter(refresh)
+        Get currently set parameters (integration time, gain, trigger modes), from the local copy or the device.
     set_parameter(integ_time, gain, trigger_edge, trigger_mode)
-        Set specified parameter with specified value.
+        Set any subset of the parameters with a single write to the device.
     set_default()
         Set all parameters to default.
     read_unit_information()
@@ -43,27 +135,39 @@ class MiniSpectro:
     write_unit_information()
         Write information into USB device.
     read_calibration_value()
-        Write calibration values with original values.
+        Read calibration coefficients and update the cached pixel and wavelength axes.
     get_sensor_data()
         Get sensor data currently in buffer and wipe buffer.
     close()
         Close device.
-    """
-    
-    def __init__(self):
-        for dev in usb.core.find(find_all=True):
-            if hex(dev.idProduct).find("0x290") == 0:       # We make the assumption only Mini-spectrometers
-                print("Hamamatsu Mini-spectrometer found")  # devices have a pid starting with 0x290
-                pid = dev.idProduct
 
-        self._handle = DLL.USB_OpenDevice(pid)  # Get index of spectrometer from pid
+    Attributes
+    ----------
+    pixel_array: numpy.array()
+        1D pixel array of device sensor (read only, cached)
+    wl_array: numpy.array()
+        1D calibrated wavelength array, λ(pix) from the calibration coefficients (read only, cached)
 
-        if DLL.USB_CheckDevice(self._handle) == 11:
-            print('Check connection success')
-        else:
-            raise ValueError('Check connection failed, please close or reconnect device')
+    Parameters
+    ----------
+    serial_number: str or None
+        Serial number of the device to open. If None, the device is selected by pid.
+    pid: int or None
+        USB product ID of the device to open. If both are None, the first device found is opened.
+    """
 
-        self._pipe = DLL.USB_OpenPipe(self._handle)
+    def __init__(self, serial_number=None, pid=None):
+        load_driver()
+        import System
+
+        if pid is None:
+            pid = self._find_pid(serial_number)
+        self._open(pid)
+        self._unit_info = UNIT_INFORMATION()
+        self.read_unit_information()
+        if serial_number is not None and self.serial_number.strip('\x00 ') != serial_number:
+            self.close()
+            raise ValueError(f'Device with pid {hex(pid)} has serial number {self.serial_number}, not {serial_number}')
 
         self._c_array = System.Array[System.Double]([0.0 for _ in range(6)])    # 6 calibration values
         self._origin_c_array = System.Array[System.Double]([206.6901787,        # Values from TokusPec at 1st boot
@@ -73,16 +177,73 @@ class MiniSpectro:
                                                             5.788371505e-12,
                                                             -1.2738255e-15])
         
-        self.read_unit_information()
-        self.get_parameter()
+        self._unit_param = UNIT_PARAMETER()  # Local copy of the device parameters
+        self.get_parameter(refresh=True)
         self.read_calibration_value()
 
-        self.buffer_array = System.Array[System.UInt16]([0 for _ in range(self.sensor_size)])
+        self.buffer_array = dotnet_utils.numpy_to_dotnet(np.zeros(self.sensor_size, dtype=np.uint16), System.UInt16)
 
-    def get_parameter(self):
+    @staticmethod
+    def _find_pid(serial_number=None):
+        """
+        Get the pid of the device with this serial number (USB descriptor), or of the first device not already opened
+        if None
+        """
+        devices = list_devices()
+        if not devices:
+            devices = list_devices(refresh=True)  # maybe plugged since the last scan
+        if not devices:
+            raise ValueError('No Hamamatsu Mini-spectrometer found')
+        available = [device for device in devices if device.pid not in _opened_pids]
+        if serial_number is None:
+            if not available:
+                raise ValueError('All the connected Hamamatsu Mini-spectrometers are already opened')
+            return available[0].pid
+        for device in devices:
+            if device.serial_number == serial_number:
+                return device.pid
+        unknown = [device for device in available if device.serial_number is None]
+        if len(unknown) == 1:  # USB serial could not be read, it will be checked from the unit information
+            return unknown[0].pid
+        raise ValueError(f'No Hamamatsu Mini-spectrometer with serial number {serial_number} found'
+                         + (' (USB serial numbers could not be read)' if unknown else ''))
+
+    def _open(self, pid):
+        """Open device and its data pipe"""
+        with _driver_lock:
+            if pid in _opened_pids:
+                raise ValueError(f'Mini-spectrometer with pid {hex(pid)} is already opened: units of the same model '
+                                 f'share their pid and cannot be opened together')
+            _opened_pids.add(pid)
+        try:
+            self._open_pipe(pid)
+        except Exception:
+            _opened_pids.discard(pid)
+            raise
+
+    def _open_pipe(self, pid):
+        self._handle = DLL.USB_OpenDevice(pid)  # Get index of spectrometer from pid
+
+        if DLL.USB_CheckDevice(self._handle) == 11:
+            logger.debug(f'Connection checked for device of PID {pid}')
+        else:
+            raise ValueError('Check connection failed, please close or reconnect device')
+
+        self._pipe = DLL.USB_OpenPipe(self._handle)
+        self.pid = pid
+
+    def get_parameter(self, refresh=False):
         """
         Get currently set parameters.
 
+        Parameters are read from a local copy of the device UNIT_PARAMETER, kept up to date by set_parameter, so
+        repeated reads don't hit the device.
+
+        Parameters
+        ----------
+        refresh: bool
+            If True, read the parameters from the device (USB round trip) and update the local copy.
+
         Returns
         ----------
         integration_time: int
@@ -103,17 +264,17 @@ class MiniSpectro:
         reserved_param:
             Reserved byte
         """
-        DLL.USB_GetParameter(self._handle, unit_param)
-        self.integration_time = unit_param.unIntegrationTime
-        self.gain = hex(unit_param.byGain)
-        self.trigger_edge = hex(unit_param.byTriggerEdge)
-        self.trigger_mode = hex(unit_param.byTriggerMode)
-        self.reserved_param = unit_param.byReserved
+        if refresh:
+            self._unit_param = DLL.USB_GetParameter(self._handle, self._unit_param)[1]
+        set_parameter_attributes(self, self._unit_param.unIntegrationTime, self._unit_param.byGain,
+                                 self._unit_param.byTriggerEdge, self._unit_param.byTriggerMode,
+                                 self._unit_param.byReserved)
 
     def set_parameter(self, integ_time=None, gain=None, trigger_edge=None, trigger_mode=None):
         """
-        Set specified parameter with specified value.
-        Integration time, gain, trigger edge and trigger mode can be set
+        Set specified parameters with specified values.
+        Integration time, gain, trigger edge and trigger mode can be set, any subset of them being applied with
+        a single USB_SetParameter call on the local copy of the parameters (no read from the device).
 
         Parameters
         ----------
@@ -134,20 +295,26 @@ class MiniSpectro:
             0x02 (External trigger mode 2 (gate trigger mode))
         """
         if integ_time is not None:
-            DLL.USB_GetParameter(self._handle, unit_param)[1].unIntegrationTime = integ_time
-        elif gain is not None:
-            DLL.USB_GetParameter(self._handle, unit_param)[1].byGain = gain
-        elif trigger_edge is not None:
-            DLL.USB_GetParameter(self._handle, unit_param)[1].byTriggerEdge = trigger_edge
-        elif trigger_mode is not None:
-            DLL.USB_GetParameter(self._handle, unit_param)[1].byTriggerMode = trigger_mode
-        DLL.USB_SetParameter(self._handle, unit_param)
+            self._unit_param.unIntegrationTime = integ_time
+        if gain is not None:
+            self._unit_param.byGain = gain
+        if trigger_edge is not None:
+            self._unit_param.byTriggerEdge = trigger_edge
+        if trigger_mode is not None:
+            self._unit_param.byTriggerMode = trigger_mode
+        try:
+            DLL.USB_SetParameter(self._handle, self._unit_param)
+        except Exception:
+            self.get_parameter(refresh=True)  # Resynchronize the local copy with the device
+            raise
+        self.get_parameter()
     
     def set_default(self):
         """
         Set all parameters to default.
         """
         DLL.USB_SetEepromDefaultParameter(self._handle, 0)
+        self.get_parameter(refresh=True)
     
     def read_unit_information(self):
         """
@@ -170,13 +337,14 @@ class MiniSpectro:
             Upper wavelength the spectrometer is set to detect. Makes it
             possible to bound to the upper/last pixel on device sensor.
         """
-        DLL.USB_ReadUnitInformation(self._handle, unit_info)[0]
+        unit_info = DLL.USB_ReadUnitInformation(self._handle, self._unit_info)[1]
         self.unit_id = bytearray(unit_info.arybyUnitID).decode('ascii')
         self.sensor_name = bytearray(unit_info.arybySensorName).decode('ascii')
         self.serial_number = bytearray(unit_info.arybySerialNumber).decode('ascii')
         self.reserved = bytearray(unit_info.arybyReserved)
         self.lower_wl = unit_info.usWaveLengthLower
         self.upper_wl = unit_info.usWaveLengthUpper
+        self._unit_info = unit_info
 
         if self.unit_id.find('1') == 1:  # Check 2nd character in unit_id string
             self.sensor_size = 256       # to determine sensor size
@@ -197,7 +365,7 @@ class MiniSpectro:
         flag: hex
             The flag value needs to be 0xAA to allow writing to device.
         """
-        DLL.USB_WriteUnitInformation(self._handle, unit_info, flag)
+        DLL.USB_WriteUnitInformation(self._handle, self._unit_info, flag)
 
     def read_calibration_value(self):
         """
@@ -210,7 +378,18 @@ class MiniSpectro:
             λ(nm) = A + B1*pix + B2*pix² + B3*pix³ + B4*pix⁴ + B5*pix⁵ with pix any pixel on sensor.
         """
         DLL.USB_ReadCalibrationValue(self._handle, self._c_array)
-        self.calibration_list = list(self._c_array)
+        calibration_list = list(self._c_array)
+        if calibration_list != getattr(self, 'calibration_list', None):
+            self.calibration_list = calibration_list
+            self._update_axes()
+
+    def _update_axes(self):
+        """
+        Compute the pixel and wavelength axes once, they are only recomputed when calibration values change.
+        Falls back to a linear axis between lower_wl and upper_wl if the device holds no calibration.
+        """
+        self.pixel_array, self.wl_array = calibrated_axes(self.sensor_size, self.calibration_list, self.lower_wl,
+                                                          self.upper_wl)
 
     def write_calibration_value(self, flag=None):
         """
@@ -222,25 +401,30 @@ class MiniSpectro:
             The flag value needs to be 0xAA to allow writing to device.
         """
         DLL.USB_WriteCalibrationValue(self._handle, self._origin_c_array, flag)
+        self.read_calibration_value()
 
-    def get_sensor_data(self):
+    def get_sensor_data(self, out=None):
         """
         Get sensor data currently in buffer and wipe buffer.
 
+        The .NET buffer is converted with a single block copy (see dotnet_utils.dotnet_to_numpy).
+
+        Parameters
+        ----------
+        out: numpy.array() or None
+            Preallocated uint16 array of sensor_size elements to copy the intensity into. A new array is
+            allocated if None.
+
         Returns
         -------
-        pixel_array: numpy.array()
-            1D pixel array of device sensor
-        wl_array: numpy.array()
-            1D array of wavelengths from lower_wl to upper_wl
         intensity: numpy.array()
-            1D measured intensity array with values between 0 and 2^16-1 (65535)
+            1D measured intensity array with values between 0 and 2^16-1 (65535). The corresponding axes are
+            the cached pixel_array and wl_array attributes.
         """
-        pixel_array = np.linspace(0, self.sensor_size-1, self.sensor_size)
-        wl_array = np.linspace(self.lower_wl, self.upper_wl, self.sensor_size)
-        intensity = np.array(DLL.USB_GetSensorData(self._handle, self._pipe, self.sensor_size, self.buffer_array)[1])
+        net_array = DLL.USB_GetSensorData(self._handle, self._pipe, self.sensor_size, self.buffer_array)[1]
+        intensity = dotnet_utils.dotnet_to_numpy(net_array, out)
 
-        return pixel_array, wl_array, intensity
+        return intensity
 
     def close(self):
         """
@@ -248,6 +432,7 @@ class MiniSpectro:
         """
         DLL.USB_ClosePipe(self._handle)
         DLL.USB_CloseDevice(self._handle)
+        _opened_pids.discard(self.pid)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent acquisition of several Mini-spectrometers (MiniSpectro API), one thread per device
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class MiniSpectroGroup:
+    """
+    Several spectrometers acquired side by side.
+
+    Each device (its own handle and pipe, the .NET driver being shared) is driven by a dedicated thread of a pool, so
+    readouts of the devices overlap instead of adding up. In read(), the threads start their readout together (barrier),
+    so that the spectra of a read are acquired at the same time.
+
+    Parameters
+    ----------
+    controllers: list(MiniSpectro or MiniSpectroSim)
+    """
+
+    def __init__(self, controllers):
+        self.controllers = list(controllers)
+        if not self.controllers:
+            raise ValueError('At least one spectrometer is needed')
+        self._pool = ThreadPoolExecutor(len(self.controllers), thread_name_prefix='MiniSpectroGroup')
+        self._barrier = threading.Barrier(len(self.controllers))
+
+    def __len__(self):
+        return len(self.controllers)
+
+    def map(self, function):
+        """
+        Call function(index, controller) for all the devices concurrently
+
+        Returns
+        -------
+        list: results, in the order of the controllers
+        """
+        return list(self._pool.map(function, range(len(self.controllers)), self.controllers))
+
+    def read(self, out=None):
+        """
+        Read one spectrum from each device, readouts being started together
+
+        Parameters
+        ----------
+        out: list(numpy.array()) or None
+            Preallocated uint16 arrays to copy the spectra into (one per device)
+
+        Returns
+        -------
+        spectra: list(numpy.array())
+        timestamps: numpy.array()
+            Time (s since epoch) at which each readout was over
+        """
+        def read_device(index, controller):
+            self._barrier.wait()
+            spectrum = controller.get_sensor_data(out=None if out is None else out[index])
+            return spectrum, time.time()
+
+        spectra, timestamps = zip(*self.map(read_device))
+        return list(spectra), np.array(timestamps)
+
+    def close(self):
+        """Stop the threads and close all the devices"""
+        self._pool.shutdown()
+        for controller in self.controllers:
+            controller.close()
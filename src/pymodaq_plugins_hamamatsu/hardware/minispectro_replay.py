@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Recording of the spectra of a Mini-spectrometer to a stream file, and replay of such a recording with the MiniSpectro
+API, to reproduce an acquisition (data, timing) on a machine without the device
+"""
+
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from pymodaq_plugins_hamamatsu.hardware.minispectro import calibrated_axes, set_parameter_attributes
+from pymodaq_plugins_hamamatsu.hardware.stream_file import StreamWriter, StreamReader, ReplayClock
+
+# Attributes of the device saved in the recording, and restored on replay
+DEVICE_ATTRIBUTES = ('unit_id', 'sensor_name', 'serial_number', 'lower_wl', 'upper_wl', 'sensor_size',
+                     'calibration_list', 'integration_time', 'gain', 'trigger_edge', 'trigger_mode')
+DARK_TAG = -2  # tag of the dark spectra in a recording, not replayed
+
+
+class RecordingMiniSpectro:
+    """
+    Wrapper of a MiniSpectro (or MiniSpectroSim) saving every spectrum read, with its readout time, and the parameter
+    changes to a stream file. Everything else is forwarded to the wrapped device. Spectra read within dark_readout()
+    are tagged with DARK_TAG.
+
+    Parameters
+    ----------
+    controller: MiniSpectro or MiniSpectroSim
+        Opened device
+    path: str or Path
+        Stream file to write
+    """
+
+    def __init__(self, controller, path):
+        self.controller = controller
+        self.writer = StreamWriter(path, {name: getattr(controller, name) for name in DEVICE_ATTRIBUTES})
+        self._tag = -1
+
+    def __getattr__(self, name):
+        return getattr(self.controller, name)
+
+    def get_sensor_data(self, out=None):
+        """Read a spectrum from the device, see MiniSpectro.get_sensor_data, and record it"""
+        intensity = self.controller.get_sensor_data(out=out)
+        self.writer.write_data(intensity, tag=self._tag)
+        return intensity
+
+    @contextmanager
+    def dark_readout(self):
+        """Context in which the spectra read are recorded as dark spectra"""
+        self._tag = DARK_TAG
+        try:
+            yield
+        finally:
+            self._tag = -1
+
+    def set_parameter(self, **kwargs):
+        """Set device parameters, see MiniSpectro.set_parameter, and record the change"""
+        self.controller.set_parameter(**kwargs)
+        self.writer.write_call('set_parameter', **kwargs)
+
+    def set_default(self):
+        self.controller.set_default()
+        self.writer.write_call('set_default')
+
+    def close(self):
+        """Close the device and the recording"""
+        self.writer.close()
+        self.controller.close()
+
+
+class MiniSpectroReplay:
+    """
+    Replay of a recorded spectrum stream, with the same API as MiniSpectro
+
+    get_sensor_data() returns the recorded spectra in turn (except the dark ones), waiting for the recorded interval
+    (divided by the speed) since the previous readout, as the device does in freerun mode. The recording is looped over. Device
+    information and calibration are those of the recorded device, and its parameters those of the first recorded
+    spectrum. Parameter changes only update the parameter attributes (the recorded ones being available in the calls
+    attribute of the reader).
+
+    Parameters
+    ----------
+    path: str or Path
+        Stream file recorded by RecordingMiniSpectro
+    speed: float
+        Replay speed (1: original rate), 0 to read spectra as fast as possible
+    loop: bool
+        If False, get_sensor_data() raises EOFError after the last spectrum
+    """
+
+    def __init__(self, path, speed=1., loop=True):
+        self.reader = StreamReader(path)
+        for name, value in self.reader.metadata.items():
+            setattr(self, name, value)
+        if len(self.reader) == 0:
+            raise ValueError(f'No spectrum in {self.reader.path}')
+        self._indices = self.reader.select(*self.reader.formats[0])
+        self._indices = self._indices[self.reader.tags[self._indices] != DARK_TAG]
+        if len(self._indices) == 0:
+            raise ValueError(f'Only dark spectra in {self.reader.path}')
+        self.clock = ReplayClock(self.reader.times[self._indices], speed, loop)
+        self._spectra = self.reader.stack(self._indices)
+        self._unit_param = dict(integration_time=self.integration_time, gain=int(self.gain, 16),
+                                trigger_edge=int(self.trigger_edge, 16), trigger_mode=int(self.trigger_mode, 16))
+        self.reserved = bytearray(16)
+        self._update_axes()
+        for elapsed, name, kwargs in self.reader.calls:
+            if elapsed <= self.reader.times[0] and name in ('set_parameter', 'set_default'):
+                getattr(self, name)(**kwargs)
+        self._count = 0
+        self._last_readout = time.perf_counter()
+
+    def get_parameter(self, refresh=False):
+        """Get currently set parameters, see MiniSpectro.get_parameter"""
+        set_parameter_attributes(self, **self._unit_param)
+
+    def set_parameter(self, integ_time=None, gain=None, trigger_edge=None, trigger_mode=None):
+        """Set parameters (without effect on the replayed spectra), see MiniSpectro.set_parameter"""
+        if integ_time is not None:
+            self._unit_param['integration_time'] = int(integ_time)
+        for name, value in dict(gain=gain, trigger_edge=trigger_edge, trigger_mode=trigger_mode).items():
+            if value is not None and '0xff' not in getattr(self, name):
+                self._unit_param[name] = value
+        self.get_parameter()
+
+    def set_default(self):
+        self.set_parameter(integ_time=100000, gain=0x00, trigger_edge=0x00, trigger_mode=0x00)
+
+    def read_unit_information(self):
+        """Device information is the recorded one"""
+        pass
+
+    def write_unit_information(self, flag=None):
+        pass
+
+    def read_calibration_value(self):
+        """Calibration is the recorded one"""
+        pass
+
+    def write_calibration_value(self, flag=None):
+        pass
+
+    def _update_axes(self):
+        """Compute the cached pixel and wavelength axes, see MiniSpectro._update_axes"""
+        self.pixel_array, self.wl_array = calibrated_axes(self.sensor_size, self.calibration_list, self.lower_wl,
+                                                          self.upper_wl)
+
+    def get_sensor_data(self, out=None):
+        """
+        Get the next recorded spectrum, see MiniSpectro.get_sensor_data
+
+        Parameters
+        ----------
+        out: numpy.array() or None
+            Preallocated uint16 array of sensor_size elements to copy the intensity into.
+
+        Returns
+        -------
+        intensity: numpy.array()
+            1D intensity array (uint16), axes are the cached pixel_array and wl_array attributes
+        """
+        if not self.clock.loop and self._count >= self.clock.size:
+            raise EOFError(f'End of the recording {self.reader.path}')
+        if self._count > 0:
+            ready = self._last_readout + self.clock.time(self._count) - self.clock.time(self._count - 1)
+            now = time.perf_counter()
+            if now < ready:
+                time.sleep(ready - now)
+                now = ready
+            self._last_readout = now
+        else:
+            self._last_readout = time.perf_counter()
+        record = self._count % self.clock.size
+        self._count += 1
+        spectrum = self.reader[self._indices[record]] if self._spectra is None else self._spectra[record]
+        if out is None:
+            return spectrum.copy()
+        out[:] = spectrum
+        return out
+
+    def close(self):
+        self.reader.close()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated Hamamatsu Mini-spectrometer, hardware-free drop-in replacement of MiniSpectro.
+
+Allows to run and profile DAQ_1DViewer_MiniSpectro (and anything using the MiniSpectro API)
+on machines without the .NET driver or a connected device.
+"""
+
+import time
+import numpy as np
+
+from pymodaq_plugins_hamamatsu.hardware.minispectro import calibrated_axes, set_parameter_attributes
+
+
+# Simulated models indexed by sensor size: (unit_id, sensor_name, lower_wl, upper_wl)
+# The 2nd character of the unit ID encodes the sensor size, as for real devices.
+SIMULATED_MODELS = {
+    256: ('S1SIM256', 'InGaAs 256 (simulated)', 900, 1700),
+    512: ('S2SIM512', 'InGaAs 512 (simulated)', 1100, 2200),
+    1024: ('S3SIM024', 'CCD 1024 (simulated)', 320, 1000),
+    2048: ('S4SIM048', 'CCD 2048 (simulated)', 200, 1000),
+}
+
+MAX_COUNTS = 2**16 - 1  # 16 bits ADC
+
+
+class MiniSpectroSim:
+    """
+    Simulated Hamamatsu Mini-spectrometer, with the same API as MiniSpectro
+
+    Spectra are made of a few gaussian lines over a broad background, scaled with integration time
+    and gain, with a dark offset, shot and readout noise, and clipped at the ADC saturation level.
+    get_sensor_data() blocks until the current integration is over, as the real device does in
+    freerun mode.
+
+    Parameters
+    ----------
+    sensor_size: int
+        Number of pixels of the simulated sensor: 256, 512, 1024 or 2048.
+    seed: int or None
+        Seed of the noise generator, for reproducible spectra.
+    pacing: bool
+        If False, get_sensor_data() returns immediately instead of waiting for the integration time.
+    device_index: int
+        Index of the simulated device, giving its serial number (to simulate several devices)
+    """
+
+    dark_level = 800.  # counts
+    read_noise = 8.  # counts rms
+    counts_per_ms = 200.  # peak signal rate at low gain
+    high_gain_factor = 5.
+
+    def __init__(self, sensor_size=1024, seed=None, pacing=True, device_index=0):
+        if sensor_size not in SIMULATED_MODELS:
+            raise ValueError(f'Unsupported sensor size {sensor_size}, choose in {list(SIMULATED_MODELS)}')
+        self._model = SIMULATED_MODELS[sensor_size]
+        self._rng = np.random.default_rng(seed)
+        self.pacing = pacing
+        self.device_index = device_index
+
+        self._unit_param = dict(integration_time=100000, gain=0x00, trigger_edge=0x00, trigger_mode=0x00)
+
+        self.read_unit_information()
+        self.get_parameter(refresh=True)
+        self.read_calibration_value()
+
+        # Noiseless normalized spectrum, only computed once
+        pix = np.arange(self.sensor_size)
+        centers = np.array([0.2, 0.45, 0.52, 0.8]) * self.sensor_size
+        widths = np.array([0.01, 0.005, 0.005, 0.02]) * self.sensor_size
+        amplitudes = np.array([0.6, 1.0, 0.4, 0.3])
+        lines = amplitudes[:, None] * np.exp(-0.5 * ((pix[None, :] - centers[:, None]) / widths[:, None])**2)
+        background = 0.15 * np.exp(-0.5 * ((pix - 0.5 * self.sensor_size) / (0.3 * self.sensor_size))**2)
+        self._profile = lines.sum(axis=0) + background
+
+        self._last_readout = time.perf_counter()
+        self._is_open = True
+
+    def get_parameter(self, refresh=False):
+        """
+        Get currently set parameters, see MiniSpectro.get_parameter
+        """
+        set_parameter_attributes(self, **self._unit_param)
+
+    def set_parameter(self, integ_time=None, gain=None, trigger_edge=None, trigger_mode=None):
+        """
+        Set specified parameters with specified values, see MiniSpectro.set_parameter
+        """
+        if integ_time is not None:
+            if not 5000 <= integ_time <= 10000000:
+                raise ValueError(f'Integration time {integ_time} µs out of range (5000µs-10000000µs)')
+            self._unit_param['integration_time'] = int(integ_time)
+        if gain is not None:
+            self._unit_param['gain'] = gain
+        if trigger_edge is not None:
+            self._unit_param['trigger_edge'] = trigger_edge
+        if trigger_mode is not None:
+            self._unit_param['trigger_mode'] = trigger_mode
+        self.get_parameter()
+
+    def set_default(self):
+        """
+        Set all parameters to default.
+        """
+        self._unit_param.update(integration_time=100000, gain=0x00, trigger_edge=0x00, trigger_mode=0x00)
+        self.get_parameter()
+
+    def read_unit_information(self):
+        """
+        Read device information, see MiniSpectro.read_unit_information
+        """
+        self.unit_id, self.sensor_name, self.lower_wl, self.upper_wl = self._model
+        self.serial_number = f'SIM{self._model[0][1]}{self.device_index + 1:04d}'
+        self.reserved = bytearray(16)
+        self.sensor_size = 256 * 2 ** (int(self.unit_id[1]) - 1)
+
+    def write_unit_information(self, flag=None):
+        """
+        Unit information of a simulated device is read only.
+        """
+        pass
+
+    def read_calibration_value(self):
+        """
+        Reads calibration coefficients of the simulated device
+
+        A slightly curved polynomial matching lower_wl and upper_wl on first and last pixels.
+        """
+        last = self.sensor_size - 1
+        b2 = -0.05 * (self.upper_wl - self.lower_wl) / last**2
+        b1 = (self.upper_wl - self.lower_wl - b2 * last**2) / last
+        self.calibration_list = [float(self.lower_wl), b1, b2, 0., 0., 0.]
+        self._update_axes()
+
+    def _update_axes(self):
+        """Compute the cached pixel and wavelength axes, see MiniSpectro._update_axes"""
+        self.pixel_array, self.wl_array = calibrated_axes(self.sensor_size, self.calibration_list, self.lower_wl,
+                                                          self.upper_wl)
+
+    def write_calibration_value(self, flag=None):
+        """
+        Restore original calibration values.
+        """
+        self.read_calibration_value()
+
+    def _wait_integration(self):
+        """Block until the current integration is over (freerun pacing)"""
+        integration = self._unit_param['integration_time'] * 1e-6
+        ready = self._last_readout + integration
+        now = time.perf_counter()
+        if self.pacing and now < ready:
+            time.sleep(ready - now)
+            now = ready
+        self._last_readout = now
+        return integration
+
+    def get_sensor_data(self, out=None):
+        """
+        Get a simulated spectrum, see MiniSpectro.get_sensor_data
+
+        Parameters
+        ----------
+        out: numpy.array() or None
+            Preallocated uint16 array of sensor_size elements to copy the intensity into.
+
+        Returns
+        -------
+        intensity: numpy.array()
+            1D simulated intensity array (uint16), axes are the cached pixel_array and wl_array attributes
+        """
+        integration = self._wait_integration()
+
+        scale = self.counts_per_ms * integration * 1e3
+        if self._unit_param['gain'] == 0x01:
+            scale *= self.high_gain_factor
+        signal = scale * self._profile
+        signal += self._rng.normal(0., 1., self.sensor_size) * np.sqrt(signal + self.read_noise**2)
+        signal += self.dark_level
+        np.clip(signal, 0, MAX_COUNTS, out=signal)
+        if out is None:
+            out = np.empty(self.sensor_size, dtype=np.uint16)
+        out[:] = signal
+        return out
+
+    def close(self):
+        """
+        Close device.
+        """
+        self._is_open = False
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Processing of Mini-spectrometer spectra: dark spectrum subtraction, nonlinearity correction and resampling onto a
+uniform wavelength grid
+"""
+
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+def load_nonlinearity(path):
+    """
+    Read nonlinearity polynomial coefficients from a .npy or text (.txt, .csv) file
+
+    Returns
+    -------
+    numpy.array(): (degree + 1,) coefficients, or (degree + 1, sensor_size) for per-pixel coefficients, constant term
+        first
+    """
+    path = Path(path)
+    if path.suffix == '.npy':
+        return np.load(path)
+    return np.loadtxt(path, delimiter=',' if path.suffix == '.csv' else None, ndmin=1)
+
+
+class DarkSpectra:
+    """
+    Cache of dark spectra, keyed by the device settings they depend on (integration time, gain)
+    """
+
+    def __init__(self):
+        self._darks = dict()
+
+    def get(self, key, max_age=None):
+        """
+        Dark spectrum taken with the settings key
+
+        Parameters
+        ----------
+        key: tuple
+        max_age: float or None
+            Maximum age of the dark spectrum (s), None for no limit
+
+        Returns
+        -------
+        numpy.array() or None: None if there is no (recent enough) dark spectrum
+        """
+        if key not in self._darks:
+            return None
+        dark, timestamp = self._darks[key]
+        if max_age is not None and time.time() - timestamp > max_age:
+            return None
+        return dark
+
+    def store(self, key, dark, timestamp=None):
+        """Keep a dark spectrum (read only float64 copy)"""
+        dark = np.array(dark, dtype=np.float64)
+        dark.flags.writeable = False
+        self._darks[key] = (dark, time.time() if timestamp is None else timestamp)
+
+    def clear(self):
+        self._darks = dict()
+
+
+class SpectrumCorrector:
+    """
+    Dark subtraction and nonlinearity correction of spectra, vectorized over pixels (and spectra for 2D arrays)
+
+    The corrected intensity is P(raw - dark), P being a polynomial (constant term first) evaluated in place with
+    Horner's scheme, either common to all pixels or with per-pixel coefficients.
+
+    Attributes
+    ----------
+    dark: numpy.array() or None
+        Dark spectrum subtracted from the raw intensity
+    nonlinearity: numpy.array() or None
+        (degree + 1, 1) or (degree + 1, sensor_size) polynomial coefficients
+    """
+
+    def __init__(self):
+        self.dark = None
+        self.nonlinearity = None
+        self._counts = None  # scratch buffer of the dark subtracted counts
+
+    @property
+    def is_identity(self):
+        """True if spectra are not modified"""
+        return self.dark is None and self.nonlinearity is None
+
+    def set_nonlinearity(self, coefficients, sensor_size=None):
+        """
+        Set the nonlinearity polynomial
+
+        Parameters
+        ----------
+        coefficients: numpy.array() or None
+            (degree + 1,) coefficients common to all pixels or (degree + 1, sensor_size) per-pixel coefficients,
+            constant term first. None to disable the correction.
+        sensor_size: int or None
+            If given, check the number of per-pixel coefficients
+        """
+        if coefficients is None:
+            self.nonlinearity = None
+            return
+        coefficients = np.asarray(coefficients, dtype=np.float64)
+        if coefficients.ndim == 1:
+            coefficients = coefficients[:, np.newaxis]
+        if coefficients.ndim != 2 or len(coefficients) == 0 \
+                or (sensor_size is not None and coefficients.shape[1] not in (1, sensor_size)):
+            raise ValueError(f'Nonlinearity coefficients of shape {coefficients.shape} should be (degree + 1,) or '
+                             f'(degree + 1, {sensor_size or "sensor_size"})')
+        self.nonlinearity = coefficients
+
+    def __call__(self, intensity, out=None):
+        """
+        Correct spectra
+
+        Parameters
+        ----------
+        intensity: numpy.array()
+            (sensor_size,) spectrum or (n_spectra, sensor_size) spectra
+        out: numpy.array() or None
+            float64 array of the same shape to write the corrected spectra into, allocated if None
+
+        Returns
+        -------
+        numpy.array(): corrected float64 spectra
+        """
+        if out is None:
+            out = np.empty(intensity.shape, dtype=np.float64)
+        if self.dark is not None:
+            np.subtract(intensity, self.dark, out=out, dtype=np.float64)
+        else:
+            np.copyto(out, intensity, casting='unsafe')
+        if self.nonlinearity is not None and len(self.nonlinearity) > 1:
+            if self._counts is None or self._counts.shape != out.shape:
+                self._counts = np.empty(out.shape, dtype=np.float64)
+            np.copyto(self._counts, out)
+            out[...] = self.nonlinearity[-1]
+            for coefficient in self.nonlinearity[-2::-1]:
+                out *= self._counts
+                out += coefficient
+        elif self.nonlinearity is not None:  # constant polynomial
+            out[...] = self.nonlinearity[0]
+        return out
+
+
+def uniform_grid(start, stop, step):
+    """Wavelengths from start to stop (included if it falls on the grid) every step"""
+    if step <= 0 or stop < start:
+        raise ValueError(f'Invalid wavelength grid: start {start}, stop {stop}, step {step}')
+    return start + step * np.arange(int(np.floor((stop - start) / step + 1e-9)) + 1)
+
+
+class WavelengthResampler:
+    """
+    Linear interpolation of spectra from their calibrated (non-uniform) wavelengths onto a given grid.
+
+    The interpolation is a sparse matrix with two non-zero elements per grid point (the weights of the two pixels
+    around it), computed once and stored as pixel indices and weights: resampling is then two gathers and a weighted
+    sum, for a single spectrum or a stack of spectra. Grid points outside of the calibrated range are NaN.
+
+    Parameters
+    ----------
+    wavelengths: numpy.array()
+        Monotonic wavelength of each pixel
+    grid: numpy.array()
+        Wavelengths to resample the spectra onto
+
+    Attributes
+    ----------
+    size: int
+        Number of points of the grid
+    """
+
+    def __init__(self, wavelengths, grid):
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        self.grid = np.asarray(grid, dtype=np.float64)
+        self.size = len(self.grid)
+        pixels = np.arange(len(wavelengths), dtype=np.float64)
+        if wavelengths[-1] < wavelengths[0]:
+            position = pixels[-1] - np.interp(self.grid, wavelengths[::-1], pixels)
+        else:
+            position = np.interp(self.grid, wavelengths, pixels)
+        self._lower = np.clip(np.floor(position).astype(np.intp), 0, max(len(wavelengths) - 2, 0))
+        self._upper = np.minimum(self._lower + 1, len(wavelengths) - 1)
+        self._upper_weight = position - self._lower
+        self._lower_weight = 1 - self._upper_weight
+        outside = (self.grid < wavelengths.min()) | (self.grid > wavelengths.max())
+        self._lower_weight[outside] = np.nan
+        self._upper_weight[outside] = np.nan
+        self._gathered = None  # scratch buffers of the gathered pixels (input type) and of the weighted ones
+        self._weighted = None
+
+    def __call__(self, spectra, out=None):
+        """
+        Resample spectra
+
+        Parameters
+        ----------
+        spectra: numpy.array()
+            (sensor_size,) spectrum or (n_spectra, sensor_size) spectra
+        out: numpy.array() or None
+            float64 array of shape (..., size) to write the resampled spectra into, allocated if None
+
+        Returns
+        -------
+        numpy.array(): resampled float64 spectra
+        """
+        shape = spectra.shape[:-1] + (self.size,)
+        if out is None:
+            out = np.empty(shape, dtype=np.float64)
+        if self._gathered is None or self._gathered.shape != shape or self._gathered.dtype != spectra.dtype:
+            self._gathered = np.empty(shape, dtype=spectra.dtype)
+            self._weighted = np.empty(shape, dtype=np.float64)
+        np.take(spectra, self._lower, axis=-1, out=self._gathered)
+        np.multiply(self._gathered, self._lower_weight, out=out)
+        np.take(spectra, self._upper, axis=-1, out=self._gathered)
+        np.multiply(self._gathered, self._upper_weight, out=self._weighted)
+        out += self._weighted
+        return out
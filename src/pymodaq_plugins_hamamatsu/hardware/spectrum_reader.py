@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous acquisition of spectra in a background thread, into a preallocated ring buffer
+"""
+
+import threading
+import time
+
+import numpy as np
+
+
+class SpectrumRingBuffer:
+    """
+    Bounded ring buffer of spectra, preallocated once.
+
+    Spectra are identified by their acquisition index (0, 1, 2...). The writer gets the slot of the next
+    spectrum with writable_slot(), fills it in place and calls commit(). The slot being written is never
+    readable, so at most size-1 spectra are available to readers.
+
+    Parameters
+    ----------
+    size: int
+        Number of spectra in the ring (>= 2)
+    sensor_size: int
+        Number of pixels of a spectrum
+    dtype: numpy.dtype
+        Type of the spectra
+    """
+
+    def __init__(self, size, sensor_size, dtype=np.uint16):
+        if size < 2:
+            raise ValueError('Ring buffer should hold at least 2 spectra')
+        self.size = size
+        self.sensor_size = sensor_size
+        self._data = np.zeros((size, sensor_size), dtype=dtype)
+        self._timestamps = np.zeros(size)
+        self._count = 0  # number of committed spectra, also index of the spectrum being written
+        self._condition = threading.Condition()
+
+    @property
+    def count(self):
+        """Total number of spectra written in the buffer"""
+        return self._count
+
+    def writable_slot(self):
+        """Return the (view on the) slot where the next spectrum should be written"""
+        return self._data[self._count % self.size]
+
+    def commit(self, timestamp=None):
+        """
+        Make the spectrum written in writable_slot() available
+
+        Returns
+        -------
+        index: int
+            Acquisition index of the committed spectrum
+        """
+        with self._condition:
+            self._timestamps[self._count % self.size] = time.time() if timestamp is None else timestamp
+            self._count += 1
+            self._condition.notify_all()
+        return self._count - 1
+
+    def oldest_index(self):
+        """Index of the oldest spectrum still available"""
+        return max(0, self._count - self.size + 1)
+
+    def get(self, index):
+        """
+        Copy of an available spectrum
+
+        Returns
+        -------
+        spectrum: numpy.array()
+        timestamp: float
+            Time (s since epoch) at which the spectrum was read
+        """
+        with self._condition:
+            if not self.oldest_index() <= index < self._count:
+                raise IndexError(f'Spectrum {index} is not available anymore (or not yet) in the ring buffer')
+            return self._data[index % self.size].copy(), self._timestamps[index % self.size]
+
+    def get_last(self, number):
+        """
+        Copy of the last available spectra
+
+        Returns
+        -------
+        spectra: numpy.array()
+            (number, sensor_size) array, oldest spectrum first
+        timestamps: numpy.array()
+        """
+        with self._condition:
+            start = max(self.oldest_index(), self._count - number)
+            slots = np.arange(start, self._count) % self.size
+            return self._data[slots], self._timestamps[slots]
+
+    def wait_for(self, index, timeout=None):
+        """Block until spectrum index is available, return False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._count > index, timeout)
+
+
+def read_burst(controller, out, timestamps=None):
+    """
+    Read spectra back to back into a preallocated array: in external trigger modes, one spectrum per trigger
+
+    Parameters
+    ----------
+    controller: MiniSpectro or MiniSpectroSim
+    out: numpy.array()
+        (n_spectra, sensor_size) uint16 array
+    timestamps: numpy.array() or None
+        (n_spectra,) array filled with the time (s since epoch) at which each readout was over
+
+    Returns
+    -------
+    out: numpy.array()
+    timestamps: numpy.array() or None
+    """
+    for index in range(len(out)):
+        controller.get_sensor_data(out=out[index])
+        if timestamps is not None:
+            timestamps[index] = time.time()
+    return out, timestamps
+
+
+class SpectrumReader(threading.Thread):
+    """
+    Thread reading spectra continuously from a controller (MiniSpectro API) into a SpectrumRingBuffer.
+
+    Parameters
+    ----------
+    controller: MiniSpectro or MiniSpectroSim
+    ring: SpectrumRingBuffer
+    callback: callable or None
+        Called in the reader thread with the index of each new spectrum
+    lock: threading.Lock or None
+        Lock held during each readout, to share the controller with other threads (parameters setting...)
+    """
+
+    def __init__(self, controller, ring, callback=None, lock=None):
+        super().__init__(name='MiniSpectroReader', daemon=True)
+        self.controller = controller
+        self.ring = ring
+        self.callback = callback
+        self.lock = lock if lock is not None else threading.Lock()
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                with self.lock:
+                    self.controller.get_sensor_data(out=self.ring.writable_slot())
+            except Exception as e:
+                self.error = e
+                break
+            if self._stop_event.is_set():  # stopped during readout, the spectrum is discarded
+                break
+            index = self.ring.commit()
+            if self.callback is not None:
+                self.callback(index)
+
+    def stop(self, timeout=0.):
+        """
+        Ask the thread to stop after the current readout
+
+        Parameters
+        ----------
+        timeout: float or None
+            Time to wait for the thread to finish (s), None to wait for the end of the current readout.
+        """
+        self._stop_event.set()
+        if timeout is None or timeout > 0:
+            self.join(timeout)
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary recording of a device data stream (spectra, camera frames), of the parameter changes and of the timing,
+to replay it later without the hardware
+
+A stream file is a sequence of records, each one being a fixed size header (kind, time since the start of the
+recording, integer tag, payload size) followed by its payload, padded to 8 bytes:
+
+* HEADER: JSON metadata of the device (first record)
+* FORMAT: JSON type and shape of the following data records (written when they change)
+* DATA: raw array, e.g. a spectrum or a frame, the tag being the frame index (-1 if unknown, other negative values
+  being markers of the device recorder)
+* CALL: JSON name and keyword arguments of a method changing the device parameters
+
+Records are queued as they come and appended by a writer thread, so that recording does not delay the device
+readout, and an interrupted recording is still readable (up to its last complete record). On replay, the file is memory mapped and data are read as numpy views, without loading the file in memory.
+"""
+
+import json
+import struct
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b'HAMSTRM1'
+STREAM_SUFFIX = '.stream'
+RECORD = struct.Struct('<B7xdqQ')  # kind, time (s), tag, payload size
+HEADER, FORMAT, DATA, CALL = range(4)
+ALIGNMENT = 8
+
+
+def indexed_path(path, index):
+    """Stream file of the index-th device of a recording of several devices (the given path for the first one)"""
+    path = Path(path)
+    return path if index == 0 else path.with_name(f'{path.stem}_{index}{path.suffix}')
+
+
+def _to_json(value):
+    """JSON serializable version of numpy scalars, arrays and tuples (lists)"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class StreamWriter:
+    """
+    Append records to a stream file in a writer thread
+
+    write_data() and write_call() may be called from any thread: they only queue the records (timed when queued) and
+    never block. If the writer cannot keep up and the queue is full, data records are dropped (and counted) rather
+    than slowing down the device readout, as in FrameRecorder.
+
+    Parameters
+    ----------
+    path: str or Path
+    metadata: dict or None
+        Description of the device (JSON serializable), written in the HEADER record
+    max_queued: int
+        Maximum number of data records waiting to be written
+
+    Attributes
+    ----------
+    frames: int
+        Number of DATA records written
+    dropped: int
+        Data records not written because the queue was full
+    error: Exception or None
+        Error of the writer thread, which then stops recording
+    """
+
+    def __init__(self, path, metadata=None, max_queued=1000):
+        self.path = Path(path)
+        self.max_queued = max_queued
+        self.frames = 0
+        self.dropped = 0
+        self.error = None
+        self._format = None
+        self._start = time.perf_counter()
+        self._file = open(self.path, 'wb')
+        self._file.write(MAGIC)
+        self._write(HEADER, 0., -1, self._encode(metadata or dict()))
+        self._queue = deque()
+        self._queued = 0
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='StreamWriter', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value, default=_to_json).encode()
+
+    def elapsed(self):
+        """Time since the start of the recording (s)"""
+        return time.perf_counter() - self._start
+
+    def _write(self, kind, elapsed, tag, payload):
+        self._file.write(RECORD.pack(kind, elapsed, tag, len(payload)))
+        self._file.write(payload)
+        padding = -len(payload) % ALIGNMENT
+        if padding:
+            self._file.write(bytes(padding))
+
+    def _put(self, record, data=False):
+        with self._condition:
+            if self._closing or self.error is not None or (data and self._queued >= self.max_queued):
+                self.dropped += data
+                return False
+            self._queue.append(record)
+            self._queued += data
+            self._condition.notify()
+        return True
+
+    def write_data(self, array, tag=-1, elapsed=None):
+        """
+        Queue an array to be appended, without blocking
+
+        Parameters
+        ----------
+        array: numpy.array()
+            Copied, so that it may be reused by the caller
+        tag: int
+            Index of the frame, -1 if unknown
+        elapsed: float or None
+            Time of the data since the start of the recording (s), now if None
+
+        Returns
+        -------
+        bool: False if the array was dropped
+        """
+        elapsed = self.elapsed() if elapsed is None else elapsed
+        return self._put((DATA, elapsed, tag, np.array(array, order='C')), data=True)
+
+    def write_call(self, name, **kwargs):
+        """Queue a parameter change to be appended: name and keyword arguments of the method called"""
+        self._put((CALL, self.elapsed(), -1, self._encode(dict(name=name, kwargs=kwargs))))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._closing)
+                if not self._queue:  # closing, and everything was written
+                    break
+                kind, elapsed, tag, payload = self._queue.popleft()
+            try:
+                if kind == DATA:
+                    frame_format = (payload.dtype.str, payload.shape)
+                    if frame_format != self._format:
+                        self._write(FORMAT, elapsed, -1,
+                                    self._encode(dict(dtype=frame_format[0], shape=frame_format[1])))
+                        self._format = frame_format
+                    self._write(DATA, elapsed, tag, payload.data.cast('B'))
+                else:
+                    self._write(kind, elapsed, tag, payload)
+            except Exception as e:
+                self.error = e
+                with self._condition:
+                    self.dropped += self._queued
+                    self._queue.clear()
+                    self._queued = 0
+                break
+            if kind == DATA:
+                with self._condition:
+                    self._queued -= 1
+                self.frames += 1
+
+    def close(self):
+        """Write the queued records and close the file"""
+        with self._condition:
+            if self._closing:
+                return
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        self._file.close()
+
+
+class StreamReader:
+    """
+    Memory mapped stream file
+
+    Parameters
+    ----------
+    path: str or Path
+
+    Attributes
+    ----------
+    metadata: dict
+        Description of the recorded device
+    formats: list(tuple)
+        (dtype, shape) of the data records
+    times: numpy.array()
+        Time of each data record since the start of the recording (s)
+    tags: numpy.array()
+        Tag (frame index) of each data record
+    format_index: numpy.array()
+        Index in formats of each data record
+    calls: list(tuple)
+        (time, method name, keyword arguments) of the recorded parameter changes
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._map = np.memmap(self.path, dtype=np.uint8, mode='r')
+        if bytes(self._map[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{self.path} is not a stream recording')
+        self.metadata = dict()
+        self.formats = []
+        self.calls = []
+        times, tags, offsets, format_index = [], [], [], []
+        offset = len(MAGIC)
+        while offset + RECORD.size <= len(self._map):
+            kind, elapsed, tag, size = RECORD.unpack_from(self._map, offset)
+            start = offset + RECORD.size
+            if start + size > len(self._map):  # interrupted recording
+                break
+            if kind == DATA:
+                times.append(elapsed)
+                tags.append(tag)
+                offsets.append(start)
+                format_index.append(len(self.formats) - 1)
+            elif kind in (HEADER, FORMAT, CALL):
+                content = json.loads(bytes(self._map[start:start + size]))
+                if kind == HEADER:
+                    self.metadata = content
+                elif kind == FORMAT:
+                    self.formats.append((np.dtype(content['dtype']), tuple(content['shape'])))
+                else:
+                    self.calls.append((elapsed, content['name'], content['kwargs']))
+            offset = start + size + (-size % ALIGNMENT)
+        self.times = np.array(times, dtype=np.float64)
+        self.tags = np.array(tags, dtype=np.int64)
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self.format_index = np.array(format_index, dtype=np.intp)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        """Read only view of a data record"""
+        dtype, shape = self.formats[self.format_index[index]]
+        return np.ndarray(shape, dtype=dtype, buffer=self._map, offset=int(self._offsets[index]))
+
+    def select(self, dtype, shape):
+        """Indices of the data records of a given format"""
+        matching = [index for index, frame_format in enumerate(self.formats) if frame_format == (dtype, shape)]
+        return np.flatnonzero(np.isin(self.format_index, matching))
+
+    def stack(self, indices):
+        """
+        View of data records as a single array, if they have the same format and are evenly spaced in the file
+
+        Returns
+        -------
+        numpy.array() or None: (len(indices), ...) read only view, None if the records cannot be viewed as an array
+        """
+        indices = np.asarray(indices)
+        if len(indices) == 0 or len(np.unique(self.format_index[indices])) != 1:
+            return None
+        offsets = self._offsets[indices]
+        strides = np.diff(offsets)
+        if len(strides) and (strides[0] <= 0 or np.any(strides != strides[0])):
+            return None
+        frame = self[indices[0]]
+        stride = int(strides[0]) if len(strides) else frame.nbytes
+        return np.lib.stride_tricks.as_strided(frame, shape=(len(indices),) + frame.shape,
+                                               strides=(stride,) + frame.strides, writeable=False)
+
+    def close(self):
+        """Release the memory map (unmapped once the views of the data are not used anymore)"""
+        self._map = None
+
+
+class ReplayClock:
+    """
+    Replay time of the data records, at a given speed, the recording being looped over
+
+    Records are replayed with their recorded intervals divided by the speed, a loop lasting the recording duration
+    plus one mean interval.
+
+    Parameters
+    ----------
+    times: numpy.array()
+        Recorded time of the records (s)
+    speed: float
+        Replay speed (1: original rate), 0 to replay as fast as possible
+    loop: bool
+        If False, the replay stops after the last record
+    """
+
+    def __init__(self, times, speed=1., loop=True):
+        if len(times) == 0:
+            raise ValueError('No data to replay')
+        if speed < 0:
+            raise ValueError(f'Invalid replay speed {speed}')
+        self.speed = speed
+        self.loop = loop
+        self._offsets = np.asarray(times, dtype=np.float64) - times[0]
+        self.size = len(self._offsets)
+        duration = self._offsets[-1]
+        self.period = duration + (duration / (self.size - 1) if self.size > 1 else 0.)
+
+    def time(self, index):
+        """Replay time of the index-th replayed record (s), counted from the start of the replay"""
+        if self.speed == 0:
+            return 0.
+        cycle, record = divmod(index, self.size)
+        return (cycle * self.period + self._offsets[record]) / self.speed
+
+    def count(self, elapsed):
+        """Number of records replayed after elapsed seconds (infinite if the speed is 0 and the replay loops)"""
+        if self.speed == 0 or self.period <= 0:
+            return float('inf') if self.loop else self.size
+        cycles, remainder = divmod(elapsed * self.speed, self.period)
+        count = int(cycles) * self.size + int(np.searchsorted(self._offsets, remainder, side='right'))
+        return count if self.loop else min(count, self.size)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the in-place accumulator used for plugin side averaging
+"""
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.averaging import Accumulator
+
+
+def test_mean_and_std():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 2**16, size=(10, 64), dtype=np.uint16)
+    acc = Accumulator((64,), compute_variance=True)
+    for spectrum in data:
+        acc.add(spectrum)
+    assert acc.count == 10
+    assert np.allclose(acc.mean(), data.mean(axis=0))
+    assert np.allclose(acc.std(), data.std(axis=0))
+
+
+def test_batch_and_reset():
+    data = np.arange(2 * 3 * 4, dtype=np.uint16).reshape((2, 3, 4))
+    acc = Accumulator((3, 4), compute_variance=True, dtype=np.float32)
+    acc.add_batch(data)
+    assert np.allclose(acc.mean(), data.mean(axis=0))
+    assert np.allclose(acc.variance(), data.var(axis=0))
+    acc.reset()
+    assert acc.count == 0
+    acc.add(data[0])
+    assert np.allclose(acc.mean(), data[0])
+
+
+def test_no_variance():
+    acc = Accumulator((4,))
+    acc.add(np.ones(4))
+    assert acc.matches((4,)) and not acc.matches((4,), compute_variance=True)
+    with pytest.raises(ValueError):
+        acc.variance()
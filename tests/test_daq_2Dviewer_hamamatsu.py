@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the camera reconfiguration of the DCAM viewer plugin (no camera needed)
+"""
+import os
+from collections import namedtuple
+
+import pytest
+from pylablib.devices.interface import camera as camera_interface
+
+from pymodaq_plugins_hamamatsu.daq_viewer_plugins.plugins_2D import daq_2Dviewer_Hamamatsu
+from pymodaq_plugins_hamamatsu.hardware.dcam_registry import camera_registry, CameraInfo
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')  # no display needed
+DeviceInfo = namedtuple('DeviceInfo', ['vendor', 'model', 'serial_number', 'camera_version'])
+
+
+class CameraStub:
+    """
+    Camera with the acquisition setup and ROI semantics of pylablib DCAMCamera: the buffer is allocated by
+    setup_acquisition (only if the number of frames changed), released by clear_acquisition, and set_roi clears the
+    acquisition, setting it up again afterwards if it was set up.
+    """
+    TimeoutError = TimeoutError
+    _clear_pausing_acquisition = False
+    pausing_acquisition = camera_interface.ICamera.pausing_acquisition
+
+    def __init__(self, idx=0):
+        self.detector_size = (64, 48)
+        self.roi = (0, 64, 0, 48, 1, 1)
+        self.exposure = 0.01
+        self.calls = []
+        self.allocations = 0
+        self._acq_params = None
+        self._alloc_nframes = 0
+        self._restart_acq_after_pause = True
+        self._acq_setup_requested = (False, False)
+
+    def get_device_info(self):
+        return DeviceInfo('Hamamatsu', 'STUB', 'S0001', '1')
+
+    def get_detector_size(self):
+        return self.detector_size
+
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+
+    def get_exposure(self):
+        return self.exposure
+
+    def get_roi(self):
+        return self.roi
+
+    @camera_interface.acqcleared
+    def set_roi(self, hstart=0, hend=None, vstart=0, vend=None, hbin=1, vbin=1):
+        self.roi = (hstart, hend, vstart, vend, hbin, hbin)
+        return self.roi
+
+    def _get_data_dimensions_rc(self):
+        hstart, hend, vstart, vend, hbin, vbin = self.roi
+        return (vend - vstart) // vbin, (hend - hstart) // hbin
+
+    def get_acquisition_parameters(self):
+        return None if self._acq_params is None else dict(self._acq_params)
+
+    def setup_acquisition(self, mode='sequence', nframes=100):
+        self.calls.append('setup')
+        self._acq_params = dict(mode=mode, nframes=nframes)
+        if nframes != self._alloc_nframes:
+            self.allocations += 1
+            self._alloc_nframes = nframes
+
+    def clear_acquisition(self):
+        self.calls.append('clear')
+        self._alloc_nframes = 0
+        self._acq_params = None
+
+    def acquisition_in_progress(self):
+        return False
+
+    def start_acquisition(self, *args, **kwargs):
+        pass
+
+    def stop_acquisition(self):
+        pass
+
+    def wait_for_frame(self, *args, **kwargs):
+        return False
+
+    def close(self):
+        pass
+
+
+class ViewerStub(daq_2Dviewer_Hamamatsu.DAQ_2DViewer_Hamamatsu):
+    """Plugin with the ROI selection settings added by the PyMoDAQ viewer"""
+    params = daq_2Dviewer_Hamamatsu.DAQ_2DViewer_Hamamatsu.params + [
+        {'title': 'ROI', 'name': 'ROIselect', 'type': 'group', 'children': [
+            {'name': 'use_ROI', 'type': 'bool', 'value': False}, {'name': 'x0', 'type': 'int', 'value': 0},
+            {'name': 'y0', 'type': 'int', 'value': 0}, {'name': 'width', 'type': 'int', 'value': 10},
+            {'name': 'height', 'type': 'int', 'value': 10}]}]
+
+
+@pytest.fixture
+def viewer(qapp, monkeypatch):
+    monkeypatch.setattr(camera_registry, '_cameras', [CameraInfo(0, 'STUB', 'S0001')])
+    monkeypatch.setattr(daq_2Dviewer_Hamamatsu.DCAM, 'DCAMCamera', CameraStub)
+    plugin = ViewerStub(None, None)
+    plugin.ini_detector()
+    yield plugin
+    plugin.close()
+
+
+def test_binning_keeps_roi(viewer):
+    viewer.update_rois((8, 32, 1, 4, 40, 1))
+    assert viewer.controller.get_roi() == (8, 40, 4, 44, 1, 1)
+    viewer.settings.child('binning').setValue(2)
+    viewer.commit_settings(viewer.settings.child('binning'))
+    assert viewer.controller.get_roi() == (8, 40, 4, 44, 2, 2)
+    assert viewer.controller._get_data_dimensions_rc() == (20, 16)
+
+
+def test_roi_change_allocates_buffer_once(viewer):
+    camera = viewer.controller
+    camera.calls.clear()
+    camera.allocations = 0
+    viewer.update_rois((8, 32, 1, 4, 40, 1))  # size change
+    assert camera.calls == ['clear', 'clear', 'setup'] and camera.allocations == 1  # second clear: within set_roi
+    camera.calls.clear()
+    viewer.update_rois((8, 32, 1, 4, 40, 1))  # unchanged
+    assert camera.calls == []
+    viewer.update_rois((16, 32, 1, 0, 40, 1))  # moved
+    assert camera.calls.count('setup') == 1 and camera.allocations == 2
+    camera.calls.clear()
+    viewer.reconfigure()  # e.g. new buffer settings, same number of frames
+    assert camera.calls == ['setup'] and camera.allocations == 2
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the DCAM frame reading helpers (no camera needed)
+"""
+import time
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.dcam_acquisition import (FrameTracker, AcquisitionLoop, drain_frames,
+                                                                  stack_frames, buffer_frame_count)
+
+FrameInfo = namedtuple('FrameInfo', ['frame_index', 'framestamp'])
+
+
+class BufferStub:
+    """Minimal camera buffer returning preset frame ranges"""
+
+    def __init__(self, reads):
+        self.reads = list(reads)
+
+    def read_multiple_images(self, return_info=False, return_rng=False):
+        first, last, stamps = self.reads.pop(0)
+        frames = [np.full((2, 3), index, dtype=np.uint16) for index in range(first, last)]
+        infos = [FrameInfo(index, stamp) for index, stamp in zip(range(first, last), stamps)]
+        return frames, infos, (first, last)
+
+
+class StreamStub:
+    """Camera acquiring a new frame at each wait"""
+    TimeoutError = TimeoutError
+
+    def __init__(self):
+        self.acquired = 0
+        self.read = 0
+        self.in_progress = True
+
+    def acquisition_in_progress(self):
+        return self.in_progress
+
+    def wait_for_frame(self, since='lastread', nframes=1, timeout=20.):
+        time.sleep(0.001)
+        self.acquired += 1
+        return True
+
+    def get_new_images_range(self):
+        return self.read, self.acquired
+
+    def read_multiple_images(self, return_info=False, return_rng=False):
+        first, last = self.read, self.acquired
+        self.read = last
+        frames = [np.full((2, 3), index, dtype=np.uint16) for index in range(first, last)]
+        return frames, [FrameInfo(index, index) for index in range(first, last)], (first, last)
+
+    def read_newest_image(self, return_info=False):
+        self.read = self.acquired
+        return np.full((2, 3), self.acquired - 1, dtype=np.uint16), FrameInfo(self.acquired - 1, self.acquired - 1)
+
+
+def test_tracker_counts_overruns_and_lost_frames():
+    tracker = FrameTracker()
+    tracker.update(0, 3, [0, 1, 2])
+    tracker.update(3, 5, [3, 5])  # driver lost framestamp 4
+    tracker.update(8, 10, [9, 10])  # frames 5 to 7 overwritten in the buffer
+    assert tracker.frames_read == 7
+    assert tracker.dropped == 4
+    assert tracker.overruns == 1
+
+
+def test_drain_frames_stacks():
+    camera = BufferStub([(0, 4, [0, 1, 2, 3]), (4, 4, [])])
+    tracker = FrameTracker()
+    frames, infos = drain_frames(camera, tracker)
+    assert frames.shape == (4, 2, 3)
+    assert np.array_equal(frames[:, 0, 0], np.arange(4))
+    assert [info.frame_index for info in infos] == [0, 1, 2, 3]
+    assert drain_frames(camera, tracker) == (None, [])
+    assert tracker.frames_read == 4
+
+
+def test_stack_chunks():
+    chunks = [np.zeros((2, 4, 4)), np.ones((4, 4))]
+    assert stack_frames(chunks).shape == (3, 4, 4)
+
+
+def test_buffer_frame_count():
+    assert buffer_frame_count((2048, 2048), nframes=50) == 50
+    assert buffer_frame_count((2048, 2048), budget_mb=100) == 11  # 8.4 MB frames
+    assert buffer_frame_count((1024, 1024), budget_mb=100) == 47  # 2x2 binning
+    assert buffer_frame_count((2048, 2048), budget_mb=1) == 2
+    with pytest.raises(ValueError):
+        buffer_frame_count((10, 10))
+
+
+def wait_until(condition, timeout=2.):
+    start = time.perf_counter()
+    while not condition() and time.perf_counter() - start < timeout:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_acquisition_loop_throttles_display():
+    camera = StreamStub()
+    displayed, consumed = [], []
+    loop = AcquisitionLoop(camera, lambda frames, infos, ready_time: displayed.append(frames))
+    loop.consumers.append(lambda frames, infos: consumed.append(frames[:, 0, 0]))
+    loop.display_period = 10.
+    loop.start()
+    loop.start_grab()
+    assert wait_until(lambda: camera.acquired > 50)
+    loop.pause()
+    assert len(displayed) == 1  # first frames displayed right away, then throttled
+    assert np.array_equal(np.concatenate(consumed), np.arange(camera.read))
+    assert loop.tracker.dropped == 0
+    loop.stop()
+    assert not loop.is_alive()
+
+
+def test_acquisition_loop_single_and_lossless():
+    camera = StreamStub()
+    displayed = []
+    loop = AcquisitionLoop(camera, lambda frames, infos, ready_time: displayed.append(frames))
+    loop.display_period = 0.05
+    loop.start()
+    loop.start_grab(single=True)
+    assert wait_until(lambda: not loop.running)
+    assert len(displayed) == 1 and displayed[0].shape == (1, 2, 3)
+    loop.lossless = True
+    loop.start_grab()
+    assert wait_until(lambda: len(displayed) >= 4)
+    loop.stop()
+    stacked = np.concatenate(displayed[1:])[:, 0, 0]
+    assert np.array_equal(stacked, np.arange(stacked[0], stacked[0] + len(stacked)))
+
+
+def test_acquisition_loop_releases_lock_when_stopped():
+    camera = StreamStub()
+    camera.in_progress = False
+    loop = AcquisitionLoop(camera, lambda frames, infos, ready_time: None)
+    loop.start()
+    loop.start_grab()
+    time.sleep(0.05)
+    waits = []
+    for _ in range(5):  # settings changes take the lock while the camera is stopped
+        start = time.perf_counter()
+        with loop.lock:
+            waits.append(time.perf_counter() - start)
+        time.sleep(0.02)
+    loop.stop()
+    assert max(waits) < loop.wait_timeout / 2
+    assert camera.acquired == 0
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the DCAM software frame processing (no camera needed)
+"""
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.dcam_processing import (FrameReducer, FramePreview, FrameCorrector,
+                                                                 ProcessingChain, ReferenceStore, RoiStatistics,
+                                                                 parse_regions)
+
+
+def reference(frames, vbin, hbin):
+    n_frames, height, width = frames.shape
+    frames = frames[:, :height - height % vbin, :width - width % hbin].astype(np.float64)
+    return frames.reshape(n_frames, height // vbin, vbin, width // hbin, hbin).sum(axis=(2, 4))
+
+
+@pytest.fixture
+def frames():
+    return np.random.default_rng(0).integers(0, 4096, size=(3, 50, 70), dtype=np.uint16)
+
+
+@pytest.mark.parametrize('vbin, hbin', [(1, 2), (3, 1), (2, 4), (5, 10), (4, 16)])
+def test_sum_binning(frames, vbin, hbin):
+    reducer = FrameReducer(hbin=hbin, vbin=vbin)
+    binned, _ = reducer(frames)
+    assert binned.dtype == np.uint32
+    assert binned.shape == (3,) + reducer.output_shape(frames.shape[1:])
+    assert np.array_equal(binned, reference(frames, vbin, hbin))
+
+
+def test_mean_binning(frames):
+    binned, _ = FrameReducer(hbin=3, vbin=2, mode='mean')(frames)
+    assert binned.dtype == np.float32
+    assert np.allclose(binned, reference(frames, 2, 3) / 6)
+
+
+def test_crop(frames):
+    reducer = FrameReducer(crop=(10, 100, -5, 33))
+    assert reducer.bounds(frames.shape[1:]) == (10, 50, 0, 33)
+    cropped, _ = reducer(frames)
+    assert np.shares_memory(cropped, frames)
+    assert np.array_equal(cropped, frames[:, 10:, :33])
+
+    reducer.hbin = 4
+    assert reducer.output_shape(frames.shape[1:]) == (40, 8)
+    assert np.array_equal(reducer(frames)[0], reference(frames[:, 10:, :32], 1, 4))
+
+
+def test_decimation_across_batches(frames):
+    reducer = FrameReducer(decimation=3)
+    stack = np.repeat(frames[:1], 10, axis=0) + np.arange(10, dtype=np.uint16)[:, np.newaxis, np.newaxis]
+    kept = []
+    for batch in (slice(0, 4), slice(4, 5), slice(5, 10)):
+        reduced, infos = reducer(stack[batch], list(range(10))[batch])
+        if reduced is not None:
+            assert list(reduced[:, 0, 0] - frames[0, 0, 0]) == infos
+            kept.extend(infos)
+    assert kept == [0, 3, 6, 9]
+
+
+def test_identity(frames):
+    reducer = FrameReducer()
+    assert reducer.is_identity
+    assert reducer(frames)[0] is frames
+
+
+def test_thread_pool(frames):
+    reducer = FrameReducer(hbin=2, vbin=2, workers=3)
+    reducer.parallel_threshold = 0
+    try:
+        assert np.array_equal(reducer(frames)[0], reference(frames, 2, 2))
+    finally:
+        reducer.close()
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        FrameReducer(mode='max')
+
+
+def test_preview(frames):
+    stride = FramePreview(4, 'stride')
+    assert stride.output_shape(frames.shape[1:]) == (13, 18)
+    preview = stride(frames)
+    assert preview.flags.c_contiguous and np.array_equal(preview, frames[:, ::4, ::4])
+
+    block = FramePreview(4, 'mean')
+    assert block.output_shape(frames.shape[1:]) == (12, 17)
+    first = block(frames)
+    assert first.dtype == np.float32 and np.allclose(first, reference(frames, 4, 4) / 16)
+    assert block(frames) is not first  # previews are not overwritten by the next ones
+
+    line = frames[:, :1]  # factors are limited to the frame size
+    assert FramePreview(4, 'mean')(line).shape == (3, 1, 17)
+    assert FramePreview(4, 'stride').output_shape((1, 70)) == (1, 18)
+
+
+def test_correction(frames):
+    dark = np.full(frames.shape[1:], 100.)
+    flat = dark + np.linspace(500, 1500, frames.shape[2])
+    flat[0, 0] = 50  # dead pixel
+    corrector = FrameCorrector()
+    assert corrector.is_identity and corrector(frames)[0] is frames
+    corrector.set_references(dark, flat)
+    response = flat - dark
+    gain_map = response[response > 0].mean() / response
+    corrected, _ = corrector(frames)
+    assert corrected.dtype == np.float32
+    assert np.allclose(corrected[:, 1:, 1:], ((frames - dark) * gain_map)[:, 1:, 1:], rtol=1e-5)
+    assert np.all(corrected[:, 0, 0] == 0)
+    assert corrector(frames[:2])[0].base is corrected.base  # buffer reused
+    assert corrector(frames[:, 1:])[0] is None  # references of another ROI
+
+
+def test_processing_chain(frames):
+    corrector = FrameCorrector()
+    corrector.set_references(dark=np.ones((25, 35)))
+    chain = ProcessingChain([FrameReducer(vbin=2, hbin=2, decimation=2), corrector])
+    processed, infos = chain(frames, [0, 1, 2])
+    assert infos == [0, 2]
+    assert np.allclose(processed, reference(frames[::2], 2, 2) - 1)
+
+
+def test_reference_store(tmp_path):
+    key = ('S0001', 0, 0, 1, 1, 48, 64, 'raw', '1ms')
+    dark = np.arange(12, dtype=np.float32).reshape(3, 4)
+    ReferenceStore(tmp_path).store(key, 'dark', dark)
+    store = ReferenceStore(tmp_path)
+    assert np.array_equal(store.get(key, 'dark'), dark)
+    assert store.get(key, 'flat') is None
+    store.remove(key, 'dark')
+    assert store.get(key, 'dark') is None and not any(tmp_path.iterdir())
+    with pytest.raises(ValueError):
+        store.store(key, 'bias', dark)
+
+
+def test_parse_regions():
+    assert parse_regions('') == []
+    assert parse_regions('10, 5, 20, 10; 0 0 4 4;') == [(5, 15, 10, 30), (0, 4, 0, 4)]
+    for text in ('1, 2, 3', '0, 0, 0, 4', 'a, b, c, d'):
+        with pytest.raises(ValueError):
+            parse_regions(text)
+
+
+def test_roi_statistics(frames):
+    regions = [(5, 15, 10, 30), (40, 80, 60, 100)]  # the second one is clipped to the frames
+    results = RoiStatistics(regions, projections=True, centroid=True)(frames)
+    assert [result['bounds'] for result in results] == [(5, 15, 10, 30), (40, 50, 60, 70)]
+    region = frames[:, 5:15, 10:30].astype(np.float64)
+    assert np.allclose(results[0]['value'], region.sum(axis=(1, 2)))
+    assert np.allclose(results[0]['rows'], region.sum(axis=2))
+    assert np.allclose(results[0]['columns'], region.sum(axis=1))
+    y, x = np.mgrid[5:15, 10:30]
+    assert np.allclose(results[0]['centroid'][:, 0], (region * y).sum(axis=(1, 2)) / region.sum(axis=(1, 2)))
+    assert np.allclose(results[0]['centroid'][:, 1], (region * x).sum(axis=(1, 2)) / region.sum(axis=(1, 2)))
+
+    mean = RoiStatistics(None, 'mean', projections=True)(frames)
+    assert len(mean) == 1 and 'centroid' not in mean[0]
+    assert np.allclose(mean[0]['value'], frames.mean(axis=(1, 2)))
+    assert np.allclose(mean[0]['columns'], frames.mean(axis=1))
+    assert np.isnan(RoiStatistics(centroid=True)(np.zeros((1, 4, 4)))[0]['centroid']).all()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the DCAM frame recorder (no camera needed)
+"""
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.dcam_recorder import FrameRecorder, read_recording
+
+FrameInfo = namedtuple('FrameInfo', ['frame_index', 'framestamp', 'timestamp_us'])
+
+
+def batches(n_batches, batch_size, shape=(4, 5)):
+    for batch in range(n_batches):
+        indexes = range(batch * batch_size, (batch + 1) * batch_size)
+        frames = np.array([np.full(shape, index, dtype=np.uint16) for index in indexes])
+        yield frames, [FrameInfo(index, index, 1000 * index) for index in indexes]
+
+
+@pytest.mark.parametrize('file_format', ['HDF5', 'Raw'])
+def test_recording_roundtrip(tmp_path, file_format):
+    if file_format == 'HDF5':
+        pytest.importorskip('h5py')
+    path = tmp_path / ('frames.h5' if file_format == 'HDF5' else 'frames.raw')
+    recorder = FrameRecorder(path, (4, 5), file_format=file_format, block_frames=8)
+    for frames, infos in batches(5, 7):
+        assert recorder.put(frames, infos)
+    recorder.close()
+    assert recorder.frames_written == 35 and recorder.dropped == 0 and recorder.queue_depth == 0
+    assert recorder.bytes_written == 35 * 4 * 5 * 2
+
+    frames, indexes, timestamps = read_recording(path)
+    assert frames.shape == (35, 4, 5)
+    assert np.array_equal(frames[:, 0, 0], np.arange(35))
+    assert np.array_equal(indexes, np.arange(35))
+    assert timestamps == pytest.approx(np.arange(35) * 1e-3)
+
+
+def test_full_queue_drops_frames(tmp_path):
+    recorder = FrameRecorder(tmp_path / 'frames.raw', (4, 5), file_format='Raw', max_queued_frames=10)
+    with recorder._condition:  # writer thread cannot dequeue
+        results = [recorder.put(frames, infos) for frames, infos in batches(3, 4)]
+    recorder.close()
+    assert results == [True, True, False]
+    assert recorder.dropped == 4
+    assert recorder.frames_written == 8
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        FrameRecorder(tmp_path / 'frames.bin', (4, 5), file_format='TIFF')
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the cached DCAM camera registry
+"""
+import pytest
+
+pytest.importorskip('pylablib')
+
+from pymodaq_plugins_hamamatsu.hardware.dcam_registry import CameraRegistry, CameraInfo
+
+
+def test_registry_is_lazy_and_cached(monkeypatch):
+    calls = []
+
+    def enumerate_cameras():
+        calls.append(1)
+        return [CameraInfo(0, 'C11440-36U', '000123')]
+
+    registry = CameraRegistry()
+    monkeypatch.setattr(registry, '_enumerate', enumerate_cameras)
+    assert calls == []
+    assert registry.get(0).model == 'C11440-36U'
+    assert len(registry) == 1
+    assert len(calls) == 1
+    registry.refresh()
+    assert len(calls) == 2
+    with pytest.raises(IndexError):
+        registry.get(1)
+
+
+def test_no_dcam_api():
+    assert isinstance(CameraRegistry().cameras(), list)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the recording and replay of DCAM frames (no camera needed)
+"""
+import time
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.dcam_acquisition import drain_frames
+from pymodaq_plugins_hamamatsu.hardware.dcam_replay import RecordingDCAMCamera, DCAMCameraReplay
+from pylablib.devices.DCAM.DCAM import TDeviceInfo, TFrameInfo
+
+
+class CameraStub:
+    """Camera returning preset frames, 1ms apart"""
+
+    def __init__(self, n_frames):
+        self.frames = np.arange(n_frames * 12, dtype=np.uint16).reshape((n_frames, 3, 4))
+        self.read = 0
+        self.exposure = 0.01
+
+    def get_device_info(self):
+        return TDeviceInfo('Hamamatsu', 'STUB', 'S0001', '1')
+
+    def get_detector_size(self):
+        return 4, 3
+
+    def get_roi(self):
+        return 0, 4, 0, 3, 1, 1
+
+    def get_exposure(self):
+        return self.exposure
+
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+
+    def _info(self, index):
+        return TFrameInfo(index, index, 1000 * index, index, None, 'mono16')
+
+    def read_multiple_images(self, rng=None, peek=False, missing_frame='skip', return_info=False, return_rng=False):
+        first, last = self.read, self.read + 4
+        self.read = last
+        return [self.frames[first:last]], [self._info(index) for index in range(first, last)], (first, last)
+
+    def read_newest_image(self, peek=False, return_info=False):
+        self.read += 1
+        return self.frames[self.read - 1], self._info(self.read - 1)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = tmp_path / 'camera.stream'
+    camera = RecordingDCAMCamera(CameraStub(9), path)
+    camera.set_exposure(0.02)
+    assert camera.exposure == 0.02  # forwarded
+    frames, infos, rng = camera.read_multiple_images(return_info=True, return_rng=True)
+    assert rng == (0, 4) and len(infos) == 4
+    camera.read_multiple_images()
+    assert camera.read_newest_image().shape == (3, 4)
+    camera.close()
+    return path
+
+
+def test_recording(recording):
+    replay = DCAMCameraReplay(recording)
+    assert replay.get_device_info().model == 'STUB' and replay.get_roi() == (0, 4, 0, 3, 1, 1)
+    assert replay.get_exposure() == 0.02 and replay._get_data_dimensions_rc() == (3, 4)
+    assert replay.reader.calls[0][1:] == ('set_exposure', dict(args=[0.02]))
+    assert list(replay.reader.tags) == list(range(9))
+    assert np.diff(replay.reader.times) == pytest.approx(1e-3)  # driver timestamps
+
+
+def test_replay(recording):
+    camera = DCAMCameraReplay(recording, speed=0.5)  # 2ms between frames
+    assert camera.get_new_images_range() is None
+    camera.setup_acquisition(nframes=4)
+    camera.start_acquisition()
+    assert camera.wait_for_frame(nframes=3, timeout=1.)
+    time.sleep(0.002)
+    frames, infos = drain_frames(camera)
+    assert len(frames) >= 3  # older frames may already be lost on a loaded machine
+    first = infos[0].frame_index
+    assert [info.frame_index for info in infos] == list(range(first, first + len(frames)))
+    assert all(np.array_equal(frame, camera.reader[info.frame_index % 9]) for frame, info in zip(frames, infos))
+    with pytest.raises(camera.TimeoutError):
+        camera.wait_for_frame(nframes=100, timeout=0.01)
+
+    time.sleep(0.05)  # looped over the recording, frames older than the buffer are lost
+    status = camera.get_frames_status()
+    assert status.unread == 4 and status.skipped > 0
+    frame, info = camera.read_newest_image(return_info=True)
+    assert np.array_equal(frame, camera.reader[info.frame_index % 9])
+    camera.stop_acquisition()
+    assert not camera.wait_for_frame()
+    camera.close()
+
+
+def test_fast_replay(recording):
+    camera = DCAMCameraReplay(recording, speed=0., loop=False)
+    camera.setup_acquisition(nframes=5)
+    camera.start_acquisition()
+    assert camera.wait_for_frame(timeout=0.)
+    frames, _ = drain_frames(camera)
+    assert len(frames) == 5  # full buffer at each read
+    frames, infos = drain_frames(camera)
+    assert len(frames) == 4 and infos[-1].frame_index == 8  # end of the recording
+    assert drain_frames(camera)[0] is None
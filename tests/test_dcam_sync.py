@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the matching of the frames of several DCAM cameras (no camera needed)
+"""
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.dcam_sync import FrameMatcher
+
+FrameInfo = namedtuple('FrameInfo', ['frame_index', 'timestamp_us'])
+
+
+def stack(indexes, timestamps_us=None):
+    """Frames filled with their index, and their infos"""
+    timestamps_us = indexes if timestamps_us is None else timestamps_us
+    frames = np.array([np.full((2, 3), index) for index in indexes])
+    return frames, [FrameInfo(index, timestamp) for index, timestamp in zip(indexes, timestamps_us)]
+
+
+def test_match_by_index():
+    matcher = FrameMatcher(2)
+    assert matcher.add(0, *stack([0, 1, 2])) is None  # nothing from the second camera yet
+    matched = matcher.add(1, *stack([1, 2]))
+    assert [info.frame_index for _, info in matched] == [2, 2]
+    assert [frame[0, 0] for frame, _ in matched] == [2, 2]
+    assert matcher.matched == 1
+    assert matcher.add(1, *stack([3])) is None  # older frames were discarded with the matched set
+    assert [info.frame_index for _, info in matcher.add(0, *stack([3, 4]))] == [3, 3]
+
+    matcher.reset()
+    assert matcher.matched == 0 and matcher.add(1, *stack([5])) is None
+
+
+def test_match_by_timestamp():
+    matcher = FrameMatcher(3, key='timestamp', tolerance=1e-3)
+    matcher.add(0, *stack([0, 1], [10_000, 20_000]))
+    matcher.add(1, *stack([7, 8], [10_400, 20_900]))
+    matched = matcher.add(2, *stack([3, 4], [9_500, 25_000]))  # only the first frames are within the tolerance
+    assert [info.frame_index for _, info in matched] == [0, 7, 3]
+    assert matcher.add(2, *stack([5], [40_000])) is None
+
+
+def test_pending_limit():
+    matcher = FrameMatcher(2, max_pending=4)
+    matcher.add(0, *stack(range(10)))
+    assert matcher.add(1, *stack([2])) is None  # dropped from the pending frames
+    assert matcher.add(1, *stack([7]))[0][1].frame_index == 7
+
+
+def test_unknown_key():
+    with pytest.raises(ValueError):
+        FrameMatcher(2, key='framestamp')
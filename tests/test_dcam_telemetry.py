@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the DCAM acquisition telemetry (no camera needed)
+"""
+from collections import namedtuple
+
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.dcam_telemetry import AcquisitionTelemetry, TELEMETRY_CHANNELS
+
+FramesStatus = namedtuple('FramesStatus', ['acquired', 'unread', 'skipped', 'buffer_size'])
+
+
+def test_camera_rate_from_driver_counter():
+    telemetry = AcquisitionTelemetry(window=1.)
+    for step in range(20):
+        telemetry.update_status(FramesStatus(100 * step, 25, 3, 100), dropped=2, now=0.1 * step)
+    snapshot = telemetry.snapshot()
+    assert list(snapshot) == list(TELEMETRY_CHANNELS)
+    assert snapshot['camera_fps'] == pytest.approx(1000)
+    assert snapshot['buffer_fill'] == pytest.approx(25)
+    assert snapshot['skipped_frames'] == 3 and snapshot['dropped_frames'] == 2
+
+    telemetry.update_status(FramesStatus(10, 0, 0, 100), now=2.1)  # acquisition restarted
+    assert telemetry.snapshot()['camera_fps'] == 0
+
+
+def test_emission_rate_and_latency():
+    telemetry = AcquisitionTelemetry(window=1.)
+    for step in range(11):
+        telemetry.add_emission(ready_time=0.05 * step, now=0.05 * step + 0.001 * (step + 1))
+    snapshot = telemetry.snapshot()
+    assert snapshot['display_fps'] == pytest.approx(20, rel=0.05)
+    assert snapshot['latency_median'] == pytest.approx(6)
+    assert snapshot['latency_max'] == pytest.approx(11)
+    telemetry.reset()
+    assert telemetry.snapshot()['display_fps'] == 0
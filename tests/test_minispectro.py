@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Mini-spectrometer wrapper which don't need the .NET driver nor a device
+"""
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+usb_core = pytest.importorskip('usb.core')
+
+from pymodaq_plugins_hamamatsu.hardware import minispectro
+
+
+def test_import_is_lazy():
+    assert minispectro.DLL is None
+    assert 'specu1b_DLL' not in sys.modules
+
+
+def test_list_devices_is_cached(monkeypatch):
+    calls = []
+
+    def find(find_all=True, custom_match=None):
+        calls.append(1)
+        devices = [SimpleNamespace(idProduct=0x2909, iSerialNumber=0),
+                   SimpleNamespace(idProduct=0x1234, iSerialNumber=0)]
+        return [dev for dev in devices if custom_match(dev)]
+
+    monkeypatch.setattr(usb_core, 'find', find)
+    monkeypatch.setattr(minispectro, '_devices', None)
+    assert minispectro.list_devices() == [minispectro.DeviceInfo(0x2909, None)]
+    minispectro.list_devices()
+    assert len(calls) == 1
+    minispectro.list_devices(refresh=True)
+    assert len(calls) == 2
+
+
+def test_same_pid_not_opened_twice(monkeypatch):
+    monkeypatch.setattr(minispectro, '_devices', [minispectro.DeviceInfo(0x2909, None)])  # USB serial not readable
+    monkeypatch.setattr(minispectro, '_opened_pids', set())
+    monkeypatch.setattr(minispectro, 'DLL', SimpleNamespace(USB_OpenDevice=lambda pid: 1, USB_CheckDevice=lambda h: 11,
+                                                            USB_OpenPipe=lambda h: 2, USB_ClosePipe=lambda h: None,
+                                                            USB_CloseDevice=lambda h: None))
+    spectro = minispectro.MiniSpectro.__new__(minispectro.MiniSpectro)
+    spectro._open(minispectro.MiniSpectro._find_pid('A123'))
+    with pytest.raises(ValueError, match='serial number B456'):  # the only unknown device is already opened
+        minispectro.MiniSpectro._find_pid('B456')
+    with pytest.raises(ValueError, match='already opened'):
+        minispectro.MiniSpectro.__new__(minispectro.MiniSpectro)._open(0x2909)
+    spectro.close()
+    assert minispectro.MiniSpectro._find_pid('B456') == 0x2909
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the concurrent acquisition of several (simulated) Mini-spectrometers
+"""
+import time
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.minispectro_group import MiniSpectroGroup
+from pymodaq_plugins_hamamatsu.hardware.minispectro_sim import MiniSpectroSim
+
+
+@pytest.fixture
+def group():
+    group = MiniSpectroGroup([MiniSpectroSim(sensor_size=size, device_index=index)
+                              for index, size in enumerate((256, 1024))])
+    yield group
+    group.close()
+
+
+def test_read(group):
+    out = [np.empty(256, dtype=np.uint16), np.empty(1024, dtype=np.uint16)]
+    spectra, timestamps = group.read(out=out)
+    assert spectra[0] is out[0] and spectra[1] is out[1]
+    assert timestamps.shape == (2,)
+    assert [controller.serial_number for controller in group.controllers] == ['SIM10001', 'SIM30002']
+
+
+def test_readouts_overlap(group):
+    group.map(lambda index, controller: controller.set_parameter(integ_time=50000))
+    group.read()
+    start = time.perf_counter()
+    for _ in range(3):
+        group.read()
+    assert time.perf_counter() - start < 3 * 0.05 * 1.8  # not 2 * 3 integrations
+
+
+def test_map_order(group):
+    assert group.map(lambda index, controller: (index, controller.sensor_size)) == [(0, 256), (1, 1024)]
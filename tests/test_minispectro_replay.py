@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the recording and replay of Mini-spectrometer spectra (simulated device)
+"""
+import time
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.minispectro_replay import RecordingMiniSpectro, MiniSpectroReplay, DARK_TAG
+from pymodaq_plugins_hamamatsu.hardware.minispectro_sim import MiniSpectroSim
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = tmp_path / 'spectro.stream'
+    spectro = RecordingMiniSpectro(MiniSpectroSim(sensor_size=256, seed=0), path)
+    spectro.set_parameter(integ_time=10000, gain=0x01)
+    spectra = [spectro.get_sensor_data().copy() for _ in range(10)]
+    spectro.close()
+    return path, spectra
+
+
+def test_replay(recording):
+    path, spectra = recording
+    replay = MiniSpectroReplay(path)
+    assert replay.serial_number == 'SIM10001' and replay.sensor_size == 256
+    assert replay.wl_array[0] == pytest.approx(900) and replay.gain == '0x1'
+    assert replay.reader.calls[0][1:] == ('set_parameter', dict(integ_time=10000, gain=0x01))
+
+    out = np.empty(256, dtype=np.uint16)
+    start = time.perf_counter()
+    replayed = [replay.get_sensor_data(out=out).copy() for _ in range(12)]
+    assert time.perf_counter() - start == pytest.approx(0.11, abs=0.05)  # recorded 10ms integrations
+    assert all(np.array_equal(spectrum, replayed[index % 10]) for index, spectrum in enumerate(spectra + spectra[:2]))
+    replay.close()
+
+
+def test_fast_replay(recording):
+    path, spectra = recording
+    replay = MiniSpectroReplay(path, speed=0., loop=False)
+    start = time.perf_counter()
+    assert all(np.array_equal(replay.get_sensor_data(), spectrum) for spectrum in spectra)
+    assert time.perf_counter() - start < 0.05
+    with pytest.raises(EOFError):
+        replay.get_sensor_data()
+    replay.set_parameter(integ_time=20000)
+    assert replay.integration_time == 20000
+
+
+def test_dark_not_replayed(tmp_path):
+    path = tmp_path / 'spectro.stream'
+    spectro = RecordingMiniSpectro(MiniSpectroSim(sensor_size=256, seed=0), path)
+    spectro.set_parameter(integ_time=10000)
+    spectra = [spectro.get_sensor_data().copy()]
+    with spectro.dark_readout():
+        spectro.get_sensor_data()
+        spectro.get_sensor_data()
+    spectra.append(spectro.get_sensor_data().copy())
+    spectro.close()
+
+    replay = MiniSpectroReplay(path, speed=0.)
+    assert list(replay.reader.tags) == [-1, DARK_TAG, DARK_TAG, -1]
+    assert all(np.array_equal(replay.get_sensor_data(), spectrum) for spectrum in spectra + spectra)
+    replay.close()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the simulated Hamamatsu Mini-spectrometer
+"""
+import time
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.minispectro_sim import MiniSpectroSim, SIMULATED_MODELS, MAX_COUNTS
+
+
+@pytest.mark.parametrize('sensor_size', list(SIMULATED_MODELS))
+def test_sensor_sizes(sensor_size):
+    spectro = MiniSpectroSim(sensor_size=sensor_size, pacing=False)
+    assert spectro.sensor_size == sensor_size
+    intensity = spectro.get_sensor_data()
+    assert spectro.pixel_array.shape == spectro.wl_array.shape == intensity.shape == (sensor_size,)
+    assert intensity.dtype == np.uint16
+    assert len(spectro.calibration_list) == 6
+    spectro.close()
+
+
+def test_cached_wavelength_axis():
+    spectro = MiniSpectroSim(sensor_size=512, pacing=False)
+    wl_array = spectro.wl_array
+    assert wl_array[0] == pytest.approx(spectro.lower_wl)
+    assert wl_array[-1] == pytest.approx(spectro.upper_wl)
+    assert np.all(np.diff(wl_array) > 0)
+    assert not wl_array.flags.writeable
+    spectro.get_sensor_data()
+    assert spectro.wl_array is wl_array
+
+
+def test_parameters():
+    spectro = MiniSpectroSim(pacing=False)
+    spectro.set_parameter(integ_time=20000, gain=0x01, trigger_mode=0x01)
+    assert spectro.integration_time == 20000
+    assert spectro.gain == '0x1'
+    assert spectro.trigger_mode == '0x1'
+    with pytest.raises(ValueError):
+        spectro.set_parameter(integ_time=10)
+    spectro.set_default()
+    assert spectro.integration_time == 100000
+
+
+def test_signal_scales_and_saturates():
+    spectro = MiniSpectroSim(seed=0, pacing=False)
+    spectro.set_parameter(integ_time=10000)
+    low = spectro.get_sensor_data().astype(float)
+    spectro.set_parameter(integ_time=100000)
+    high = spectro.get_sensor_data().astype(float)
+    assert high.max() - spectro.dark_level > 5 * (low.max() - spectro.dark_level)
+    spectro.set_parameter(integ_time=10000000)
+    assert spectro.get_sensor_data().max() == MAX_COUNTS
+
+
+def test_integration_pacing():
+    spectro = MiniSpectroSim(pacing=True)
+    spectro.set_parameter(integ_time=20000)
+    spectro.get_sensor_data()
+    start = time.perf_counter()
+    for _ in range(3):
+        spectro.get_sensor_data()
+    assert time.perf_counter() - start >= 3 * 0.02 * 0.9
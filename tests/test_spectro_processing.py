@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Mini-spectrometer spectrum corrections and resampling
+"""
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.spectro_processing import DarkSpectra, SpectrumCorrector, WavelengthResampler, \
+    load_nonlinearity, uniform_grid
+
+
+@pytest.fixture
+def spectra():
+    return np.random.default_rng(0).integers(800, 4000, size=(4, 256), dtype=np.uint16)
+
+
+def test_dark_cache():
+    darks = DarkSpectra()
+    darks.store((10000, '0x0'), np.full(8, 800, dtype=np.uint16), timestamp=0.)
+    assert darks.get((10000, '0x1')) is None
+    dark = darks.get((10000, '0x0'))
+    assert dark.dtype == np.float64 and not dark.flags.writeable
+    assert darks.get((10000, '0x0'), max_age=10.) is None  # taken too long ago
+    darks.clear()
+    assert darks.get((10000, '0x0')) is None
+
+
+def test_dark_subtraction(spectra):
+    corrector = SpectrumCorrector()
+    assert corrector.is_identity
+    corrector.dark = np.full(256, 800.)
+    out = np.empty(spectra.shape)
+    assert corrector(spectra, out) is out
+    assert np.array_equal(out, spectra - 800.)
+    assert np.array_equal(corrector(spectra[0]), spectra[0] - 800.)
+
+
+def test_nonlinearity(spectra):
+    corrector = SpectrumCorrector()
+    corrector.dark = np.full(256, 800.)
+    coefficients = np.array([1., 1.1, 2e-5])
+    corrector.set_nonlinearity(coefficients, sensor_size=256)
+    counts = spectra - 800.
+    assert np.allclose(corrector(spectra), np.polynomial.polynomial.polyval(counts, coefficients))
+
+    per_pixel = np.stack([np.zeros(256), np.linspace(1, 2, 256)])
+    corrector.set_nonlinearity(per_pixel, sensor_size=256)
+    assert np.allclose(corrector(spectra), counts * np.linspace(1, 2, 256))
+
+    with pytest.raises(ValueError):
+        corrector.set_nonlinearity(np.zeros((2, 100)), sensor_size=256)
+
+
+@pytest.mark.parametrize('suffix', ['.npy', '.txt', '.csv'])
+def test_load_nonlinearity(tmp_path, suffix):
+    coefficients = np.array([[0., 0.], [1., 1.1], [1e-6, 2e-6]])
+    path = tmp_path / f'nonlinearity{suffix}'
+    if suffix == '.npy':
+        np.save(path, coefficients)
+    else:
+        np.savetxt(path, coefficients, delimiter=',' if suffix == '.csv' else ' ')
+    assert np.allclose(load_nonlinearity(path), coefficients)
+
+
+def test_uniform_grid():
+    assert np.allclose(uniform_grid(400, 401, 0.1), np.linspace(400, 401, 11))
+    assert np.allclose(uniform_grid(400, 401.05, 0.5), [400, 400.5, 401])
+    with pytest.raises(ValueError):
+        uniform_grid(500, 400, 1)
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_resampling(spectra, reverse):
+    wavelengths = np.polynomial.polynomial.polyval(np.arange(256.), [320, 2.7, -1e-3])
+    grid = uniform_grid(300, 1000, 1.5)
+    expected = np.array([np.interp(grid, wavelengths, spectrum, left=np.nan, right=np.nan) for spectrum in spectra])
+    if reverse:
+        wavelengths, spectra = wavelengths[::-1], spectra[:, ::-1]
+    resampler = WavelengthResampler(wavelengths, grid)
+    assert resampler.size == len(grid)
+    out = np.empty((len(spectra), len(grid)))
+    assert resampler(spectra, out) is out
+    assert np.allclose(out, expected, equal_nan=True)
+    assert np.isnan(out[:, grid < 320]).all() and not np.isnan(out[:, (grid >= 320) & (grid <= 900)]).any()
+    assert np.allclose(resampler(spectra[0].astype(np.float64)), expected[0], equal_nan=True)
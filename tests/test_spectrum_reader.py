@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the continuous spectrum reader and its ring buffer
+"""
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.minispectro_sim import MiniSpectroSim
+from pymodaq_plugins_hamamatsu.hardware.spectrum_reader import SpectrumRingBuffer, SpectrumReader, read_burst
+
+
+def test_ring_buffer_wraps():
+    ring = SpectrumRingBuffer(4, 8)
+    for index in range(10):
+        ring.writable_slot()[:] = index
+        assert ring.commit(timestamp=float(index)) == index
+    assert ring.count == 10
+    assert ring.oldest_index() == 7
+    spectrum, timestamp = ring.get(8)
+    assert np.all(spectrum == 8) and timestamp == 8.
+    with pytest.raises(IndexError):
+        ring.get(6)
+    spectra, timestamps = ring.get_last(5)  # only 3 still available
+    assert spectra.shape == (3, 8)
+    assert np.array_equal(timestamps, [7., 8., 9.])
+
+
+def test_reader_fills_ring():
+    spectro = MiniSpectroSim(sensor_size=256, pacing=True)
+    spectro.set_parameter(integ_time=5000)
+    ring = SpectrumRingBuffer(8, spectro.sensor_size)
+    indexes = []
+    reader = SpectrumReader(spectro, ring, callback=indexes.append)
+    reader.start()
+    assert ring.wait_for(4, timeout=2.)
+    reader.stop(timeout=None)
+    assert not reader.is_alive()
+    assert reader.error is None
+    assert indexes[:5] == list(range(5))
+    assert ring.get(4)[0].max() > 0
+
+
+def test_read_burst():
+    spectro = MiniSpectroSim(sensor_size=256, pacing=False)
+    out = np.zeros((5, 256), dtype=np.uint16)
+    timestamps = np.zeros(5)
+    spectra, times = read_burst(spectro, out, timestamps)
+    assert spectra is out and times is timestamps
+    assert np.all(out > 0)
+    assert np.all(np.diff(timestamps) >= 0) and timestamps[0] > 0
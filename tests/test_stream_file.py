@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the stream recording file format and of the replay timing
+"""
+import threading
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_hamamatsu.hardware.stream_file import StreamWriter, StreamReader, ReplayClock, indexed_path
+
+
+def test_stream_roundtrip(tmp_path):
+    path = tmp_path / 'device.stream'
+    writer = StreamWriter(path, dict(model='test', size=np.int64(5)))
+    for index in range(4):
+        writer.write_data(np.full(5, index, dtype=np.uint16), tag=index, elapsed=0.1 * index)
+    writer.write_call('set_parameter', integ_time=10000)
+    writer.write_data(np.ones((2, 3), dtype=np.float32), elapsed=1.)  # new format
+    writer.close()
+    assert writer.frames == 5
+
+    reader = StreamReader(path)
+    assert reader.metadata == dict(model='test', size=5)
+    assert len(reader) == 5 and reader.formats == [(np.dtype(np.uint16), (5,)), (np.dtype(np.float32), (2, 3))]
+    assert reader.times == pytest.approx([0., 0.1, 0.2, 0.3, 1.])
+    assert list(reader.tags) == [0, 1, 2, 3, -1]
+    assert [call[1:] for call in reader.calls] == [('set_parameter', dict(integ_time=10000))]
+    assert np.array_equal(reader[4], np.ones((2, 3)))
+    assert not reader[0].flags.writeable
+
+    indices = reader.select(np.dtype(np.uint16), (5,))
+    assert list(indices) == [0, 1, 2, 3]
+    stack = reader.stack(indices)
+    assert stack.shape == (4, 5) and np.array_equal(stack[:, 0], np.arange(4))
+    assert reader.stack([0, 4]) is None  # different formats
+    reader.close()
+
+
+def test_interrupted_recording(tmp_path):
+    path = tmp_path / 'device.stream'
+    writer = StreamWriter(path)
+    for index in range(3):
+        writer.write_data(np.full(8, index, dtype=np.uint16))
+    writer.close()
+    path.write_bytes(path.read_bytes()[:-5])  # last record truncated
+    reader = StreamReader(path)
+    assert len(reader) == 2 and reader[1][0] == 1
+
+    path.write_bytes(b'not a stream')
+    with pytest.raises(ValueError):
+        StreamReader(path)
+
+
+def test_writer_queue(tmp_path):
+    path = tmp_path / 'device.stream'
+    writer = StreamWriter(path, max_queued=2)
+    release = threading.Event()
+    write = writer._write
+
+    def slow_write(*args):
+        release.wait()
+        write(*args)
+
+    writer._write = slow_write  # disk slower than the readout
+    buffer = np.zeros(4, dtype=np.uint16)
+    queued = []
+    for index in range(5):
+        buffer[:] = index  # reused by the caller
+        queued.append(writer.write_data(buffer))
+    assert queued == [True, True, False, False, False]
+    release.set()
+    writer.close()
+    assert writer.frames == 2 and writer.dropped == 3
+    reader = StreamReader(path)
+    assert [reader[index][0] for index in range(len(reader))] == [0, 1]
+
+
+def test_replay_clock():
+    clock = ReplayClock(np.array([10., 10.1, 10.2, 10.3]), speed=2.)
+    assert clock.period == pytest.approx(0.4)
+    assert clock.time(1) == pytest.approx(0.05)
+    assert clock.time(5) == pytest.approx(0.25)  # second loop
+    assert clock.count(0.) == 1 and clock.count(0.11) == 3 and clock.count(0.21) == 5
+
+    clock = ReplayClock(np.array([0., 0.1]), speed=1., loop=False)
+    assert clock.count(10.) == 2
+    assert ReplayClock(np.array([0.]), speed=0.).count(0.) == float('inf')
+    with pytest.raises(ValueError):
+        ReplayClock(np.array([]))
+
+
+def test_indexed_path(tmp_path):
+    assert indexed_path(tmp_path / 'a.stream', 0) == tmp_path / 'a.stream'
+    assert indexed_path(tmp_path / 'a.stream', 2) == tmp_path / 'a_2.stream'